@@ -10,7 +10,15 @@ from cactus.setup.cactus_setupTest import TestCase as setupTest
 from cactus.blast.blastTest import TestCase as blastTest
 from cactus.blast.cactus_coverageTest import TestCase as coverageTest
 from cactus.blast.trimSequencesTest import TestCase as trimSequencesTest
+from cactus.blast.blastCollateTest import TestCase as blastCollateTest
+from cactus.blast.alignmentFileTest import TestCase as alignmentFileTest
+from cactus.blast.upconvertCoordinatesTest import TestCase as upconvertCoordinatesTest
+from cactus.blast.alignmentCoverageTest import TestCase as alignmentCoverageTest
+from cactus.blast.outgroupRoundTest import TestCase as outgroupRoundTest
 from cactus.pipeline.cactus_workflowTest import TestCase as workflowTest
+from cactus.pipeline.ktserverSnapshotTest import TestCase as ktserverSnapshotTest
+from cactus.pipeline.ktserverControlTest import TestCase as ktserverControlTest
+from cactus.pipeline.embeddedDbTest import TestCase as embeddedDbTest
 from cactus.pipeline.cactus_evolverTest import TestCase as evolverTest
 from cactus.bar.cactus_barTest import TestCase as barTest
 from cactus.phylogeny.cactus_phylogenyTest import TestCase as phylogenyTest
@@ -23,6 +31,9 @@ from cactus.normalisation.cactus_normalisationTest import TestCase as normalisat
 from cactus.progressive.allTests import allSuites as progressiveSuite
 from cactus.shared.commonTest import TestCase as commonTest
 from cactus.shared.experimentWrapperTest import TestCase as experimentWrapperTest
+from cactus.shared.resourceModelTest import TestCase as resourceModelTest
+from cactus.shared.profilingTest import TestCase as profilingTest
+from cactus.shared.fastaTest import TestCase as fastaTest
 from cactus.faces.cactus_fillAdjacenciesTest import TestCase as fillAdjacenciesTest
 from cactus.preprocessor.allTests import allSuites as preprocessorTest
 from cactus.preprocessor.lastzRepeatMasking.cactus_lastzRepeatMaskTest import TestCase as lastzRepeatMaskTest
@@ -34,6 +45,9 @@ def allSuites():
                        [setupTest,
                         cafTest,
                         workflowTest,
+                        ktserverSnapshotTest,
+                        ktserverControlTest,
+                        embeddedDbTest,
                         evolverTest,
                         barTest,
                         phylogenyTest,
@@ -44,9 +58,17 @@ def allSuites():
                         halTest,
                         coverageTest,
                         trimSequencesTest,
+                        blastCollateTest,
+                        alignmentFileTest,
+                        upconvertCoordinatesTest,
+                        alignmentCoverageTest,
+                        outgroupRoundTest,
                         experimentWrapperTest,
                         fillAdjacenciesTest,
-                        commonTest]] + 
+                        commonTest,
+                        resourceModelTest,
+                        profilingTest,
+                        fastaTest]] + 
                         [progressiveSuite()])
     if "SON_TRACE_DATASETS" in os.environ:
         allTests.addTests([unittest.makeSuite(blastTest), preprocessorTest(), unittest.makeSuite(lastzRepeatMaskTest), unittest.makeSuite(realignTest)])
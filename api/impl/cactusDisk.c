@@ -17,6 +17,154 @@
 #define CACTUS_DISK_PARAMETER_KEY -100000
 #define CACTUS_DISK_SEQUENCE_CHUNK_SIZE 500
 
+/*
+ * Functions on the shards of the database. Each record is stored in the
+ * shard picked by a hash of its key, so consecutive keys (such as the chunks
+ * of a sequence) are spread over the shards. Bulk operations are split into
+ * one bulk operation per shard, so are only atomic within a shard.
+ */
+
+int64_t cactusDisk_getShardIndex(CactusDisk *cactusDisk, int64_t key) {
+    int64_t shardNumber = stList_length(cactusDisk->databases);
+    if (shardNumber == 1) {
+        return 0;
+    }
+    //The splitmix64 finaliser
+    uint64_t h = (uint64_t) key;
+    h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    h = (h ^ (h >> 27)) * 0x94d049bb133111ebULL;
+    h = h ^ (h >> 31);
+    return (int64_t) (h % (uint64_t) shardNumber);
+}
+
+static stKVDatabase *getShard(CactusDisk *cactusDisk, int64_t key) {
+    return stList_get(cactusDisk->databases, cactusDisk_getShardIndex(cactusDisk, key));
+}
+
+static stList *constructShardedRequests(CactusDisk *cactusDisk, void (*destructElement)(void *)) {
+    /*
+     * Constructs a list of lists of requests, one per shard.
+     */
+    stList *requests = stList_construct3(0, (void (*)(void *)) stList_destruct);
+    for (int64_t i = 0; i < stList_length(cactusDisk->databases); i++) {
+        stList_append(requests, stList_construct3(0, destructElement));
+    }
+    return requests;
+}
+
+static void addShardedRequest(CactusDisk *cactusDisk, stList *requests, int64_t key, void *request) {
+    stList_append(stList_get(requests, cactusDisk_getShardIndex(cactusDisk, key)), request);
+}
+
+static int64_t shardedRequestsLength(stList *requests) {
+    int64_t length = 0;
+    for (int64_t i = 0; i < stList_length(requests); i++) {
+        length += stList_length(stList_get(requests, i));
+    }
+    return length;
+}
+
+static void bulkSetRecords(CactusDisk *cactusDisk, stList *requests) {
+    for (int64_t i = 0; i < stList_length(requests); i++) {
+        stList *shardRequests = stList_get(requests, i);
+        if (stList_length(shardRequests) > 0) {
+            stKVDatabase_bulkSetRecords(stList_get(cactusDisk->databases, i), shardRequests);
+        }
+    }
+}
+
+static void bulkRemoveRecords(CactusDisk *cactusDisk, stList *requests) {
+    for (int64_t i = 0; i < stList_length(requests); i++) {
+        stList *shardRequests = stList_get(requests, i);
+        if (stList_length(shardRequests) > 0) {
+            stKVDatabase_bulkRemoveRecords(stList_get(cactusDisk->databases, i), shardRequests);
+        }
+    }
+}
+
+stList *cactusDisk_bulkGetRecords(CactusDisk *cactusDisk, stList *keys) {
+    /*
+     * Gets the records for a list of keys from their shards, in the order of the keys.
+     */
+    int64_t shardNumber = stList_length(cactusDisk->databases);
+    if (shardNumber == 1) {
+        return stKVDatabase_bulkGetRecords(stList_get(cactusDisk->databases, 0), keys);
+    }
+    stList *keysByShard = constructShardedRequests(cactusDisk, NULL);
+    for (int64_t i = 0; i < stList_length(keys); i++) {
+        int64_t *key = stList_get(keys, i);
+        addShardedRequest(cactusDisk, keysByShard, *key, key);
+    }
+    stList *recordsByShard = stList_construct3(0, (void (*)(void *)) stList_destruct);
+    for (int64_t i = 0; i < shardNumber; i++) {
+        stList *shardKeys = stList_get(keysByShard, i);
+        stList_append(recordsByShard, stList_length(shardKeys) > 0 ?
+                      stKVDatabase_bulkGetRecords(stList_get(cactusDisk->databases, i), shardKeys) : stList_construct());
+    }
+    stList *records = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkResult_destruct);
+    int64_t *nextRecord = st_calloc(shardNumber, sizeof(int64_t));
+    for (int64_t i = 0; i < stList_length(keys); i++) {
+        int64_t shardIndex = cactusDisk_getShardIndex(cactusDisk, *((int64_t *) stList_get(keys, i)));
+        stList_append(records, stList_get(stList_get(recordsByShard, shardIndex), nextRecord[shardIndex]++));
+    }
+    for (int64_t i = 0; i < shardNumber; i++) {
+        //The results now belong to records
+        stList_setDestructor(stList_get(recordsByShard, i), NULL);
+    }
+    free(nextRecord);
+    stList_destruct(recordsByShard);
+    stList_destruct(keysByShard);
+    return records;
+}
+
+static char *replaceXmlAttribute(const char *string, const char *attribute, const char *value) {
+    /*
+     * Returns a copy of the XML string with the value of the first occurrence of the given attribute replaced.
+     */
+    char *pattern = stString_print(" %s=\"", attribute);
+    const char *start = strstr(string, pattern);
+    if (start == NULL) {
+        st_errAbort("The attribute %s is missing from the database conf string: %s", attribute, string);
+    }
+    start += strlen(pattern);
+    char *prefix = stString_getSubString(string, 0, start - string);
+    char *replaced = stString_print("%s%s%s", prefix, value, strchr(start, '"'));
+    free(prefix);
+    free(pattern);
+    return replaced;
+}
+
+stList *cactusDisk_getShardConfs(const char *databaseString) {
+    /*
+     * Returns a list of the confs of the extra shards listed in the database conf string.
+     */
+    stList *confs = stList_construct3(0, (void (*)(void *)) stKVDatabaseConf_destruct);
+    const char *start = strstr(databaseString, " shards=\"");
+    if (start == NULL) {
+        return confs;
+    }
+    start += strlen(" shards=\"");
+    char *shardsString = stString_getSubString(start, 0, strchr(start, '"') - start);
+    stList *shards = stString_split(shardsString);
+    //The first shard is the one described by the rest of the string
+    for (int64_t i = 1; i < stList_length(shards); i++) {
+        char *shard = stList_get(shards, i);
+        char *separator = strrchr(shard, ':');
+        if (separator == NULL) {
+            st_errAbort("Could not parse the shard %s in the database conf string: %s", shard, databaseString);
+        }
+        *separator = '\0';
+        char *shardString = replaceXmlAttribute(databaseString, "host", shard);
+        char *shardString2 = replaceXmlAttribute(shardString, "port", separator + 1);
+        stList_append(confs, stKVDatabaseConf_constructFromString(shardString2));
+        free(shardString);
+        free(shardString2);
+    }
+    stList_destruct(shards);
+    free(shardsString);
+    return confs;
+}
+
 /*
  * Functions on meta sequences.
  */
@@ -42,18 +190,19 @@ Name cactusDisk_addString(CactusDisk *cactusDisk, const char *string) {
     int64_t stringSize = strlen(string);
     int64_t intervalSize = ceil((double) stringSize / CACTUS_DISK_SEQUENCE_CHUNK_SIZE);
     Name name = cactusDisk_getUniqueIDInterval(cactusDisk, intervalSize);
-    stList *insertRequests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    stList *insertRequests = constructShardedRequests(cactusDisk, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
     for (int64_t i = 0; i * CACTUS_DISK_SEQUENCE_CHUNK_SIZE < stringSize; i++) {
         int64_t j =
             (i + 1) * CACTUS_DISK_SEQUENCE_CHUNK_SIZE < stringSize ?
             CACTUS_DISK_SEQUENCE_CHUNK_SIZE : stringSize - i * CACTUS_DISK_SEQUENCE_CHUNK_SIZE;
         char *subString = stString_getSubString(string, i * CACTUS_DISK_SEQUENCE_CHUNK_SIZE, j);
-        stList_append(insertRequests, stKVDatabaseBulkRequest_constructInsertRequest(name + i, subString, j + 1));
+        addShardedRequest(cactusDisk, insertRequests, name + i,
+                          stKVDatabaseBulkRequest_constructInsertRequest(name + i, subString, j + 1));
         free(subString);
     }
     stTry
     {
-        stKVDatabase_bulkSetRecords(cactusDisk->database, insertRequests);
+        bulkSetRecords(cactusDisk, insertRequests);
     }
     stCatch(except)
     {
@@ -163,7 +312,7 @@ static void cacheSubstringsFromDB(CactusDisk *cactusDisk, stList *substrings) {
     stList *records = NULL;
     stTry
     {
-        records = stKVDatabase_bulkGetRecords(cactusDisk->database, getRequests);
+        records = cactusDisk_bulkGetRecords(cactusDisk, getRequests);
     }
     stCatch(except)
     {
@@ -423,7 +572,7 @@ static stList *getRecords(CactusDisk *cactusDisk, stList *objectNames, char *typ
     stList *records = NULL;
     stTry
         {
-            records = stKVDatabase_bulkGetRecords(cactusDisk->database, objectNames);
+            records = cactusDisk_bulkGetRecords(cactusDisk, objectNames);
         }
         stCatch(except)
             {
@@ -469,7 +618,7 @@ static void *getRecord(CactusDisk *cactusDisk, Name objectName, char *type, int6
     } else {
         stTry
             {
-                cA = stKVDatabase_getRecord2(cactusDisk->database, objectName, &recordSize);
+                cA = stKVDatabase_getRecord2(getShard(cactusDisk, objectName), objectName, &recordSize);
             }
             stCatch(except)
                 {
@@ -499,23 +648,27 @@ static void *getRecord(CactusDisk *cactusDisk, Name objectName, char *type, int6
 static bool containsRecord(CactusDisk *cactusDisk, Name objectName) {
     return (cactusDisk->cache != NULL
             && stCache_containsRecord(cactusDisk->cache, objectName, 0, INT64_MAX))
-        || stKVDatabase_containsRecord(cactusDisk->database, objectName);
+        || stKVDatabase_containsRecord(getShard(cactusDisk, objectName), objectName);
 }
 
-static CactusDisk *cactusDisk_constructPrivate(stKVDatabaseConf *conf, bool create, bool cache) {
+CactusDisk *cactusDisk_construct3(stList *confs, bool create, bool cache) {
     CactusDisk *cactusDisk = st_calloc(1, sizeof(CactusDisk));
 
+    //Now open the database
+    cactusDisk->databases = stList_construct3(0, (void (*)(void *)) stKVDatabase_destruct);
+    for (int64_t i = 0; i < stList_length(confs); i++) {
+        stList_append(cactusDisk->databases, stKVDatabase_construct(stList_get(confs, i), create));
+    }
+
     //construct lists of in memory objects
     cactusDisk->metaSequences = stSortedSet_construct3(cactusDisk_constructMetaSequencesP, NULL);
     cactusDisk->flowers = stSortedSet_construct3(cactusDisk_constructFlowersP, NULL);
     cactusDisk->flowerNamesMarkedForDeletion = stSortedSet_construct3((int (*)(const void *, const void *)) strcmp,
             free);
-    cactusDisk->updateRequests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    cactusDisk->updateRequests = constructShardedRequests(cactusDisk, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
 
     cactusDisk->eventTree = NULL;
 
-    //Now open the database
-    cactusDisk->database = stKVDatabase_construct(conf, create);
     if (cache) {
         // 10MB for general DB responses
         cactusDisk->cache = stCache_construct2(10000000);
@@ -537,7 +690,7 @@ static CactusDisk *cactusDisk_constructPrivate(stKVDatabaseConf *conf, bool crea
         }
         void *record = getRecord(cactusDisk, CACTUS_DISK_PARAMETER_KEY, "cactus_disk parameters", NULL);
         void *record2 = record;
-        cactusDisk_loadFromBinaryRepresentation(&record, cactusDisk, conf);
+        cactusDisk_loadFromBinaryRepresentation(&record, cactusDisk, stList_get(confs, 0));
         free(record2);
     } else {
         assert(create);
@@ -547,7 +700,22 @@ static CactusDisk *cactusDisk_constructPrivate(stKVDatabaseConf *conf, bool crea
 }
 
 CactusDisk *cactusDisk_construct(stKVDatabaseConf *conf, bool create, bool cache) {
-    return cactusDisk_constructPrivate(conf, create, cache);
+    stList *confs = stList_construct();
+    stList_append(confs, conf);
+    CactusDisk *cactusDisk = cactusDisk_construct3(confs, create, cache);
+    stList_destruct(confs);
+    return cactusDisk;
+}
+
+CactusDisk *cactusDisk_construct2(stKVDatabaseConf *conf, const char *databaseString, bool create, bool cache) {
+    stList *shardConfs = cactusDisk_getShardConfs(databaseString);
+    stList *confs = stList_construct();
+    stList_append(confs, conf);
+    stList_appendAll(confs, shardConfs);
+    CactusDisk *cactusDisk = cactusDisk_construct3(confs, create, cache);
+    stList_destruct(confs);
+    stList_destruct(shardConfs);
+    return cactusDisk;
 }
 
 void cactusDisk_destruct(CactusDisk *cactusDisk) {
@@ -567,7 +735,7 @@ void cactusDisk_destruct(CactusDisk *cactusDisk) {
     stSortedSet_destruct(cactusDisk->metaSequences);
 
     //close DB
-    stKVDatabase_destruct(cactusDisk->database);
+    stList_destruct(cactusDisk->databases);
 
     if (cactusDisk->cache != NULL) {
         stCache_destruct(cactusDisk->cache);
@@ -594,12 +762,12 @@ void cactusDisk_addUpdateRequest(CactusDisk *cactusDisk, Flower *flower) {
         int64_t recordSize2;
         void *vA2 = getRecord(cactusDisk, flower_getName(flower), "flower", &recordSize2);
         if (!stCache_recordsIdentical(vA, recordSize, vA2, recordSize2)) { //Only rewrite if we actually did something
-            stList_append(cactusDisk->updateRequests,
+            addShardedRequest(cactusDisk, cactusDisk->updateRequests, flower_getName(flower),
                     stKVDatabaseBulkRequest_constructUpdateRequest(flower_getName(flower), compressed, compressedSize));
         }
         free(vA2);
     } else {
-        stList_append(cactusDisk->updateRequests,
+        addShardedRequest(cactusDisk, cactusDisk->updateRequests, flower_getName(flower),
                 stKVDatabaseBulkRequest_constructInsertRequest(flower_getName(flower), compressed, compressedSize));
     }
     free(vA);
@@ -615,11 +783,11 @@ void cactusDisk_forceParameterUpdate(CactusDisk *cactusDisk, bool keyAlreadyExis
     //Compression
     cactusDiskParameters = compress(cactusDiskParameters, &recordSize);
     if (keyAlreadyExists) {
-        stList_append(cactusDisk->updateRequests,
+        addShardedRequest(cactusDisk, cactusDisk->updateRequests, CACTUS_DISK_PARAMETER_KEY,
                       stKVDatabaseBulkRequest_constructUpdateRequest(CACTUS_DISK_PARAMETER_KEY, cactusDiskParameters,
                                                                      recordSize));
     } else {
-        stList_append(cactusDisk->updateRequests,
+        addShardedRequest(cactusDisk, cactusDisk->updateRequests, CACTUS_DISK_PARAMETER_KEY,
                       stKVDatabaseBulkRequest_constructInsertRequest(CACTUS_DISK_PARAMETER_KEY, cactusDiskParameters,
                                                                      recordSize));
     }
@@ -630,7 +798,7 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
     Flower *flower;
     int64_t recordSize;
 
-    stList *removeRequests = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
+    stList *removeRequests = constructShardedRequests(cactusDisk, (void (*)(void *)) stIntTuple_destruct);
 
     st_logDebug("Starting to write the cactus to disk\n");
 
@@ -649,8 +817,8 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
     while ((nameString = stSortedSet_getNext(it)) != NULL) {
         Name name = cactusMisc_stringToName(nameString);
         if (containsRecord(cactusDisk, name)) {
-            stList_append(cactusDisk->updateRequests, stKVDatabaseBulkRequest_constructUpdateRequest(name, &name, 0)); //We set it to null in the first atomic operation.
-            stList_append(removeRequests, stIntTuple_construct1(name));
+            addShardedRequest(cactusDisk, cactusDisk->updateRequests, name, stKVDatabaseBulkRequest_constructUpdateRequest(name, &name, 0)); //We set it to null in the first atomic operation.
+            addShardedRequest(cactusDisk, removeRequests, name, stIntTuple_construct1(name));
         }
     }
     stSortedSet_destructIterator(it);
@@ -668,10 +836,10 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
         //Compression
         vA = compress(vA, &recordSize);
         if (!containsRecord(cactusDisk, metaSequence_getName(metaSequence))) {
-            stList_append(cactusDisk->updateRequests,
+            addShardedRequest(cactusDisk, cactusDisk->updateRequests, metaSequence_getName(metaSequence),
                     stKVDatabaseBulkRequest_constructInsertRequest(metaSequence_getName(metaSequence), vA, recordSize));
         } else {
-            stList_append(cactusDisk->updateRequests,
+            addShardedRequest(cactusDisk, cactusDisk->updateRequests, metaSequence_getName(metaSequence),
                     stKVDatabaseBulkRequest_constructUpdateRequest(metaSequence_getName(metaSequence), vA, recordSize));
         }
         free(vA);
@@ -686,13 +854,13 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
 
     st_logDebug("Checked if need to write the initial parameters\n");
 
-    if (stList_length(cactusDisk->updateRequests) > 0) {
-        st_logDebug("Going to write %" PRIi64 " updates\n", stList_length(cactusDisk->updateRequests));
+    if (shardedRequestsLength(cactusDisk->updateRequests) > 0) {
+        st_logDebug("Going to write %" PRIi64 " updates\n", shardedRequestsLength(cactusDisk->updateRequests));
         stTry
             {
-                st_logDebug("Writing %" PRIi64 " updates\n", stList_length(cactusDisk->updateRequests));
-                assert(stList_length(cactusDisk->updateRequests) > 0);
-                stKVDatabase_bulkSetRecords(cactusDisk->database, cactusDisk->updateRequests);
+                st_logDebug("Writing %" PRIi64 " updates\n", shardedRequestsLength(cactusDisk->updateRequests));
+                assert(shardedRequestsLength(cactusDisk->updateRequests) > 0);
+                bulkSetRecords(cactusDisk, cactusDisk->updateRequests);
             }
             stCatch(except)
                 {
@@ -704,10 +872,10 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
 
     st_logDebug("Updated the database with inserts\n");
 
-    if (stList_length(removeRequests) > 0) {
+    if (shardedRequestsLength(removeRequests) > 0) {
         stTry
             {
-                stKVDatabase_bulkRemoveRecords(cactusDisk->database, removeRequests);
+                bulkRemoveRecords(cactusDisk, removeRequests);
             }
             stCatch(except)
                 {
@@ -720,7 +888,7 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
     st_logDebug("Now removed flowers we don't need\n");
 
     stList_destruct(cactusDisk->updateRequests);
-    cactusDisk->updateRequests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    cactusDisk->updateRequests = constructShardedRequests(cactusDisk, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
     stList_destruct(removeRequests);
 
     st_logDebug("Finished writing to the database\n");
@@ -836,8 +1004,8 @@ void cactusDisk_getBlockOfUniqueIDs(CactusDisk *cactusDisk, int64_t intervalSize
                 assert(minimumValue >= 1);
                 assert(maximumValue <= INT64_MAX);
                 assert(minimumValue < maximumValue);
-                if (stKVDatabase_containsRecord(cactusDisk->database, keyName)) {
-                    cactusDisk->maxUniqueNumber = stKVDatabase_incrementInt64(cactusDisk->database, keyName,
+                if (stKVDatabase_containsRecord(getShard(cactusDisk, keyName), keyName)) {
+                    cactusDisk->maxUniqueNumber = stKVDatabase_incrementInt64(getShard(cactusDisk, keyName), keyName,
                             intervalSize);
                     cactusDisk->uniqueNumber = cactusDisk->maxUniqueNumber - intervalSize;
                     if (cactusDisk->uniqueNumber <= 0 || cactusDisk->uniqueNumber < minimumValue
@@ -851,7 +1019,7 @@ void cactusDisk_getBlockOfUniqueIDs(CactusDisk *cactusDisk, int64_t intervalSize
                 } else {
                     stTry
                         {
-                            stKVDatabase_insertInt64(cactusDisk->database, keyName, minimumValue);
+                            stKVDatabase_insertInt64(getShard(cactusDisk, keyName), keyName, minimumValue);
                         }
                         stCatch(except)
                             {
@@ -10,11 +10,11 @@
 #include "cactusGlobals.h"
 
 struct _cactusDisk {
-    stKVDatabase *database;
+    stList *databases; // The shards of the database, see getShard()
     stSortedSet *metaSequences;
     stSortedSet *flowers;
     stSortedSet *flowerNamesMarkedForDeletion;
-    stList *updateRequests;
+    stList *updateRequests; // Per shard
     stCache *cache;
     stCache *stringCache;
     EventTree *eventTree;
@@ -30,6 +30,32 @@ struct _cactusDisk {
 ////////////////////////////////////////////////
 ////////////////////////////////////////////////
 
+/*
+ * Constructs a cactus disk spread over the databases of the given list of confs, the first of
+ * which holds the parameters of the disk.
+ */
+CactusDisk *cactusDisk_construct3(stList *confs, bool create, bool cache);
+
+/*
+ * Functions on the shards of the database.
+ */
+
+/*
+ * Returns the index of the shard the record with the given key is stored in.
+ */
+int64_t cactusDisk_getShardIndex(CactusDisk *cactusDisk, int64_t key);
+
+/*
+ * Returns a list of the confs of the extra shards listed in the "shards" attribute of the
+ * database conf string, the first shard being the one the rest of the string describes.
+ */
+stList *cactusDisk_getShardConfs(const char *databaseString);
+
+/*
+ * Gets the records for a list of keys from their shards, in the order of the keys.
+ */
+stList *cactusDisk_bulkGetRecords(CactusDisk *cactusDisk, stList *keys);
+
 /*
  * Returns non-zero if the given flower is loaded in memory.
  */
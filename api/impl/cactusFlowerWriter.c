@@ -151,7 +151,57 @@ static void addName(stList *flowerNamesList, Name name) {
     stList_append(flowerNamesList, iA);
 }
 
+/*
+ * Reading the binary form of the flower names (see
+ * encodeBinaryFlowerNames in cactus/shared/common.py): a magic byte, then
+ * varints giving the number of flowers, the number of secondary grouping
+ * separators, the separators themselves and the zigzag-encoded deltas
+ * between successive flower names.
+ */
+
+#define BINARY_FLOWER_NAMES_MAGIC 0xca
+
+static uint64_t readVarint(FILE *fileHandle) {
+    uint64_t value = 0;
+    for (int64_t shift = 0; shift < 64; shift += 7) {
+        int c = getc(fileHandle);
+        if (c == EOF) {
+            st_errAbort("Reached the end of the input while reading binary flower names");
+        }
+        value |= ((uint64_t) (c & 0x7f)) << shift;
+        if ((c & 0x80) == 0) {
+            return value;
+        }
+    }
+    st_errAbort("Got a malformed varint while reading binary flower names");
+    return 0;
+}
+
+static int64_t unzigzag(uint64_t value) {
+    return (int64_t) (value >> 1) ^ -((int64_t) (value & 1));
+}
+
+static stList *parseBinaryNames(FILE *fileHandle) {
+    int64_t flowerNumber = readVarint(fileHandle);
+    int64_t separatorNumber = readVarint(fileHandle);
+    for (int64_t i = 0; i < separatorNumber; i++) {
+        readVarint(fileHandle); // The secondary groupings are only used by the workflow
+    }
+    stList *flowerNamesList = stList_construct3(0, free);
+    Name name = 0;
+    for (int64_t i = 0; i < flowerNumber; i++) {
+        name += unzigzag(readVarint(fileHandle));
+        addName(flowerNamesList, name);
+    }
+    return flowerNamesList;
+}
+
 stList *flowerWriter_parseNames(FILE *fileHandle) {
+    int c = getc(fileHandle);
+    if (c == BINARY_FLOWER_NAMES_MAGIC) {
+        return parseBinaryNames(fileHandle);
+    }
+    ungetc(c, fileHandle);
     int64_t flowerArgumentNumber;
     int64_t j = fscanf(fileHandle, "%" PRIi64 "", &flowerArgumentNumber);
     (void) j;
@@ -30,6 +30,15 @@ extern const char *CACTUS_DISK_EXCEPTION_ID;
  */
 CactusDisk *cactusDisk_construct(stKVDatabaseConf *conf, bool create, bool cache);
 
+/*
+ * As cactusDisk_construct, but the database may be sharded. The
+ * databaseString (from which conf was parsed) can have a "shards"
+ * attribute listing the "host:port" of each kyoto tycoon server the
+ * database is spread over, the first of which is the server in conf.
+ * Each record is stored in the shard given by a hash of its key.
+ */
+CactusDisk *cactusDisk_construct2(stKVDatabaseConf *conf, const char *databaseString, bool create, bool cache);
+
 /*
  * Destructs the cactus disk and all open flowers and sequences, and
  * then disconnects from the cactus DB.
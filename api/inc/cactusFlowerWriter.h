@@ -22,6 +22,7 @@ void flowerWriter_add(FlowerWriter *flowerWriter, Name flowerName, int64_t flowe
 
 /*
  * Decodes a list of flower names and returns them from the filehandle.
+ * The names may be in either the text or the compact binary form.
  */
 stList *flowerWriter_parseNames(FILE *fileHandle);
 
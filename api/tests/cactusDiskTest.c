@@ -134,6 +134,98 @@ void testCactusDisk_getUniqueID_UniqueIntervals(CuTest* testCase) {
     cactusDiskTestTeardown();
 }
 
+void testCactusDisk_getShardConfs(CuTest* testCase) {
+    //The shards attribute lists every shard, the first being the one the rest of the string describes
+    stList *confs = cactusDisk_getShardConfs("<st_kv_database_conf shards=\"host1:1978 host2:1979 host3:1980\" "
+            "type=\"kyoto_tycoon\"><kyoto_tycoon database_dir=\"dir\" host=\"host1\" port=\"1978\" />"
+            "</st_kv_database_conf>");
+    CuAssertIntEquals(testCase, 2, stList_length(confs));
+    CuAssertStrEquals(testCase, "host2", stKVDatabaseConf_getHost(stList_get(confs, 0)));
+    CuAssertIntEquals(testCase, 1979, stKVDatabaseConf_getPort(stList_get(confs, 0)));
+    CuAssertStrEquals(testCase, "host3", stKVDatabaseConf_getHost(stList_get(confs, 1)));
+    CuAssertIntEquals(testCase, 1980, stKVDatabaseConf_getPort(stList_get(confs, 1)));
+    stList_destruct(confs);
+
+    //Without the attribute there are no extra shards
+    confs = cactusDisk_getShardConfs("<st_kv_database_conf type=\"kyoto_tycoon\"><kyoto_tycoon database_dir=\"dir\" "
+            "host=\"host1\" port=\"1978\" /></st_kv_database_conf>");
+    CuAssertIntEquals(testCase, 0, stList_length(confs));
+    stList_destruct(confs);
+}
+
+static uint64_t splitmix64(uint64_t h) {
+    h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    h = (h ^ (h >> 27)) * 0x94d049bb133111ebULL;
+    return h ^ (h >> 31);
+}
+
+static stList *getShardedDiskConfs(void) {
+    int64_t i = system("rm -rf temporaryCactusDisk temporaryCactusDiskShard");
+    exitOnFailure(i, "Tried to delete the temporary KV databases\n");
+    stList *confs = stList_construct3(0, (void (*)(void *)) stKVDatabaseConf_destruct);
+    stList_append(confs, stKVDatabaseConf_constructTokyoCabinet("temporaryCactusDisk"));
+    stList_append(confs, stKVDatabaseConf_constructTokyoCabinet("temporaryCactusDiskShard"));
+    return confs;
+}
+
+void testCactusDisk_shards(CuTest* testCase) {
+    stList *confs = getShardedDiskConfs();
+    CactusDisk *shardedDisk = cactusDisk_construct3(confs, true, false);
+
+    //Each key goes to the shard picked by the splitmix64 finaliser of the key, spreading consecutive keys
+    int64_t shardSizes[2] = { 0, 0 };
+    for (int64_t key = 0; key < 1000; key++) {
+        int64_t shardIndex = cactusDisk_getShardIndex(shardedDisk, key);
+        CuAssertIntEquals(testCase, splitmix64(key) % 2, shardIndex);
+        shardSizes[shardIndex]++;
+    }
+    CuAssertTrue(testCase, shardSizes[0] > 400);
+    CuAssertTrue(testCase, shardSizes[1] > 400);
+
+    //The chunks of a string are stored in the shards of their keys, and no other
+    int64_t chunks = 10;
+    char *string = stRandom_getRandomDNAString(chunks * 500, true, true, true);
+    Name name = cactusDisk_addString(shardedDisk, string);
+    for (int64_t i = 0; i < chunks; i++) {
+        int64_t shardIndex = cactusDisk_getShardIndex(shardedDisk, name + i);
+        CuAssertTrue(testCase, stKVDatabase_containsRecord(stList_get(shardedDisk->databases, shardIndex), name + i));
+        CuAssertTrue(testCase, !stKVDatabase_containsRecord(stList_get(shardedDisk->databases, 1 - shardIndex), name + i));
+    }
+
+    //A bulk get returns the records in the order of the keys, whichever shards they come from
+    stList *keys = stList_construct3(0, free);
+    for (int64_t i = chunks - 1; i >= 0; i--) {
+        int64_t *key = st_malloc(sizeof(int64_t));
+        *key = name + i;
+        stList_append(keys, key);
+    }
+    stList *records = cactusDisk_bulkGetRecords(shardedDisk, keys);
+    CuAssertIntEquals(testCase, chunks, stList_length(records));
+    for (int64_t i = 0; i < chunks; i++) {
+        int64_t recordSize;
+        char *record = stKVDatabaseBulkResult_getRecord(stList_get(records, i), &recordSize);
+        char *chunk = stString_getSubString(string, (chunks - 1 - i) * 500, 500);
+        CuAssertIntEquals(testCase, 501, recordSize);
+        CuAssertStrEquals(testCase, chunk, record);
+        free(chunk);
+    }
+    stList_destruct(records);
+    stList_destruct(keys);
+    free(string);
+
+    //The disk can be opened again, its parameters being found in their shard
+    cactusDisk_write(shardedDisk);
+    cactusDisk_destruct(shardedDisk);
+    shardedDisk = cactusDisk_construct3(confs, false, false);
+    CuAssertTrue(testCase, stKVDatabase_containsRecord(stList_get(shardedDisk->databases,
+            cactusDisk_getShardIndex(shardedDisk, name)), name));
+    cactusDisk_destruct(shardedDisk);
+
+    stList_destruct(confs);
+    int64_t i = system("rm -rf temporaryCactusDisk temporaryCactusDiskShard");
+    exitOnFailure(i, "Tried to delete the temporary KV databases\n");
+}
+
 CuSuite* cactusDiskTestSuite(void) {
     CuSuite* suite = CuSuiteNew();
     SUITE_ADD_TEST(suite, testCactusDisk_write);
@@ -143,5 +235,7 @@ CuSuite* cactusDiskTestSuite(void) {
     SUITE_ADD_TEST(suite, testCactusDisk_getUniqueID_Unique);
     SUITE_ADD_TEST(suite, testCactusDisk_getUniqueID_UniqueIntervals);
     SUITE_ADD_TEST(suite, testCactusDisk_constructAndDestruct);
+    SUITE_ADD_TEST(suite, testCactusDisk_getShardConfs);
+    SUITE_ADD_TEST(suite, testCactusDisk_shards);
     return suite;
 }
@@ -98,9 +98,42 @@ static void testFlowerWriter(CuTest *testCase) {
     stFile_rmrf(tempFile);
 }
 
+static void checkParsedNames(CuTest *testCase, const char *tempFile, int64_t *expected, int64_t expectedLength) {
+    FILE *fileHandle = fopen(tempFile, "r");
+    stList *names = flowerWriter_parseNames(fileHandle);
+    fclose(fileHandle);
+    CuAssertIntEquals(testCase, expectedLength, stList_length(names));
+    for (int64_t i = 0; i < expectedLength; i++) {
+        CuAssertIntEquals(testCase, expected[i], *((Name *) stList_get(names, i)));
+    }
+    stList_destruct(names);
+}
+
+static void testParseNames(CuTest *testCase) {
+    char *tempFile = "./flowerWriterParseTest.txt";
+    int64_t expected[] = { 9, 10, 11, 8, 12, 13, 20, 28 };
+
+    // Text form
+    FILE *fileHandle = fopen(tempFile, "w");
+    fprintf(fileHandle, "8 9 1 1 a -3 4 b 1 7 8");
+    fclose(fileHandle);
+    checkParsedNames(testCase, tempFile, expected, 8);
+
+    // The same names in the binary form
+    const unsigned char binary[] = { 0xca, 0x08, 0x02, 0x06, 0x05, 0x12, 0x02, 0x02,
+                                     0x05, 0x08, 0x02, 0x0e, 0x10 };
+    fileHandle = fopen(tempFile, "wb");
+    fwrite(binary, 1, sizeof(binary), fileHandle);
+    fclose(fileHandle);
+    checkParsedNames(testCase, tempFile, expected, 8);
+
+    stFile_rmrf(tempFile);
+}
+
 CuSuite* cactusFlowerWriterTestSuite(void) {
     CuSuite* suite = CuSuiteNew();
     SUITE_ADD_TEST(suite, testFlowerStream);
     SUITE_ADD_TEST(suite, testFlowerWriter);
+    SUITE_ADD_TEST(suite, testParseNames);
     return suite;
 }
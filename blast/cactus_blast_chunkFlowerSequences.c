@@ -30,7 +30,7 @@ int main(int argc, char *argv[]) {
 	assert(argc == 7);
 	st_setLogLevelFromString(argv[1]);
 	stKVDatabaseConf *kvDatabaseConf = stKVDatabaseConf_constructFromString(argv[2]);
-	cactusDisk = cactusDisk_construct(kvDatabaseConf, false, true);
+	cactusDisk = cactusDisk_construct2(kvDatabaseConf, argv[2], false, true);
 	st_logInfo("Set up the flower disk\n");
 	flower = cactusDisk_getFlower(cactusDisk, cactusMisc_stringToName(argv[3]));
 	assert(flower != NULL);
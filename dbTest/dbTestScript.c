@@ -6,11 +6,12 @@
 #include <time.h>
 #include <getopt.h>
 #include <unistd.h>
+#include <sys/time.h>
 
 #include "sonLib.h"
 
 void usage() {
-    fprintf(stderr, "dpTestScript, version 0.1\n");
+    fprintf(stderr, "dpTestScript, version 0.2\n");
     fprintf(stderr, "-a --logLevel : Set the log level\n");
     fprintf(stderr, "-b --databaseConf : The database connection script\n");
     fprintf(stderr, "-c --firstKey : First key.\n");
@@ -18,12 +19,21 @@ void usage() {
     fprintf(stderr, "-e --addRecords : Add records instead of getting them.\n");
     fprintf(stderr, "-f --setRecords : After adding/getting records, set the records.\n");
     fprintf(stderr, "-g --minRecordSize : Min size of record.\n");
-    fprintf(stderr, "-h --maxRecordSize : Min size of record.\n");
+    fprintf(stderr, "-h --maxRecordSize : Max size of record.\n");
     fprintf(stderr, "-i --create : Make the database.\n");
+    fprintf(stderr, "-j --batchSize : Number of records per bulk request (default: all of them).\n");
+    fprintf(stderr, "-k --shuffle : Get and set the records in a random order.\n");
+    fprintf(stderr, "-l --reportLatencies : Print the operation, latency (s), records and bytes of each bulk request.\n");
 }
 
-void *getRandomRecord(int64_t minRecordSize, int64_t maxRecordSize, int64_t *recordSize) {
-    *recordSize = maxRecordSize;
+static double getTime() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+static void *getRandomRecord(int64_t minRecordSize, int64_t maxRecordSize, int64_t *recordSize) {
+    *recordSize = minRecordSize < maxRecordSize ? st_randomInt64(minRecordSize, maxRecordSize + 1) : maxRecordSize;
     char *cA = st_malloc(sizeof(char) * (*recordSize));
     for (int64_t i = 0; i < *recordSize; i++) {
         cA[i] = st_randomInt(0, 128);
@@ -31,9 +41,75 @@ void *getRandomRecord(int64_t minRecordSize, int64_t maxRecordSize, int64_t *rec
     return cA;
 }
 
+static void reportLatency(bool report, const char *operation, double start, int64_t records, int64_t bytes) {
+    if (report) {
+        fprintf(stdout, "%s\t%f\t%" PRIi64 "\t%" PRIi64 "\n", operation, getTime() - start, records, bytes);
+    }
+}
+
+static void setRecordBatch(stKVDatabase *database, int64_t *keys, int64_t keyNumber, bool insert,
+        int64_t minRecordSize, int64_t maxRecordSize, bool report) {
+    stList *requests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    int64_t bytes = 0;
+    for (int64_t i = 0; i < keyNumber; i++) {
+        int64_t recordSize;
+        void *vA = getRandomRecord(minRecordSize, maxRecordSize, &recordSize);
+        stList_append(requests, insert ? stKVDatabaseBulkRequest_constructInsertRequest(keys[i], vA, recordSize)
+                : stKVDatabaseBulkRequest_constructUpdateRequest(keys[i], vA, recordSize));
+        bytes += recordSize;
+        free(vA);
+    }
+    double start = getTime();
+    stTry {
+        stKVDatabase_bulkSetRecords(database, requests);
+    }
+    stCatch(except)
+    {
+        stThrowNewCause(
+                except,
+                ST_KV_DATABASE_EXCEPTION_ID,
+                "An unknown database error occurred when doing a bulk set");
+    }
+    stTryEnd;
+    reportLatency(report, insert ? "add" : "set", start, keyNumber, bytes);
+    stList_destruct(requests);
+}
+
+static void getRecordBatch(stKVDatabase *database, int64_t *keys, int64_t keyNumber, bool report) {
+    stList *recordNames = stList_construct3(0, free);
+    for (int64_t i = 0; i < keyNumber; i++) {
+        int64_t *iA = st_malloc(sizeof(int64_t));
+        iA[0] = keys[i];
+        stList_append(recordNames, iA);
+    }
+    double start = getTime();
+    stTry {
+        stList *list = stKVDatabase_bulkGetRecords(database, recordNames);
+        assert(stList_length(list) == keyNumber);
+        int64_t bytes = 0;
+        for (int64_t i = 0; i < stList_length(list); i++) {
+            int64_t recordSize;
+            stKVDatabaseBulkResult_getRecord(stList_get(list, i), &recordSize);
+            bytes += recordSize;
+        }
+        reportLatency(report, "get", start, keyNumber, bytes);
+        stList_destruct(list);
+    }
+    stCatch(except)
+    {
+        stThrowNewCause(
+                except,
+                ST_KV_DATABASE_EXCEPTION_ID,
+                "An unknown database error occurred when doing a bulk get");
+    }
+    stTryEnd;
+    stList_destruct(recordNames);
+}
+
 int main(int argc, char *argv[]) {
     /*
-     * Script for adding a reference genome to a flower.
+     * Script for loading a database with random records, as a
+     * client of a database benchmark (see dbTestScript.py).
      */
 
     /*
@@ -43,19 +119,21 @@ int main(int argc, char *argv[]) {
     char * databaseString = NULL;
     int64_t firstKey = INT64_MIN;
     int64_t keyNumber = INT64_MIN;
-    bool addRecords = 0, setRecords = 0, create = 0;
+    bool addRecords = 0, setRecords = 0, create = 0, shuffle = 0, report = 0;
     int64_t minRecordSize = 0, maxRecordSize = 100000000;
+    int64_t batchSize = INT64_MAX;
     int64_t i;
 
     while (1) {
         static struct option long_options[] = { { "logLevel", required_argument, 0, 'a' }, { "databaseConf", required_argument, 0, 'b' }, {
                 "firstKey", required_argument, 0, 'c' }, { "keyNumber", required_argument, 0, 'd' }, { "addRecords", no_argument, 0, 'e' },
                 { "setRecords", no_argument, 0, 'f' }, { "minRecordSize", required_argument, 0, 'g' }, { "maxRecordSize",
-                        required_argument, 0, 'h' }, { "maxRecordSize", no_argument, 0, 'i' }, { 0, 0, 0, 0 } };
+                        required_argument, 0, 'h' }, { "create", no_argument, 0, 'i' }, { "batchSize", required_argument, 0, 'j' },
+                { "shuffle", no_argument, 0, 'k' }, { "reportLatencies", no_argument, 0, 'l' }, { 0, 0, 0, 0 } };
 
         int option_index = 0;
 
-        int key = getopt_long(argc, argv, "a:b:c:d:efg:h:i", long_options, &option_index);
+        int key = getopt_long(argc, argv, "a:b:c:d:efg:h:ij:kl", long_options, &option_index);
 
         if (key == -1) {
             break;
@@ -100,6 +178,19 @@ int main(int argc, char *argv[]) {
                 break;
             case 'i':
                 create = 1;
+                break;
+            case 'j':
+                i = sscanf(optarg, "%" PRIi64 "", &batchSize);
+                if (i != 1 || batchSize <= 0) {
+                    st_errAbort("Did not parse a valid batchSize: %s", optarg);
+                }
+                break;
+            case 'k':
+                shuffle = 1;
+                break;
+            case 'l':
+                report = 1;
+                break;
             default:
                 usage();
                 return 1;
@@ -142,73 +233,35 @@ int main(int argc, char *argv[]) {
 
     st_logInfo("Modifying records to the database in the range %" PRIi64 " to %" PRIi64 "\n", firstKey, firstKey+keyNumber);
 
-    if (addRecords) {
-        st_logInfo("Adding records to the database\n");
-        stList *recordNames = stList_construct3(0, free);
-        for (int64_t i = 0; i < keyNumber; i++) {
-            int64_t recordSize;
-            void *vA = getRandomRecord(minRecordSize, maxRecordSize, &recordSize);
-            stList_append(recordNames, stKVDatabaseBulkRequest_constructInsertRequest(firstKey + i, vA, recordSize));
-        } stTry {
-            stKVDatabase_bulkSetRecords(database, recordNames);
-        }
-        stCatch(except)
-        {
-            stThrowNewCause(
-                    except,
-                    ST_KV_DATABASE_EXCEPTION_ID,
-                    "An unknown database error occurred when getting a bulk add");
-        }
-        stTryEnd;
-        stList_destruct(recordNames);
-    } else {
-        st_logInfo("Getting records from the database\n");
-        stList *recordNames = stList_construct3(0, free);
-        for (int64_t i = 0; i < keyNumber; i++) {
-            int64_t *iA = st_malloc(sizeof(int64_t));
-            iA[0] = firstKey + i;
-            stList_append(recordNames, iA);
-            //Do it again
-            //iA = st_malloc(sizeof(int64_t));
-            //iA[0] = firstKey + i;
-            //stList_append(recordNames, iA);
-        } stTry {
-            stList *list = stKVDatabase_bulkGetRecords(database, recordNames);
-            assert(stList_length(list) == keyNumber);
-            //assert(stList_length(list) == keyNumber * 2);
-            stList_destruct(list);
-        }
-        stCatch(except)
-        {
-            stThrowNewCause(
-                    except,
-                    ST_KV_DATABASE_EXCEPTION_ID,
-                    "An unknown database error occurred when getting a bulk set");
+    int64_t *keys = st_malloc(sizeof(int64_t) * (keyNumber > 0 ? keyNumber : 1));
+    for (int64_t j = 0; j < keyNumber; j++) {
+        keys[j] = firstKey + j;
+    }
+    if (shuffle) {
+        //Fisher-Yates, so the reads and writes hit the keys in a scattered order
+        for (int64_t j = keyNumber - 1; j > 0; j--) {
+            int64_t k = st_randomInt64(0, j + 1);
+            int64_t key = keys[j];
+            keys[j] = keys[k];
+            keys[k] = key;
         }
-        stTryEnd;
-        stList_destruct(recordNames);
     }
 
-    if (setRecords) {
-        st_logInfo("Setting records in the database\n");
-        stList *recordNames = stList_construct3(0, free);
-        for (int64_t i = 0; i < keyNumber; i++) {
-            int64_t recordSize;
-            void *vA = getRandomRecord(minRecordSize, maxRecordSize, &recordSize);
-            stList_append(recordNames, stKVDatabaseBulkRequest_constructUpdateRequest(firstKey + i, vA, recordSize));
-        } stTry {
-            stKVDatabase_bulkSetRecords(database, recordNames);
+    for (int64_t j = 0; j < keyNumber; j += batchSize) {
+        int64_t batchKeyNumber = keyNumber - j < batchSize ? keyNumber - j : batchSize;
+        if (addRecords) {
+            st_logDebug("Adding records to the database\n");
+            setRecordBatch(database, keys + j, batchKeyNumber, 1, minRecordSize, maxRecordSize, report);
+        } else {
+            st_logDebug("Getting records from the database\n");
+            getRecordBatch(database, keys + j, batchKeyNumber, report);
         }
-        stCatch(except)
-        {
-            stThrowNewCause(
-                    except,
-                    ST_KV_DATABASE_EXCEPTION_ID,
-                    "An unknown database error occurred when getting a bulk add");
+        if (setRecords) {
+            st_logDebug("Setting records in the database\n");
+            setRecordBatch(database, keys + j, batchKeyNumber, 0, minRecordSize, maxRecordSize, report);
         }
-        stTryEnd;
-        stList_destruct(recordNames);
     }
+    free(keys);
 
     st_logDebug("Finished!\n");
 
@@ -217,4 +270,6 @@ int main(int argc, char *argv[]) {
     ///////////////////////////////////////////////////////////////////////////
 
     stKVDatabase_destruct(database);
+    stKVDatabaseConf_destruct(kvDatabaseConf);
+    return 0;
 }
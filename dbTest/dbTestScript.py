@@ -1,95 +1,218 @@
 #!/usr/bin/env python
+"""Load generator for the cactus disk, to tune the KV database.
 
-"""Script to generate a series of random
+Replays the access patterns of the pipeline against a fresh database,
+using a pool of concurrent dbTestScript clients, each of which holds one
+connection and pipelines its requests in bulk batches:
+
+  setup      -- bulk inserts of fixed-size sequence records at
+                consecutive keys, as cactus_setup writes them
+  getFlowers -- bulk gets of variable-size flower records in a random
+                order, as the getFlowers calls of the child jobs do
+  bar        -- bulk gets followed by bulk sets of the same flowers in a
+                random order, as cactus_barsAligner does
+
+Each workload is run for every combination of backend, tuning string
+(the "#bnum=..#msiz=.." options from getKtTuningOptions), ktserver
+thread count (-th) and number of clients, against a new database each
+time. The throughput of each workload and percentiles of the latency
+of its bulk requests are reported, and optionally written as JSON.
+
+Needs dbTestScript (built in dbTest/) and ktserver on the PATH.
 """
+import os
+import re
+import json
+import math
+import time
+import shutil
+import subprocess
+from argparse import ArgumentParser
+
+from sonLib.bioio import getTempDirectory
+from cactus.pipeline.ktserverControl import getKtTuningOptions, getKtServerOptions
+from cactus.pipeline.embeddedDbBenchmark import makeDbElem, startKtserver, stopKtserver
+
+WORKLOADS = ("setup", "getFlowers", "bar")
+
+BACKENDS = ("kyoto_tycoon", "tokyo_cabinet")
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+def getWorkloadArguments(workload, options):
+    """Get the dbTestScript arguments that replay a workload."""
+    if workload == "setup":
+        return ["--addRecords",
+                "--minRecordSize", str(options.sequenceRecordSize),
+                "--maxRecordSize", str(options.sequenceRecordSize),
+                "--batchSize", str(options.setupBatchSize)]
+    arguments = ["--shuffle",
+                 "--minRecordSize", str(options.minFlowerSize),
+                 "--maxRecordSize", str(options.maxFlowerSize),
+                 "--batchSize", str(options.flowerBatchSize)]
+    if workload == "bar":
+        arguments.append("--setRecords")
+    return arguments
+
+def setServerThreads(serverOptions, threads):
+    """Replace the -th option of a ktserver command line."""
+    serverOptions = re.sub(r"-th\s+\d+", "", serverOptions)
+    return " ".join(serverOptions.split() + ["-th", str(threads)])
+
+def percentile(sortedValues, fraction):
+    """Nearest-rank percentile of a sorted list.
 
-from optparse import OptionParser
-from jobTree.scriptTree.target import Target 
-from jobTree.scriptTree.stack import Stack
-from sonLib.bioio import system, spawnDaemon, setLoggingFromOptions, logger, getLogLevelString
-from jobTree.src.common import runJobTreeStatusAndFailIfNotComplete
-
-def getDatabaseConf(options):
-    return "<st_kv_database_conf type=\"kyoto_tycoon\"><kyoto_tycoon host=\"%s\" port=\"%s\" database_dir=\"%s\"/></<st_kv_database_conf>" % \
-        (options.host, options.port, options.databaseDir)
-
-def runDbTestScript(options, firstKey=0, keyNumber=0, addRecords=False, setRecords=False):
-    def fn(stringId, bool):
-        if bool:
-            return stringId
-        return ""
-    addRecords = fn("--addRecords", addRecords)
-    setRecords = fn("--setRecords", setRecords)
-    command = "dbTestScript --databaseConf '%s' --firstKey %s --keyNumber %s %s %s --minRecordSize %s --maxRecordSize %s --logLevel %s" %\
-    (getDatabaseConf(options), firstKey, keyNumber, addRecords, setRecords, options.minRecordSize, options.maxRecordSize, getLogLevelString())
-    system(command)
-
-class AddKeysPhase(Target):
-    def __init__(self, options):
-        Target.__init__(self)
-        self.options = options
-    
-    def run(self):
-        keyIndex = 0
-        for jobIndex in xrange(int(self.options.totalJobs)):
-            self.addChildTarget(AddKeys(self.options, keyIndex))
-            keyIndex += int(self.options.keysPerJob)
-        self.setFollowOnTarget(SetKeysPhase(self.options))
-    
-class AddKeys(Target):
-    def __init__(self, options, firstKey):
-        Target.__init__(self)
-        self.options = options
-        self.firstKey = firstKey
-        
-    def run(self):
-        runDbTestScript(self.options, self.firstKey, self.options.keysPerJob, addRecords=True)
-
-class SetKeysPhase(AddKeysPhase):
-    def run(self):
-        keyIndex = 0
-        for jobIndex in xrange(int(self.options.totalJobs)):
-            self.addChildTarget(SetKeys(self.options, keyIndex))
-            keyIndex += int(self.options.keysPerJob)
-
-class SetKeys(AddKeys):
-    def run(self):
-        runDbTestScript(self.options, self.firstKey, self.options.keysPerJob, setRecords=True)
+    >>> percentile([1, 2, 3, 4], 0.5)
+    2
+    >>> percentile([1, 2, 3, 4], 0.99)
+    4
+    """
+    if len(sortedValues) == 0:
+        return 0.0
+    rank = max(0, min(len(sortedValues) - 1, int(math.ceil(fraction * len(sortedValues))) - 1))
+    return sortedValues[rank]
+
+def parseLatencies(latencyFile):
+    """Parse the per-request lines printed by dbTestScript --reportLatencies into
+    a map from operation to a list of (seconds, records, bytes) tuples."""
+    latencies = {}
+    with open(latencyFile) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) != 4:
+                continue
+            latencies.setdefault(tokens[0], []).append((float(tokens[1]), int(tokens[2]), int(tokens[3])))
+    return latencies
+
+def runClients(dbElem, workload, clients, options, workDir):
+    """Run a workload on a number of concurrent clients, each with its own
+    range of keys. Returns the wall-clock time taken and the merged latencies."""
+    processes = []
+    start = time.time()
+    for client in xrange(clients):
+        latencyFile = os.path.join(workDir, "%s_%i.txt" % (workload, client))
+        command = ["dbTestScript", "--databaseConf", dbElem.getConfString(),
+                   "--firstKey", str(client * options.keysPerClient),
+                   "--keyNumber", str(options.keysPerClient),
+                   "--reportLatencies"] + getWorkloadArguments(workload, options)
+        with open(latencyFile, 'w') as f:
+            processes.append((subprocess.Popen(command, stdout=f), latencyFile))
+    latencies = {}
+    for process, latencyFile in processes:
+        if process.wait() != 0:
+            raise RuntimeError("dbTestScript failed with exit code %i" % process.returncode)
+    wallTime = time.time() - start
+    for process, latencyFile in processes:
+        for operation, requests in parseLatencies(latencyFile).items():
+            latencies.setdefault(operation, []).extend(requests)
+    return wallTime, latencies
+
+def summarise(wallTime, latencies):
+    """Get the throughput and latency percentiles of each operation of a workload."""
+    summary = {}
+    for operation, requests in latencies.items():
+        records = sum(request[1] for request in requests)
+        bytes = sum(request[2] for request in requests)
+        sortedLatencies = sorted(request[0] for request in requests)
+        summary[operation] = {"requests": len(requests),
+                              "recordsPerSecond": records / wallTime if wallTime > 0 else 0.0,
+                              "mbPerSecond": bytes / wallTime / 1000000.0 if wallTime > 0 else 0.0,
+                              "latencyPercentiles": dict(("p%i" % int(fraction * 100),
+                                                          percentile(sortedLatencies, fraction))
+                                                         for fraction in PERCENTILES)}
+    return summary
+
+def runWorkloads(dbElem, clients, options, workDir):
+    return dict((workload, summarise(*runClients(dbElem, workload, clients, options, workDir)))
+                for workload in WORKLOADS)
+
+def benchmarkKtserver(tuning, threads, clients, options, workDir):
+    dbElem = makeDbElem("kyoto_tycoon")
+    dbElem.setDbHost("localhost")
+    dbElem.setDbPort(options.port)
+    dbElem.setDbTuningOptions(tuning)
+    dbElem.setDbServerOptions(setServerThreads(getKtServerOptions(dbElem), threads))
+    snapshotDir = os.path.join(workDir, "snapshot")
+    os.mkdir(snapshotDir)
+    logPath = os.path.join(workDir, "ktserver.log")
+    process = startKtserver(dbElem, logPath, snapshotDir)
+    try:
+        return runWorkloads(dbElem, clients, options, workDir)
+    finally:
+        stopKtserver(process, logPath)
+
+def benchmarkEmbedded(clients, options, workDir):
+    dbElem = makeDbElem("tokyo_cabinet")
+    dbElem.setDbDir(os.path.join(workDir, "db"))
+    if subprocess.call(["dbTestScript", "--databaseConf", dbElem.getConfString(),
+                        "--firstKey", "0", "--keyNumber", "0", "--create"]) != 0:
+        raise RuntimeError("dbTestScript failed to create the database")
+    return runWorkloads(dbElem, clients, options, workDir)
+
+def getConfigurations(options):
+    """Get the (backend, tuning, threads, clients) combinations to benchmark."""
+    for backend in options.backends:
+        for clients in options.clients:
+            if backend == "kyoto_tycoon":
+                for tuning in options.tunings:
+                    for threads in options.serverThreads:
+                        yield backend, tuning, threads, clients
+            else:
+                yield backend, None, None, clients
 
 def main():
-    ##########################################
-    #Construct the arguments.
-    ##########################################
-
-    parser = OptionParser()
-    
-    parser.add_option("--host", dest="host")
-    parser.add_option("--port", dest="port")
-    parser.add_option("--databaseDir", dest="databaseDir")
-    parser.add_option("--databaseOptions", dest="databaseOptions")
-    parser.add_option("--keysPerJob", dest="keysPerJob")
-    parser.add_option("--totalJobs", dest="totalJobs")
-    parser.add_option("--minRecordSize", dest="minRecordSize")
-    parser.add_option("--maxRecordSize", dest="maxRecordSize")
-    parser.add_option("--test", dest="test", action="store_true",
-                      help="Run doctest unit tests")
-    
-    Stack.addJobTreeOptions(parser)
-
-    options, args = parser.parse_args()
-    if options.test:
-        _test()
-    setLoggingFromOptions(options)
-
-    if len(args) != 0:
-        raise RuntimeError("Unrecognised input arguments: %s" % " ".join(args))
-    
-    Stack(AddKeysPhase(options)).startJobTree(options)
-
-def _test():
-    import doctest      
-    return doctest.testmod()
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=["kyoto_tycoon"])
+    parser.add_argument("--tunings", nargs="+", default=[getKtTuningOptions(makeDbElem("kyoto_tycoon"))],
+                        help="ktserver tuning strings to compare, e.g. '#opts=ls#bnum=30m#msiz=50g#ktopts=p'")
+    parser.add_argument("--serverThreads", nargs="+", type=int, default=[64],
+                        help="ktserver worker thread counts (-th) to compare")
+    parser.add_argument("--clients", nargs="+", type=int, default=[8],
+                        help="Numbers of concurrent clients (connections) to compare")
+    parser.add_argument("--keysPerClient", type=int, default=10000)
+    parser.add_argument("--sequenceRecordSize", type=int, default=1000,
+                        help="Size of the records written by the setup workload")
+    parser.add_argument("--minFlowerSize", type=int, default=100)
+    parser.add_argument("--maxFlowerSize", type=int, default=100000)
+    parser.add_argument("--setupBatchSize", type=int, default=1000,
+                        help="Records per bulk request in the setup workload")
+    parser.add_argument("--flowerBatchSize", type=int, default=100,
+                        help="Records per bulk request in the getFlowers and bar workloads")
+    parser.add_argument("--port", type=int, default=1978,
+                        help="Port to run the ktserver on")
+    parser.add_argument("--workDir", default=None,
+                        help="Directory to keep the DBs in (ideally on local SSD)")
+    parser.add_argument("--outputFile", default=None,
+                        help="Write the results to this file as JSON")
+    options = parser.parse_args()
+
+    results = []
+    print "%-14s %-40s %4s %4s %-10s %-4s %12s %9s %9s %9s %9s" % ("backend", "tuning", "-th", "clnt",
+                                                                 "workload", "op", "records/s", "MB/s",
+                                                                 "p50 (ms)", "p90 (ms)", "p99 (ms)")
+    for backend, tuning, threads, clients in getConfigurations(options):
+        workDir = getTempDirectory(rootDir=options.workDir)
+        try:
+            if backend == "kyoto_tycoon":
+                summary = benchmarkKtserver(tuning, threads, clients, options, workDir)
+            else:
+                summary = benchmarkEmbedded(clients, options, workDir)
+        finally:
+            shutil.rmtree(workDir)
+        results.append({"backend": backend, "tuning": tuning, "serverThreads": threads,
+                        "clients": clients, "workloads": summary})
+        for workload in WORKLOADS:
+            for operation in sorted(summary[workload].keys()):
+                stats = summary[workload][operation]
+                percentiles = stats["latencyPercentiles"]
+                print "%-14s %-40s %4s %4i %-10s %-4s %12.0f %9.2f %9.2f %9.2f %9.2f" % \
+                    (backend, tuning or "-", threads or "-", clients, workload, operation,
+                     stats["recordsPerSecond"], stats["mbPerSecond"],
+                     percentiles["p50"] * 1000, percentiles["p90"] * 1000, percentiles["p99"] * 1000)
+
+    if options.outputFile is not None:
+        with open(options.outputFile, 'w') as f:
+            json.dump(results, f, indent=2)
 
 if __name__ == '__main__':
-    from cactus.dbTest.dbTestScript import *
     main()
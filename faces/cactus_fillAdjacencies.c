@@ -1138,7 +1138,7 @@ int main(int argc, char ** argv) {
     //////////////////////////////////////////////
 
     stKVDatabaseConf *kvDatabaseConf = stKVDatabaseConf_constructFromString(cactusDiskDatabaseString);
-    cactusDisk = cactusDisk_construct(kvDatabaseConf, false, true);
+    cactusDisk = cactusDisk_construct2(kvDatabaseConf, cactusDiskDatabaseString, false, true);
     st_logInfo("Set up the flower disk\n");
 
     //////////////////////////////////////////////
@@ -279,9 +279,9 @@ int main(int argc, char *argv[]) {
     if (stKVDatabaseConf_getType(kvDatabaseConf) == stKVDatabaseTypeTokyoCabinet || stKVDatabaseConf_getType(kvDatabaseConf)
             == stKVDatabaseTypeKyotoTycoon) {
         assert(stKVDatabaseConf_getDir(kvDatabaseConf) != NULL);
-        cactusDisk = cactusDisk_construct(kvDatabaseConf, true, true);
+        cactusDisk = cactusDisk_construct2(kvDatabaseConf, cactusDiskDatabaseString, true, true);
     } else {
-        cactusDisk = cactusDisk_construct(kvDatabaseConf, true, true);
+        cactusDisk = cactusDisk_construct2(kvDatabaseConf, cactusDiskDatabaseString, true, true);
     }
     st_logInfo("Set up the flower disk\n");
 
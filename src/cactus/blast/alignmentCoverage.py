@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""In-process calculation of the coverage of a set of alignments on the
+sequences of a FASTA file, giving the same results as cactus_coverage.
+
+The aligned blocks are collected as intervals, and the coverage is only
+computed, by sweeping over the interval ends, when it is asked for, so
+the memory used is proportional to the number of alignments rather than
+to the length of the sequences. The coverage of each sequence is kept as
+runs of constant depth, in columns of starts, ends and depths (NumPy
+arrays, if NumPy is installed), which can be saved in a compact binary
+format and added to again later:
+
+  magic
+  for each sequence with coverage: the name as length (I) and bytes,
+  the number of runs (Q), then their starts (q each), ends (q each) and
+  depths (H each)
+"""
+from collections import defaultdict
+import array
+import struct
+
+from cactus.shared.fasta import FastaFile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Depth at which the coverage of a position stops increasing, as in
+# cactus_coverage, which keeps it in 16 bits
+MAX_COVERAGE_DEPTH = 65535
+
+COVERAGE_MAGIC = "CACTUSCV"
+
+# Memory used per aligned block while the coverage is computed (with
+# NumPy): 16 bytes for its start and end as they are collected, 32 for
+# its depth and the concatenated columns in getRuns, then 16 bytes (two
+# ends) for each of the positions, deltas, sort order, sorted positions,
+# sorted deltas and running depths in getCoverageRuns, and a little for
+# its masks and runs.
+COVERAGE_BYTES_PER_BLOCK = 160
+
+# Each block on a sequence is a match operation, kept from the next by
+# a gap operation. Those take at least 8 bytes of a cigar line
+# ("M 1 I 1 "), or 10 of a binary alignment file, so there is at most
+# one block for every 8 bytes of alignments.
+MIN_ALIGNMENT_BYTES_PER_BLOCK = 8
+
+def estimateCoverageMemory(alignmentsSize):
+    """Get the most memory computing the coverage of a set of
+    alignments, alignmentsSize bytes of cigar or binary alignment file,
+    on one of their sequences can take."""
+    return COVERAGE_BYTES_PER_BLOCK * alignmentsSize // MIN_ALIGNMENT_BYTES_PER_BLOCK
+
+def toColumn(values):
+    """Get a list of integers as a column, a NumPy array or an array."""
+    if numpy is not None:
+        return numpy.asarray(values, dtype=numpy.int64)
+    return array.array('l', values)
+
+def concatenateColumns(columns):
+    if numpy is not None:
+        if len(columns) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate([numpy.asarray(column, dtype=numpy.int64) for column in columns])
+    ret = array.array('l')
+    for column in columns:
+        ret.extend(column)
+    return ret
+
+def getCoverageRuns(starts, ends, weights=None):
+    """Get the runs of constant, non-zero depth covered by a set of
+    intervals (each of weight 1, unless weights are given), merging
+    adjacent runs of the same depth. Returns columns of the starts, ends
+    and depths of the runs, in order."""
+    if numpy is not None:
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        if weights is None:
+            weights = numpy.ones(len(starts), dtype=numpy.int64)
+        weights = numpy.asarray(weights, dtype=numpy.int64)
+        if len(starts) == 0:
+            return starts, ends, weights
+        positions = numpy.concatenate((starts, ends))
+        deltas = numpy.concatenate((weights, -weights))
+        order = numpy.argsort(positions, kind='mergesort')
+        positions = positions[order]
+        depths = numpy.cumsum(deltas[order])
+        # The depth following each distinct position is the one after its
+        # last change
+        isLast = numpy.ones(len(positions), dtype=bool)
+        isLast[:-1] = positions[1:] != positions[:-1]
+        positions = positions[isLast]
+        depths = numpy.minimum(depths[isLast], MAX_COVERAGE_DEPTH)
+        changed = numpy.empty(len(depths), dtype=bool)
+        changed[0] = depths[0] != 0
+        changed[1:] = depths[1:] != depths[:-1]
+        positions = positions[changed]
+        depths = depths[changed]
+        covered = depths[:-1] != 0
+        return positions[:-1][covered], positions[1:][covered], depths[:-1][covered]
+    if weights is None:
+        weights = [1] * len(starts)
+    deltas = defaultdict(int)
+    for start, end, weight in zip(starts, ends, weights):
+        deltas[start] += weight
+        deltas[end] -= weight
+    runStarts, runEnds, runDepths = array.array('l'), array.array('l'), array.array('l')
+    runStart = None
+    previousDepth = 0
+    depth = 0
+    for position in sorted(deltas.keys()):
+        depth += deltas[position]
+        cappedDepth = min(depth, MAX_COVERAGE_DEPTH)
+        if cappedDepth != previousDepth:
+            if previousDepth != 0:
+                runStarts.append(runStart)
+                runEnds.append(position)
+                runDepths.append(previousDepth)
+            runStart = position
+            previousDepth = cappedDepth
+    return runStarts, runEnds, runDepths
+
+def getMatchBlocks(fields, contigNum):
+    """Get the (start, end) blocks of sequence 1 or 2 of the split fields
+    of a cigar line that are aligned to the other sequence."""
+    contigField = 1 if contigNum == 1 else 5
+    position = int(fields[contigField + 1])
+    forward = fields[contigField + 3] == '+'
+    # 'I' only advances sequence 1 and 'D' only sequence 2, as read by
+    # sonLib's cigarRead
+    gapType = 'I' if contigNum == 1 else 'D'
+    blocks = []
+    for i in xrange(10, len(fields) - 1, 2):
+        operationType = fields[i]
+        length = int(fields[i + 1])
+        if operationType == 'M':
+            if forward:
+                blocks.append((position, position + length))
+                position += length
+            else:
+                blocks.append((position - length, position))
+                position -= length
+        elif operationType == gapType:
+            position += length if forward else -length
+    return blocks
+
+def packColumn(column, typecode):
+    if numpy is not None:
+        return numpy.asarray(column).astype("<" + {'q': 'i8', 'H': 'u2'}[typecode]).tostring()
+    return struct.pack("<%i%s" % (len(column), typecode), *column)
+
+def unpackColumn(data, offset, length, typecode):
+    if numpy is not None:
+        dtype = "<" + {'q': 'i8', 'H': 'u2'}[typecode]
+        return numpy.frombuffer(data, dtype=dtype, count=length, offset=offset).astype(numpy.int64)
+    return array.array('l', struct.unpack_from("<%i%s" % (length, typecode), data, offset))
+
+class AlignmentCoverage(object):
+    def __init__(self, sequenceLengths, depthById=False):
+        """Takes the (name, length) of each sequence to calculate coverage
+        on, in order. If depthById is set, the depth of a position is the
+        number of different 'id=N|' prefixes of the sequences aligned to
+        it rather than the number of alignments, as with cactus_coverage
+        --depthById."""
+        self.names = []
+        self.lengths = {}
+        for name, length in sequenceLengths:
+            if name in self.lengths:
+                raise RuntimeError("Duplicate sequence identifier %s found: make sure "
+                                   "the first tokens in the headers are unique" % name)
+            self.names.append(name)
+            self.lengths[name] = length
+        self.depthById = depthById
+        # (name, id) -> (starts, ends) of the aligned blocks, where id is
+        # None unless depthById is set
+        self.blocks = {}
+        # name -> [(starts, ends, depths)] of the runs of coverage added
+        # directly
+        self.baseRuns = defaultdict(list)
+        self.runs = None
+
+    def __contains__(self, name):
+        return name in self.lengths
+
+    def getTotalLength(self):
+        return sum(self.lengths.values())
+
+    def addBlocks(self, name, blocks, fromName):
+        if self.depthById:
+            sourceID = fromName.split('|')[0]
+            if not sourceID.startswith("id="):
+                raise RuntimeError("Using depthById, but header %s does not have "
+                                   "an 'id=N|' prefix" % fromName)
+        else:
+            sourceID = None
+        key = (name, sourceID)
+        if key not in self.blocks:
+            self.blocks[key] = (array.array('l'), array.array('l'))
+        starts, ends = self.blocks[key]
+        for start, end in blocks:
+            if start < 0 or end > self.lengths[name]:
+                raise RuntimeError("Alignment on %s:%d-%d is past chr end" % (name, start, end))
+            starts.append(start)
+            ends.append(end)
+        self.runs = None
+
+    def addAlignment(self, fields):
+        """Add the coverage of an alignment, given as the split fields of
+        its cigar line, on whichever of its sequences are being covered."""
+        if fields[1] in self.lengths:
+            self.addBlocks(fields[1], getMatchBlocks(fields, 1), fields[5])
+        if fields[5] in self.lengths:
+            self.addBlocks(fields[5], getMatchBlocks(fields, 2), fields[1])
+
+    def addRuns(self, name, starts, ends, depths):
+        """Add runs of coverage, such as those of an earlier calculation,
+        to a sequence, given as columns of their starts, ends and
+        depths."""
+        if name not in self.lengths:
+            raise RuntimeError("Coverage on %s, which is not one of the "
+                               "sequences being covered" % name)
+        self.baseRuns[name].append((starts, ends, depths))
+        self.runs = None
+
+    def addBed(self, bedFile):
+        """Add the coverage in a BED file written by writeBed or
+        cactus_coverage."""
+        runs = defaultdict(lambda: ([], [], []))
+        for line in bedFile:
+            fields = line.split('\t')
+            if len(fields) < 5:
+                continue
+            starts, ends, depths = runs[fields[0]]
+            starts.append(int(fields[1]))
+            ends.append(int(fields[2]))
+            depths.append(int(fields[4]))
+        for name, (starts, ends, depths) in runs.items():
+            self.addRuns(name, toColumn(starts), toColumn(ends), toColumn(depths))
+
+    def getRuns(self):
+        """Get a dict of name -> (starts, ends, depths) columns of the
+        sorted runs of non-zero coverage."""
+        if self.runs is not None:
+            return self.runs
+        intervals = defaultdict(list)
+        for (name, sourceID), (blockStarts, blockEnds) in self.blocks.items():
+            if self.depthById:
+                # Each id counts once towards the depth of a position
+                starts, ends, depths = getCoverageRuns(blockStarts, blockEnds)
+                intervals[name].append((starts, ends, toColumn([1] * len(starts))))
+            else:
+                intervals[name].append((blockStarts, blockEnds, toColumn([1] * len(blockStarts))))
+        for name, runs in self.baseRuns.items():
+            intervals[name].extend(runs)
+        self.runs = {}
+        for name, columns in intervals.items():
+            runs = getCoverageRuns(*[concatenateColumns([column[i] for column in columns])
+                                     for i in xrange(3)])
+            if len(runs[0]) > 0:
+                self.runs[name] = runs
+        return self.runs
+
+    def iterRuns(self, name):
+        """Iterate over the (start, end, depth) runs of a sequence."""
+        if name not in self.getRuns():
+            return iter([])
+        starts, ends, depths = self.getRuns()[name]
+        if numpy is not None:
+            return zip(starts.tolist(), ends.tolist(), depths.tolist())
+        return zip(starts, ends, depths)
+
+    def getBlocks(self, depth=1):
+        """Get a dict of name -> (start, end, depth) runs of at least the
+        given depth, as trimSequences reads them from a BED file."""
+        ret = defaultdict(list)
+        for name in self.getRuns():
+            runs = [run for run in self.iterRuns(name) if run[2] >= depth]
+            if len(runs) > 0:
+                ret[name] = runs
+        return ret
+
+    def getCoveredLength(self):
+        """Get the number of positions covered at least once."""
+        if numpy is not None:
+            return sum(int((ends - starts).sum()) for starts, ends, depths in self.getRuns().values())
+        return sum(end - start for starts, ends, depths in self.getRuns().values()
+                   for start, end in zip(starts, ends))
+
+    def getPercentCoverage(self):
+        """Get the % of the sequences that is covered, as percentCoverage
+        does from a BED file."""
+        totalLength = self.getTotalLength()
+        coveredLength = self.getCoveredLength()
+        if totalLength == 0 or coveredLength == 0:
+            return 0
+        return 100*float(coveredLength)/totalLength
+
+    def writeBed(self, outFile):
+        """Write the coverage in the BED format of cactus_coverage, in the
+        order of the sequences."""
+        for name in self.names:
+            for start, end, depth in self.iterRuns(name):
+                outFile.write("%s\t%d\t%d\t\t%d\n" % (name, start, end, depth))
+
+    def saveRuns(self, outFile):
+        """Write the coverage in the compact binary format, to be added to
+        another AlignmentCoverage of the same sequences with loadRuns."""
+        outFile.write(COVERAGE_MAGIC)
+        runs = self.getRuns()
+        for name in self.names:
+            if name not in runs:
+                continue
+            starts, ends, depths = runs[name]
+            outFile.write(struct.pack("<I", len(name)) + name + struct.pack("<Q", len(starts)))
+            outFile.write(packColumn(starts, 'q'))
+            outFile.write(packColumn(ends, 'q'))
+            outFile.write(packColumn(depths, 'H'))
+
+    def loadRuns(self, inFile):
+        """Add the coverage saved with saveRuns."""
+        data = inFile.read()
+        if data[:len(COVERAGE_MAGIC)] != COVERAGE_MAGIC:
+            raise RuntimeError("Not a saved coverage file")
+        offset = len(COVERAGE_MAGIC)
+        while offset < len(data):
+            nameLength, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            name = data[offset:offset + nameLength]
+            offset += nameLength
+            numRuns, = struct.unpack_from("<Q", data, offset)
+            offset += 8
+            starts = unpackColumn(data, offset, numRuns, 'q')
+            offset += 8 * numRuns
+            ends = unpackColumn(data, offset, numRuns, 'q')
+            offset += 8 * numRuns
+            depths = unpackColumn(data, offset, numRuns, 'H')
+            offset += 2 * numRuns
+            self.addRuns(name, starts, ends, depths)
+
+def getFastaCoverage(fastaPath, depthById=False):
+    """Get an empty AlignmentCoverage of the sequences of a FASTA file."""
+    with FastaFile(fastaPath) as fastaFile:
+        return AlignmentCoverage([(record.name, record.length) for record in fastaFile],
+                                 depthById=depthById)
@@ -0,0 +1,171 @@
+import os
+import random
+import unittest
+from StringIO import StringIO
+from textwrap import dedent
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.blast.alignmentCoverage import AlignmentCoverage, getFastaCoverage, getCoverageRuns, \
+                                          getMatchBlocks, MIN_ALIGNMENT_BYTES_PER_BLOCK
+from cactus.blast.alignmentFile import AlignmentWriter, parseCigarLine
+from cactus.blast.upconvertCoordinates import iterCigarFields
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        # The same alignments as in cactus_coverageTest, which the
+        # coverage should be the same as cactus_coverage's on
+        self.fastaPathA = os.path.join(self.tempDir, "a.fa")
+        with open(self.fastaPathA, 'w') as f:
+            f.write(dedent('''\
+            >id=0|simpleSeqA1 otherTokens thatDon'tMatter
+            ACTAGAGTAGGAGAGAGAGGGGGG
+            CATGCATGCATGCATGCATGCATG
+            >id=1|simpleSeqA2 otherTokens thatDon'tMatter
+            AAAAAAAAAAAAAAAACTCGTGAG
+            CATGCATGCATGCATGCATGCATG'''))
+        self.fastaPathB = os.path.join(self.tempDir, "b.fa")
+        with open(self.fastaPathB, 'w') as f:
+            f.write(dedent('''\
+            >id=2|simpleSeqB1 otherTokens
+            CATGCATGCATGCATGCATGCATG
+            CATGCATGCATGCATGCATGCATG'''))
+        self.cigarPath = os.path.join(self.tempDir, "alignments.cigar")
+        with open(self.cigarPath, 'w') as f:
+            f.write(dedent('''\
+            cigar: id=2|simpleSeqB1 0 9 + id=0|simpleSeqA1 10 0 - 0 M 8 D 1 M 1
+            cigar: id=2|simpleSeqB1 9 18 + id=0|simpleSeqA1 2 6 + 0 M 3 I 5 M 1
+            cigar: id=2|simpleSeqB1 18 28 + id=1|simpleSeqA2 0 10 + 0 M 1 I 2 M 2 D 2 M 5
+            cigar: id=2|simpleSeqB1 28 30 + id=1|simpleSeqA2 6 8 + 0 M 2
+            cigar: id=2|simpleSeqB1 30 32 + id=1|simpleSeqA2 7 9 + 0 M 2
+            cigar: id=12|simpleSeqZ1 0 1 + id=0|simpleSeqA1 6 7 + 0 M 1
+            cigar: id=3|simpleSeqC1 0 5 + id=4|simpleSeqD 0 5 + 0 M 5
+            '''))
+        random.seed(1)
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def getBed(self, fastaPath, depthById=False):
+        coverage = getFastaCoverage(fastaPath, depthById=depthById)
+        for fields in iterCigarFields(self.cigarPath):
+            coverage.addAlignment(fields)
+        bed = StringIO()
+        coverage.writeBed(bed)
+        return bed.getvalue()
+
+    def testCoverage(self):
+        self.assertEquals(dedent('''\
+        id=0|simpleSeqA1\t0\t1\t\t1
+        id=0|simpleSeqA1\t2\t7\t\t2
+        id=0|simpleSeqA1\t7\t10\t\t1
+        id=1|simpleSeqA2\t0\t3\t\t1
+        id=1|simpleSeqA2\t5\t6\t\t1
+        id=1|simpleSeqA2\t6\t7\t\t2
+        id=1|simpleSeqA2\t7\t8\t\t3
+        id=1|simpleSeqA2\t8\t9\t\t2
+        id=1|simpleSeqA2\t9\t10\t\t1
+        '''), self.getBed(self.fastaPathA))
+        self.assertEquals(dedent('''\
+        id=2|simpleSeqB1\t0\t12\t\t1
+        id=2|simpleSeqB1\t17\t19\t\t1
+        id=2|simpleSeqB1\t21\t32\t\t1
+        '''), self.getBed(self.fastaPathB))
+
+    def testDepthById(self):
+        self.assertEquals(dedent('''\
+        id=0|simpleSeqA1\t0\t1\t\t1
+        id=0|simpleSeqA1\t2\t6\t\t1
+        id=0|simpleSeqA1\t6\t7\t\t2
+        id=0|simpleSeqA1\t7\t10\t\t1
+        id=1|simpleSeqA2\t0\t3\t\t1
+        id=1|simpleSeqA2\t5\t10\t\t1
+        '''), self.getBed(self.fastaPathA, depthById=True))
+
+    def testCoverageRuns(self):
+        """The runs of coverage of random intervals are the same as those
+        counted position by position, capped at 65535."""
+        for i in xrange(20):
+            starts = [random.randint(0, 100) for j in xrange(random.randint(0, 50))]
+            ends = [start + random.randint(0, 20) for start in starts]
+            weights = [random.choice([1, 2, 40000]) for start in starts]
+            depths = [0] * 121
+            for start, end, weight in zip(starts, ends, weights):
+                for position in xrange(start, end):
+                    depths[position] = min(depths[position] + weight, 65535)
+            runs = zip(*[list(column) for column in getCoverageRuns(starts, ends, weights)])
+            expandedDepths = [0] * 121
+            for start, end, depth in runs:
+                expandedDepths[start:end] = [depth] * (end - start)
+            self.assertEquals(depths, expandedDepths)
+            for run, nextRun in zip(runs, runs[1:]):
+                self.assertTrue(run[1] < nextRun[0] or run[2] != nextRun[2])
+
+    def testIncremental(self):
+        """Adding the BED of the coverage of the alignments from some
+        genomes gives the same coverage as adding the alignments
+        themselves."""
+        allFields = list(iterCigarFields(self.cigarPath))
+        for depthById in (False, True):
+            coverage = getFastaCoverage(self.fastaPathA, depthById=depthById)
+            for fields in allFields[5:]:
+                coverage.addAlignment(fields)
+            bed = StringIO()
+            coverage.writeBed(bed)
+            coverage = getFastaCoverage(self.fastaPathA, depthById=depthById)
+            coverage.addBed(StringIO(bed.getvalue()))
+            for fields in allFields[:5]:
+                coverage.addAlignment(fields)
+            bed = StringIO()
+            coverage.writeBed(bed)
+            self.assertEquals(self.getBed(self.fastaPathA, depthById=depthById), bed.getvalue())
+            self.assertEquals(100.0 * 17 / 96, coverage.getPercentCoverage())
+
+    def testSaveRuns(self):
+        for depthById in (False, True):
+            coverage = getFastaCoverage(self.fastaPathA, depthById=depthById)
+            for fields in iterCigarFields(self.cigarPath):
+                coverage.addAlignment(fields)
+            saved = StringIO()
+            coverage.saveRuns(saved)
+            loadedCoverage = getFastaCoverage(self.fastaPathA, depthById=depthById)
+            loadedCoverage.loadRuns(StringIO(saved.getvalue()))
+            bed = StringIO()
+            loadedCoverage.writeBed(bed)
+            self.assertEquals(self.getBed(self.fastaPathA, depthById=depthById), bed.getvalue())
+        self.assertRaises(RuntimeError, loadedCoverage.loadRuns, StringIO("id=0|simpleSeqA1\t0\t1\t\t1\n"))
+        # Nothing covered
+        saved = StringIO()
+        getFastaCoverage(self.fastaPathA).saveRuns(saved)
+        loadedCoverage = getFastaCoverage(self.fastaPathA)
+        loadedCoverage.loadRuns(StringIO(saved.getvalue()))
+        self.assertEquals({}, loadedCoverage.getRuns())
+
+    def testBlocksPerByte(self):
+        """The densest alignments, alternating 1bp matches and gaps, have
+        no more blocks than estimateCoverageMemory allows for."""
+        line = "cigar: a 0 1000 + b 0 2000 + 0" + " M 1 I 1" * 1000 + "\n"
+        fields = line.split()
+        self.assertEquals(1000, len(getMatchBlocks(fields, 1)))
+        self.assertEquals(1000, len(getMatchBlocks(fields, 2)))
+        self.assertTrue(len(line) >= 1000 * MIN_ALIGNMENT_BYTES_PER_BLOCK)
+        binary = StringIO()
+        with AlignmentWriter(binary) as writer:
+            writer.write(parseCigarLine(line))
+        self.assertTrue(len(binary.getvalue()) >= 1000 * MIN_ALIGNMENT_BYTES_PER_BLOCK)
+
+    def testErrors(self):
+        coverage = AlignmentCoverage([("a", 10), ("b", 5)])
+        self.assertRaises(RuntimeError, coverage.addAlignment,
+                          "cigar: a 5 11 + b 0 6 + 0 M 6".split())
+        self.assertRaises(RuntimeError, AlignmentCoverage, [("a", 10), ("a", 5)])
+        coverage = AlignmentCoverage([("a", 10)], depthById=True)
+        self.assertRaises(RuntimeError, coverage.addAlignment,
+                          "cigar: a 0 5 + b 0 5 + 0 M 5".split())
+        self.assertEquals(0, AlignmentCoverage([]).getPercentCoverage())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+"""A compact binary container for pairwise alignments, indexed by
+contig and position.
+
+The alignments are the same as those in a cigar file: each has a
+contig, start, end and strand on each of its two sequences (in the order
+they appear on the cigar line), a score and a list of (type, length)
+operations. The file holds the records in the order they were written,
+each contig name given just before the first record using it, so the
+file can be read as a stream. These are followed by the table of contig
+names and, for each of the two sequences, an index of the records
+sorted by contig name and then by start position. This means the
+alignments can be read in sorted order, or queried by region, without
+sorting or re-parsing any text.
+
+Layout (little-endian):
+
+  magic
+  entries:  "N", then a contig name as length (I) and bytes, or
+            "R", then contig1 (I) start1 end1 (q q) strand1 (c)
+                      contig2 (I) start2 end2 (q q) strand2 (c)
+                      score (d) number of operations (I)
+                      operation types (1 byte each) operation lengths (I each)
+            and finally "E"
+  contigs:  number (I), then each name as length (I) and bytes
+  indexes:  for each sequence, arrays of the contig rank (I), minimum
+            position (q), maximum position (q) and offset (Q) of each
+            record, sorted by contig rank and then minimum position
+  footer:   number of records, offset of the contigs, offsets of the
+            two indexes (Q each), magic
+
+The contig rank is the position of the contig's name in the sorted list
+of names. If NumPy is installed the index columns are returned as NumPy
+views, otherwise as tuples.
+"""
+import sys
+import mmap
+import array
+import struct
+import bisect
+import shutil
+import itertools
+from argparse import ArgumentParser
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ALIGNMENT_FILE_MAGIC = "CACTUSAL"
+
+_CONTIG_ENTRY = "N"
+_RECORD_ENTRY = "R"
+_END_ENTRY = "E"
+
+_RECORD = struct.Struct("<IqqcIqqcdI")
+_FOOTER = struct.Struct("<QQQQ8s")
+_COUNT = struct.Struct("<I")
+
+# The struct format characters of the index columns
+_INDEX_COLUMNS = (('rank', 'I'), ('minPos', 'q'), ('maxPos', 'q'), ('offset', 'Q'))
+_NUMPY_TYPES = {'I': '<u4', 'q': '<i8', 'Q': '<u8'}
+
+# The AlignmentWriter keeps the index of every record in memory until it
+# is closed: two tuples of Python ints per record, and the sorted copies
+# of them made when the index is written, which measure about 600 bytes
+# a record under 64-bit CPython 2.7.
+INDEX_BYTES_PER_RECORD = 640
+# The smallest a record can be in a binary alignment file: its entry
+# type and fields, with no operations
+MIN_RECORD_BYTES = 1 + _RECORD.size
+
+def estimateWriterMemory(alignmentsSize):
+    """Estimate the memory an AlignmentWriter needs to merge binary
+    alignment files totalling alignmentsSize bytes."""
+    return INDEX_BYTES_PER_RECORD * alignmentsSize // MIN_RECORD_BYTES
+
+Alignment = namedtuple("Alignment", ["contig1", "start1", "end1", "strand1",
+                                     "contig2", "start2", "end2", "strand2",
+                                     "score", "operations"])
+
+def parseCigarLine(line):
+    """Parse a cigar line into an Alignment, or return None if it isn't one."""
+    tokens = line.split()
+    if len(tokens) < 10 or tokens[0] != "cigar:":
+        return None
+    operations = [(tokens[i], int(tokens[i + 1])) for i in xrange(10, len(tokens) - 1, 2)]
+    return Alignment(tokens[1], int(tokens[2]), int(tokens[3]), tokens[4],
+                     tokens[5], int(tokens[6]), int(tokens[7]), tokens[8],
+                     float(tokens[9]), operations)
+
+def getCigarFields(alignment):
+    """Get the whitespace-separated fields of the cigar line of an Alignment."""
+    score = alignment.score
+    score = "%i" % score if float(score).is_integer() else repr(score)
+    fields = ["cigar:", alignment.contig1, str(alignment.start1), str(alignment.end1), alignment.strand1,
+              alignment.contig2, str(alignment.start2), str(alignment.end2), alignment.strand2, score]
+    for operationType, length in alignment.operations:
+        fields += [operationType, str(length)]
+    return fields
+
+def formatCigarLine(alignment):
+    """Format an Alignment as a cigar line (with its newline)."""
+    return " ".join(getCigarFields(alignment)) + "\n"
+
+def isAlignmentFile(path):
+    """Is the file a binary alignment file, rather than cigar text?"""
+    with open(path, 'rb') as f:
+        return isAlignmentFileHandle(f)
+
+def isAlignmentFileHandle(f):
+    return f.read(len(ALIGNMENT_FILE_MAGIC)) == ALIGNMENT_FILE_MAGIC
+
+class AlignmentWriter(object):
+    """Writes Alignments to a binary alignment file (a path, or a file
+    handle, which needn't be seekable). The contig table and the indexes
+    are written when it is closed."""
+    def __init__(self, path):
+        if isinstance(path, basestring):
+            self.file = open(path, 'wb')
+            self.closeFile = True
+        else:
+            self.file = path
+            self.closeFile = False
+        self.file.write(ALIGNMENT_FILE_MAGIC)
+        self.offset = len(ALIGNMENT_FILE_MAGIC)
+        self.contigs = {}
+        self.contigNames = []
+        self.index = ([], [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        elif self.closeFile:
+            self.file.close()
+
+    def getContig(self, name):
+        if name not in self.contigs:
+            self.contigs[name] = len(self.contigNames)
+            self.contigNames.append(name)
+            self.file.write(_CONTIG_ENTRY + _COUNT.pack(len(name)) + name)
+            self.offset += 1 + _COUNT.size + len(name)
+        return self.contigs[name]
+
+    def write(self, alignment):
+        contig1 = self.getContig(alignment.contig1)
+        contig2 = self.getContig(alignment.contig2)
+        types = "".join(operation[0] for operation in alignment.operations)
+        lengths = array.array('I', [operation[1] for operation in alignment.operations])
+        if sys.byteorder != 'little':
+            lengths.byteswap()
+        self.offset += 1
+        self.file.write(_RECORD_ENTRY)
+        self.file.write(_RECORD.pack(contig1, alignment.start1, alignment.end1, alignment.strand1,
+                                     contig2, alignment.start2, alignment.end2, alignment.strand2,
+                                     alignment.score, len(types)))
+        self.file.write(types)
+        self.file.write(lengths.tostring())
+        self.index[0].append((contig1, min(alignment.start1, alignment.end1),
+                              max(alignment.start1, alignment.end1), self.offset))
+        self.index[1].append((contig2, min(alignment.start2, alignment.end2),
+                              max(alignment.start2, alignment.end2), self.offset))
+        self.offset += _RECORD.size + len(types) * 5
+
+    def close(self):
+        self.file.write(_END_ENTRY)
+        contigsOffset = self.offset + 1
+        self.offset = contigsOffset + _COUNT.size
+        self.file.write(_COUNT.pack(len(self.contigNames)))
+        for name in self.contigNames:
+            self.file.write(_COUNT.pack(len(name)))
+            self.file.write(name)
+            self.offset += _COUNT.size + len(name)
+        ranks = getContigRanks(self.contigNames)
+        indexOffsets = []
+        for index in self.index:
+            indexOffsets.append(self.offset)
+            entries = sorted((ranks[contig], minPos, maxPos, offset) for contig, minPos, maxPos, offset in index)
+            for column, (name, typecode) in enumerate(_INDEX_COLUMNS):
+                values = struct.pack("<%i%s" % (len(entries), typecode), *[entry[column] for entry in entries])
+                self.file.write(values)
+                self.offset += len(values)
+        self.file.write(_FOOTER.pack(len(self.index[0]), contigsOffset, indexOffsets[0], indexOffsets[1],
+                                     ALIGNMENT_FILE_MAGIC))
+        if self.closeFile:
+            self.file.close()
+
+def getContigRanks(contigNames):
+    """Get the rank of each contig (its position in sorted order), indexed
+    by the contig's number in the file."""
+    order = sorted(xrange(len(contigNames)), key=lambda contig: contigNames[contig])
+    ranks = [0] * len(contigNames)
+    for rank, contig in enumerate(order):
+        ranks[contig] = rank
+    return ranks
+
+class AlignmentReader(object):
+    """Reads a binary alignment file, in file order, in sorted order or by
+    region."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if not isAlignmentFileHandle(self.file):
+            self.file.close()
+            raise RuntimeError("%s is not a binary alignment file" % path)
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count, contigsOffset, index1Offset, index2Offset, magic = \
+            _FOOTER.unpack_from(self.data, len(self.data) - _FOOTER.size)
+        if magic != ALIGNMENT_FILE_MAGIC:
+            raise RuntimeError("%s is truncated" % path)
+        self.contigNames = []
+        offset = contigsOffset + _COUNT.size
+        for i in xrange(_COUNT.unpack_from(self.data, contigsOffset)[0]):
+            length = _COUNT.unpack_from(self.data, offset)[0]
+            self.contigNames.append(self.data[offset + _COUNT.size:offset + _COUNT.size + length])
+            offset += _COUNT.size + length
+        self.sortedContigNames = sorted(self.contigNames)
+        self.indexOffsets = (index1Offset, index2Offset)
+        self.indexes = [None, None]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def readRecord(self, offset):
+        """Get the Alignment at the given offset (just after its entry's
+        tag), and the offset of the next entry."""
+        contig1, start1, end1, strand1, contig2, start2, end2, strand2, score, numOperations = \
+            _RECORD.unpack_from(self.data, offset)
+        offset += _RECORD.size
+        types = self.data[offset:offset + numOperations]
+        offset += numOperations
+        lengths = array.array('I', self.data[offset:offset + 4 * numOperations])
+        if sys.byteorder != 'little':
+            lengths.byteswap()
+        offset += 4 * numOperations
+        return Alignment(self.contigNames[contig1], start1, end1, strand1,
+                         self.contigNames[contig2], start2, end2, strand2,
+                         score, zip(types, lengths)), offset
+
+    def __iter__(self):
+        """Iterate over the alignments in the order they were written."""
+        offset = len(ALIGNMENT_FILE_MAGIC)
+        while True:
+            tag = self.data[offset]
+            offset += 1
+            if tag == _RECORD_ENTRY:
+                alignment, offset = self.readRecord(offset)
+                yield alignment
+            elif tag == _CONTIG_ENTRY:
+                offset += _COUNT.size + _COUNT.unpack_from(self.data, offset)[0]
+            else:
+                break
+
+    def getIndex(self, contigNum):
+        """Get the index of sequence 1 or 2 of the alignments, as a dict of
+        the rank, minPos, maxPos and offset columns (NumPy arrays if
+        NumPy is installed, otherwise tuples)."""
+        if self.indexes[contigNum - 1] is None:
+            index = {}
+            offset = self.indexOffsets[contigNum - 1]
+            for name, typecode in _INDEX_COLUMNS:
+                columnFormat = "<%i%s" % (self.count, typecode)
+                if numpy is not None:
+                    index[name] = numpy.frombuffer(self.data, dtype=_NUMPY_TYPES[typecode],
+                                                   count=self.count, offset=offset)
+                else:
+                    index[name] = struct.unpack_from(columnFormat, self.data, offset)
+                offset += struct.calcsize(columnFormat)
+            self.indexes[contigNum - 1] = index
+        return self.indexes[contigNum - 1]
+
+    def iterSorted(self, contigNum=1):
+        """Iterate over the alignments sorted by the contig and then the
+        start of sequence 1 or 2."""
+        for offset in self.getIndex(contigNum)['offset']:
+            yield self.readRecord(int(offset))[0]
+
+    def query(self, contig, start, end, contigNum=1):
+        """Iterate over the alignments whose sequence 1 or 2 starts within
+        [start, end) of the contig, sorted by position."""
+        rank = bisect.bisect_left(self.sortedContigNames, contig)
+        if rank == len(self.sortedContigNames) or self.sortedContigNames[rank] != contig:
+            return
+        index = self.getIndex(contigNum)
+        keys = _IndexKeys(index)
+        i = bisect.bisect_left(keys, (rank, start))
+        while i < self.count and index['rank'][i] == rank and index['minPos'][i] < end:
+            yield self.readRecord(int(index['offset'][i]))[0]
+            i += 1
+
+class _IndexKeys(object):
+    """A sequence view of the (rank, minPos) keys of an index, to bisect."""
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index['rank'])
+
+    def __getitem__(self, i):
+        return (self.index['rank'][i], self.index['minPos'][i])
+
+def _readExactly(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise RuntimeError("Binary alignment stream is truncated")
+    return data
+
+def iterAlignmentStream(f):
+    """Iterate over the alignments of a binary alignment file being read
+    as a stream, just after its magic."""
+    contigNames = []
+    while True:
+        tag = _readExactly(f, 1)
+        if tag == _CONTIG_ENTRY:
+            length = _COUNT.unpack(_readExactly(f, _COUNT.size))[0]
+            contigNames.append(_readExactly(f, length))
+        elif tag == _RECORD_ENTRY:
+            contig1, start1, end1, strand1, contig2, start2, end2, strand2, score, numOperations = \
+                _RECORD.unpack(_readExactly(f, _RECORD.size))
+            types = _readExactly(f, numOperations)
+            lengths = array.array('I', _readExactly(f, 4 * numOperations))
+            if sys.byteorder != 'little':
+                lengths.byteswap()
+            yield Alignment(contigNames[contig1], start1, end1, strand1,
+                            contigNames[contig2], start2, end2, strand2,
+                            score, zip(types, lengths))
+        elif tag == _END_ENTRY:
+            return
+        else:
+            raise RuntimeError("Unexpected entry %r in binary alignment stream" % tag)
+
+def iterAlignmentsFromStream(f):
+    """Iterate over the alignments of either a binary alignment file or a
+    cigar file, being read as a stream."""
+    prefix = f.read(len(ALIGNMENT_FILE_MAGIC))
+    if prefix == ALIGNMENT_FILE_MAGIC:
+        for alignment in iterAlignmentStream(f):
+            yield alignment
+        return
+    if prefix == "":
+        return
+    for line in itertools.chain([prefix + f.readline()], f):
+        alignment = parseCigarLine(line)
+        if alignment is not None:
+            yield alignment
+
+def copyStreamAsCigar(f, outputFile):
+    """Copy a stream of either a binary alignment file or a cigar file to
+    a cigar file handle. Cigar is copied as it is."""
+    prefix = f.read(len(ALIGNMENT_FILE_MAGIC))
+    if prefix == ALIGNMENT_FILE_MAGIC:
+        for alignment in iterAlignmentStream(f):
+            outputFile.write(formatCigarLine(alignment))
+    else:
+        outputFile.write(prefix)
+        shutil.copyfileobj(f, outputFile)
+
+def readAlignments(path):
+    """Iterate over the alignments in either a binary alignment file or a
+    cigar file."""
+    if isAlignmentFile(path):
+        with AlignmentReader(path) as reader:
+            for alignment in reader:
+                yield alignment
+    else:
+        with open(path) as f:
+            for line in f:
+                alignment = parseCigarLine(line)
+                if alignment is not None:
+                    yield alignment
+
+def cigarToAlignmentFile(cigarPath, path):
+    """Convert a cigar file to a binary alignment file."""
+    with AlignmentWriter(path) as writer:
+        with open(cigarPath) as f:
+            for line in f:
+                alignment = parseCigarLine(line)
+                if alignment is not None:
+                    writer.write(alignment)
+
+def alignmentFileToCigar(path, outputFile, sortByContig=None):
+    """Write the alignments of a binary alignment file to a cigar file
+    handle, optionally sorted by the contig and position of sequence 1
+    or 2."""
+    with AlignmentReader(path) as reader:
+        alignments = reader if sortByContig is None else reader.iterSorted(sortByContig)
+        for alignment in alignments:
+            outputFile.write(formatCigarLine(alignment))
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["toBinary", "toCigar"])
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--sortByContig", type=int, choices=[1, 2], default=None,
+                        help="With toCigar, sort the output by the contig and position of sequence 1 or 2")
+    options = parser.parse_args()
+    if options.command == "toBinary":
+        cigarToAlignmentFile(options.input, options.output)
+    else:
+        with open(options.output, 'w') as f:
+            alignmentFileToCigar(options.input, f, sortByContig=options.sortByContig)
+
+if __name__ == '__main__':
+    main()
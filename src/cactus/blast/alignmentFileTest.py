@@ -0,0 +1,137 @@
+import os
+import random
+import unittest
+from StringIO import StringIO
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.blast.alignmentFile import Alignment, AlignmentWriter, AlignmentReader, \
+                                       parseCigarLine, formatCigarLine, isAlignmentFile, \
+                                       iterAlignmentsFromStream, copyStreamAsCigar, \
+                                       cigarToAlignmentFile, alignmentFileToCigar, \
+                                       estimateWriterMemory, INDEX_BYTES_PER_RECORD
+from cactus.blast.upconvertCoordinates import upconvertCoords
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        random.seed(1)
+        self.alignments = [self.getRandomAlignment() for i in xrange(200)]
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def getRandomAlignment(self):
+        start1 = random.randint(0, 10000)
+        start2 = random.randint(0, 10000)
+        operations = [(random.choice("MID"), random.randint(1, 50)) for i in xrange(random.randint(0, 5))]
+        return Alignment("id=human|chr%i" % random.randint(0, 5), start1, start1 + 100, "+",
+                         "id=mouse|chr%i" % random.randint(0, 3), start2 + 100, start2, "-",
+                         float(random.randint(0, 10000000)), operations)
+
+    def writeAlignments(self, alignments):
+        path = os.path.join(self.tempDir, "alignments")
+        with AlignmentWriter(path) as writer:
+            for alignment in alignments:
+                writer.write(alignment)
+        return path
+
+    def normalise(self, alignments):
+        return [alignment._replace(operations=[(operationType, int(length))
+                                               for operationType, length in alignment.operations])
+                for alignment in alignments]
+
+    def testCigarLines(self):
+        line = "cigar: a 10 0 - b 5 15 + 3.5 M 5 I 2 D 3\n"
+        alignment = parseCigarLine(line)
+        self.assertEquals(Alignment("a", 10, 0, "-", "b", 5, 15, "+", 3.5, [("M", 5), ("I", 2), ("D", 3)]),
+                          alignment)
+        self.assertEquals(line, formatCigarLine(alignment))
+        self.assertEquals("cigar: a 0 1 + b 0 1 + 10\n",
+                          formatCigarLine(parseCigarLine("cigar: a 0 1 + b 0 1 + 10")))
+        self.assertEquals(None, parseCigarLine("\n"))
+
+    def testRoundTrip(self):
+        path = self.writeAlignments(self.alignments)
+        self.assertTrue(isAlignmentFile(path))
+        with AlignmentReader(path) as reader:
+            self.assertEquals(len(self.alignments), len(reader))
+            self.assertEquals(self.alignments, self.normalise(reader))
+        cigarPath = os.path.join(self.tempDir, "alignments.cigar")
+        with open(cigarPath, 'w') as f:
+            alignmentFileToCigar(path, f)
+        self.assertFalse(isAlignmentFile(cigarPath))
+        with open(cigarPath) as f:
+            self.assertEquals("".join(map(formatCigarLine, self.alignments)), f.read())
+        convertedPath = os.path.join(self.tempDir, "converted")
+        cigarToAlignmentFile(cigarPath, convertedPath)
+        with open(convertedPath) as converted:
+            with open(path) as original:
+                self.assertEquals(original.read(), converted.read())
+
+    def testEmpty(self):
+        path = self.writeAlignments([])
+        with AlignmentReader(path) as reader:
+            self.assertEquals([], list(reader))
+            self.assertEquals([], list(reader.iterSorted(2)))
+            self.assertEquals([], list(reader.query("id=human|chr1", 0, 10000)))
+
+    def testWriterMemory(self):
+        """The memory estimated for writing a file covers the index of
+        however many records it could hold, even with no operations."""
+        alignments = [alignment._replace(operations=[]) for alignment in self.alignments]
+        for records in (self.alignments, alignments):
+            size = os.path.getsize(self.writeAlignments(records))
+            self.assertTrue(estimateWriterMemory(size) >= len(records) * INDEX_BYTES_PER_RECORD)
+
+    def testSortedAndQuery(self):
+        path = self.writeAlignments(self.alignments)
+        with AlignmentReader(path) as reader:
+            self.assertEquals(sorted(self.alignments, key=lambda a: (a.contig1, a.start1)),
+                              self.normalise(reader.iterSorted(1)))
+            self.assertEquals(sorted((a.contig2, a.end2) for a in self.alignments),
+                              [(a.contig2, a.end2) for a in reader.iterSorted(2)])
+            queried = self.normalise(reader.query("id=human|chr3", 1000, 5000))
+            self.assertEquals(sorted([a for a in self.alignments
+                                      if a.contig1 == "id=human|chr3" and 1000 <= a.start1 < 5000],
+                                     key=lambda a: a.start1),
+                              queried)
+            self.assertEquals([], list(reader.query("id=dog|chr1", 0, 10000)))
+
+    def testStreams(self):
+        # The writer can write to a stream, and the result can be read
+        # back as a stream, as the alignments are in the job store
+        output = StringIO()
+        with AlignmentWriter(output) as writer:
+            for alignment in self.alignments:
+                writer.write(alignment)
+        with open(self.writeAlignments(self.alignments)) as f:
+            self.assertEquals(f.read(), output.getvalue())
+        cigar = "".join(map(formatCigarLine, self.alignments))
+        self.assertEquals(self.alignments, self.normalise(iterAlignmentsFromStream(StringIO(output.getvalue()))))
+        self.assertEquals(self.alignments, self.normalise(iterAlignmentsFromStream(StringIO(cigar))))
+        self.assertEquals([], list(iterAlignmentsFromStream(StringIO(""))))
+        for stream in (output.getvalue(), cigar):
+            copied = StringIO()
+            copyStreamAsCigar(StringIO(stream), copied)
+            self.assertEquals(cigar, copied.getvalue())
+
+    def testUpconvertCoords(self):
+        """The binary alignments are converted to the coordinates of the
+        trimmed sequences, as cigar."""
+        fastaPath = os.path.join(self.tempDir, "trimmed.fa")
+        with open(fastaPath, 'w') as f:
+            f.write(">id=human|chr1|0\nACGTACGTAC\n>id=human|chr1|20\nACGTACGTAC\n")
+        path = self.writeAlignments([Alignment("id=human|chr1", 22, 25, "+", "b", 0, 3, "+", 1.0, [("M", 3)]),
+                                     Alignment("id=human|chr2", 0, 3, "+", "b", 0, 3, "+", 1.0, [("M", 3)]),
+                                     Alignment("id=human|chr1", 5, 2, "-", "b", 3, 6, "+", 2.0, [("M", 3)])])
+        output = StringIO()
+        upconvertCoords(cigarPath=path, fastaPath=fastaPath, contigNum=1, outputFile=output)
+        self.assertEquals("cigar: id=human|chr1|20 2 5 + b 0 3 + 1 M 3\n"
+                          "cigar: id=human|chr2 0 3 + b 0 3 + 1 M 3\n"
+                          "cigar: id=human|chr1|0 5 2 - b 3 6 + 2 M 3\n", output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
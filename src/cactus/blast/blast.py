@@ -7,21 +7,26 @@
 sequences. Uses the toil framework to parallelise the blasts.
 """
 import os
-import shutil
+import json
+import time
 from toil.lib.bioio import logger
 from toil.lib.bioio import system
 
-from sonLib.bioio import catFiles, nameValue, popenCatch, getTempDirectory
+from sonLib.bioio import nameValue, popenCatch, getTempDirectory
 
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import cactus_call
 from cactus.shared.common import runLastz, runSelfLastz
 from cactus.shared.common import runCactusRealign, runCactusSelfRealign
 from cactus.shared.common import runGetChunks
-from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.common import ChildTreeJob
-from cactus.blast.upconvertCoordinates import upconvertCoords
-from cactus.blast.trimSequences import trimSequences
+from cactus.shared.fasta import FastaFile
+from cactus.blast.alignmentCoverage import getFastaCoverage, estimateCoverageMemory
+from cactus.blast.outgroupRound import getContigIngroups, partitionAlignments, trimOutgroup, \
+                                       convertRoundAlignments
+from cactus.blast.alignmentFile import AlignmentWriter, iterAlignmentsFromStream, copyStreamAsCigar, \
+                                       cigarToAlignmentFile, isAlignmentFileHandle, estimateWriterMemory
+from cactus.blast.trimSequences import trimSequencesToBlocks
 
 class BlastOptions(object):
     def __init__(self, chunkSize=10000000, overlapSize=10000, 
@@ -40,7 +45,16 @@ class BlastOptions(object):
                  # default because it's needed for the tests (which
                  # don't use realign.)
                  trimOutgroupFlanking=2000,
-                 keepParalogs=False):
+                 keepParalogs=False,
+                 # Collation options:
+                 collateFanIn=100,
+                 collateManifest=False,
+                 # Keep the results in the binary alignment format
+                 # (see alignmentFile) rather than as cigar text.
+                 # Experimental: the results are converted to and
+                 # from cigar in Python, record by record, at every
+                 # step, so this is slower than cigar text for now.
+                 binaryAlignments=False):
         """Class defining options for blast
         """
         self.chunkSize = chunkSize
@@ -62,6 +76,9 @@ class BlastOptions(object):
         self.trimOutgroupDepth = trimOutgroupDepth
         self.trimOutgroupFlanking = trimOutgroupFlanking
         self.keepParalogs = keepParalogs
+        self.collateFanIn = collateFanIn
+        self.collateManifest = collateManifest
+        self.binaryAlignments = binaryAlignments
 
 class BlastSequencesAllAgainstAll(RoundedJob):
     """Take a set of sequences, chunks them up and blasts them.
@@ -208,6 +225,10 @@ class BlastFirstOutgroup(RoundedJob):
     """Blast the given sequence(s) against the first of a succession of
     outgroups, only aligning fragments that haven't aligned to the
     previous outgroups. Then recurse on the other outgroups.
+
+    The coverage of the previous outgroups on each ingroup is passed on
+    in ingroupCoverageIDs, saved with AlignmentCoverage.saveRuns, and
+    returned by the last round as BED files.
     """
     def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
                  outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
@@ -232,7 +253,7 @@ class BlastFirstOutgroup(RoundedJob):
             self.sequenceIDs,
             [self.outgroupSequenceIDs[0]],
             self.blastOptions)).rv()
-        trimRecurseJob = self.addFollowOn(TrimAndRecurseOnOutgroups(
+        trimRecurseJob = self.addFollowOn(StartTrimAndRecurseOnOutgroups(
             ingroupNames=self.ingroupNames,
             untrimmedSequenceIDs=self.untrimmedSequenceIDs,
             sequenceIDs=self.sequenceIDs,
@@ -249,12 +270,40 @@ class BlastFirstOutgroup(RoundedJob):
         ingroupCoverageIDs = trimRecurseJob.rv(2)
         return (outgroupAlignmentsID, outgroupFragmentIDs, ingroupCoverageIDs)
 
+class StartTrimAndRecurseOnOutgroups(RoundedJob):
+    """Start TrimAndRecurseOnOutgroups once the alignments of the round
+    exist, so that it can be sized from them.
+    """
+    def __init__(self, **kwargs):
+        super(StartTrimAndRecurseOnOutgroups, self).__init__(preemptable=True)
+        self.kwargs = kwargs
+
+    def run(self, fileStore):
+        mostRecentResultsSize = getAlignmentsSize(fileStore.jobStore, self.kwargs['mostRecentResultsID'])
+        return self.addFollowOn(TrimAndRecurseOnOutgroups(mostRecentResultsSize=mostRecentResultsSize,
+                                                          **self.kwargs)).rv()
+
 class TrimAndRecurseOnOutgroups(RoundedJob):
+    """Trim the outgroup to the alignments of the latest round, then
+    convert the alignments and trim away the aligned regions of each
+    ingroup, in a ConvertAndTrimIngroup job for each ingroup, and
+    recurse on the next outgroup once they are all done.
+    """
     def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
                  outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
                  mostRecentResultsID, outgroupResultsID,
-                 blastOptions, outgroupNumber, ingroupCoverageIDs):
-        super(TrimAndRecurseOnOutgroups, self).__init__(preemptable=True)
+                 blastOptions, outgroupNumber, ingroupCoverageIDs,
+                 mostRecentResultsSize=None):
+        if mostRecentResultsSize is not None and hasattr(outgroupSequenceIDs[0], "size"):
+            # The coverage of the alignments is computed on the outgroup,
+            # which is trimmed with it, and the alignments are split up
+            # by ingroup.
+            disk = 3*(outgroupSequenceIDs[0].size + mostRecentResultsSize)
+            memory = 3*outgroupSequenceIDs[0].size + estimateCoverageMemory(mostRecentResultsSize)
+        else:
+            disk = None
+            memory = None
+        super(TrimAndRecurseOnOutgroups, self).__init__(memory=memory, disk=disk, preemptable=True)
         self.ingroupNames = ingroupNames
         self.untrimmedSequenceIDs = untrimmedSequenceIDs
         self.sequenceIDs = sequenceIDs
@@ -268,96 +317,189 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
         self.ingroupCoverageIDs = ingroupCoverageIDs
 
     def run(self, fileStore):
-        # Trim outgroup, convert outgroup coordinates, and add to
-        # outgroup fragments dir
-
-        outgroupSequenceFiles = [fileStore.readGlobalFile(fileID) for fileID in self.outgroupSequenceIDs]
-        mostRecentResultsFile = fileStore.readGlobalFile(self.mostRecentResultsID)
-        trimmedOutgroup = fileStore.getLocalTempFile()
-        outgroupCoverage = fileStore.getLocalTempFile()
-        calculateCoverage(outgroupSequenceFiles[0],
-                          mostRecentResultsFile, outgroupCoverage)
-        # The windowSize and threshold are fixed at 1: anything more
-        # and we will run into problems with alignments that aren't
-        # covered in a matching trimmed sequence.
-        trimSequences(outgroupSequenceFiles[0], outgroupCoverage,
-                      trimmedOutgroup, flanking=self.blastOptions.trimOutgroupFlanking,
-                      windowSize=1, threshold=1)
-        outgroupConvertedResultsFile = fileStore.getLocalTempFile()
-        with open(outgroupConvertedResultsFile, 'w') as f:
-            upconvertCoords(cigarPath=mostRecentResultsFile,
-                            fastaPath=trimmedOutgroup,
-                            contigNum=1,
-                            outputFile=f)
-
-        self.outgroupFragmentIDs.append(fileStore.writeGlobalFile(trimmedOutgroup))
+        # Trim outgroup, and add to outgroup fragments dir. The same pass
+        # over the alignments that calculates their coverage on the
+        # outgroup splits them up by ingroup.
+        outgroupSequenceFile = fileStore.readGlobalFile(self.outgroupSequenceIDs[0])
         sequenceFiles = [fileStore.readGlobalFile(path) for path in self.sequenceIDs]
-        untrimmedSequenceFiles = [fileStore.readGlobalFile(path) for path in self.untrimmedSequenceIDs]
-
-        # Report coverage of the latest outgroup on the trimmed ingroups.
-        for trimmedIngroupSequence, ingroupSequence, ingroupName in zip(sequenceFiles, untrimmedSequenceFiles, self.ingroupNames):
-            tmpIngroupCoverage = fileStore.getLocalTempFile()
-            calculateCoverage(trimmedIngroupSequence, mostRecentResultsFile,
-                              tmpIngroupCoverage)
-            fileStore.logToMaster("Coverage on %s from outgroup #%d, %s: %s%% (current ingroup length %d, untrimmed length %d). Outgroup trimmed to %d bp from %d" % (ingroupName, self.outgroupNumber, self.outgroupNames[self.outgroupNumber - 1], percentCoverage(trimmedIngroupSequence, tmpIngroupCoverage), sequenceLength(trimmedIngroupSequence), sequenceLength(ingroupSequence), sequenceLength(trimmedOutgroup), sequenceLength(outgroupSequenceFiles[0])))
-
-        # Convert the alignments' ingroup coordinates.
-        ingroupConvertedResultsFile = fileStore.getLocalTempFile()
-        if self.sequenceIDs == self.untrimmedSequenceIDs:
-            # No need to convert ingroup coordinates on first run.
-            shutil.copy(outgroupConvertedResultsFile,
-                        ingroupConvertedResultsFile)
-        else:
-            cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                    "--onlyContig1",
-                                    outgroupConvertedResultsFile,
-                                    ingroupConvertedResultsFile,
-                                    "1"])
-        # Append the latest results to the accumulated outgroup coverage file
-        if self.outgroupResultsID:
-            outgroupResultsFile = fileStore.readGlobalFile(self.outgroupResultsID, mutable=True)
+        mostRecentResultsFile = readGlobalAlignmentsFile(fileStore, self.mostRecentResultsID,
+                                                         binary=self.blastOptions.binaryAlignments)
+        outgroupCoverage = getFastaCoverage(outgroupSequenceFile)
+        ingroupResultsFiles = [fileStore.getLocalTempFile() for path in sequenceFiles]
+        outputs = [open(path, 'w') for path in ingroupResultsFiles]
+        try:
+            numAlignments = partitionAlignments(mostRecentResultsFile, outgroupCoverage,
+                                                getContigIngroups(sequenceFiles), outputs)
+        finally:
+            for output in outputs:
+                output.close()
+        trimmedOutgroup = fileStore.getLocalTempFile()
+        trimOutgroup(outgroupSequenceFile, outgroupCoverage, trimmedOutgroup,
+                     flanking=self.blastOptions.trimOutgroupFlanking)
+        trimmedOutgroupID = fileStore.writeGlobalFile(trimmedOutgroup)
+        self.outgroupFragmentIDs.append(trimmedOutgroupID)
+        fileStore.logToMaster("Outgroup #%d, %s, trimmed to %d bp from %d" % (self.outgroupNumber, self.outgroupNames[self.outgroupNumber - 1], sequenceLength(trimmedOutgroup), outgroupCoverage.getTotalLength()))
+
+        # The rest of the round is independent for each ingroup.
+        ingroupResults = []
+        for i, ingroupName in enumerate(self.ingroupNames):
+            logger.info("%i alignments on ingroup %s" % (numAlignments[i], ingroupName))
+            ingroupResults.append(self.addChild(ConvertAndTrimIngroup(
+                ingroupName=ingroupName,
+                untrimmedSequenceID=self.untrimmedSequenceIDs[i],
+                sequenceID=self.sequenceIDs[i],
+                resultsID=fileStore.writeGlobalFile(ingroupResultsFiles[i]),
+                trimmedOutgroupID=trimmedOutgroupID,
+                coverageID=self.ingroupCoverageIDs[i] if self.ingroupCoverageIDs else None,
+                blastOptions=self.blastOptions,
+                outgroupName=self.outgroupNames[self.outgroupNumber - 1],
+                outgroupNumber=self.outgroupNumber,
+                lastRound=len(self.outgroupSequenceIDs) == 1)).rv())
+        return self.addFollowOn(RecurseOnOutgroups(
+            ingroupNames=self.ingroupNames,
+            untrimmedSequenceIDs=self.untrimmedSequenceIDs,
+            sequenceIDs=self.sequenceIDs,
+            outgroupNames=self.outgroupNames,
+            outgroupSequenceIDs=self.outgroupSequenceIDs,
+            outgroupFragmentIDs=self.outgroupFragmentIDs,
+            outgroupResultsID=self.outgroupResultsID,
+            blastOptions=self.blastOptions,
+            outgroupNumber=self.outgroupNumber,
+            ingroupResults=ingroupResults)).rv()
+
+class ConvertAndTrimIngroup(RoundedJob):
+    """Convert the coordinates of the alignments of a round on one
+    ingroup, add them to the coverage of the previous outgroups on it,
+    and trim away the aligned regions of the ingroup for the next round.
+
+    Returns the IDs of the converted alignments, the coverage (saved with
+    AlignmentCoverage.saveRuns, or as a BED file on the last round) and
+    the trimmed ingroup (None on the last round).
+    """
+    def __init__(self, ingroupName, untrimmedSequenceID, sequenceID, resultsID,
+                 trimmedOutgroupID, coverageID, blastOptions, outgroupName,
+                 outgroupNumber, lastRound):
+        if hasattr(untrimmedSequenceID, "size") and hasattr(resultsID, "size"):
+            # The coverage of the alignments is computed on the untrimmed
+            # ingroup, which is trimmed with it, and the alignments are
+            # read and written again converted.
+            disk = 3*(untrimmedSequenceID.size + resultsID.size)
+            memory = 3*untrimmedSequenceID.size + estimateCoverageMemory(resultsID.size)
         else:
-            outgroupResultsFile = fileStore.getLocalTempFile()
-        with open(ingroupConvertedResultsFile) as results:
-            with open(outgroupResultsFile, 'a') as output:
-                output.write(results.read())
-
-        self.outgroupResultsID = fileStore.writeGlobalFile(outgroupResultsFile)
-
-        # Report coverage of the all outgroup alignments so far on the ingroups.
-        ingroupCoverageFiles = []
-        self.ingroupCoverageIDs = []
-        for ingroupSequence, ingroupName in zip(untrimmedSequenceFiles, self.ingroupNames):
-            ingroupCoverageFile = fileStore.getLocalTempFile()
-            calculateCoverage(sequenceFile=ingroupSequence, cigarFile=outgroupResultsFile,
-                              outputFile=ingroupCoverageFile, depthById=self.blastOptions.trimOutgroupDepth > 1)
-            ingroupCoverageFiles.append(ingroupCoverageFile)
-            self.ingroupCoverageIDs.append(fileStore.writeGlobalFile(ingroupCoverageFile))
-            fileStore.logToMaster("Cumulative coverage of %d outgroups on ingroup %s: %s" % (self.outgroupNumber, ingroupName, percentCoverage(ingroupSequence, ingroupCoverageFile)))
+            disk = None
+            memory = None
+        super(ConvertAndTrimIngroup, self).__init__(memory=memory, disk=disk, preemptable=True)
+        self.ingroupName = ingroupName
+        self.untrimmedSequenceID = untrimmedSequenceID
+        self.sequenceID = sequenceID
+        self.resultsID = resultsID
+        self.trimmedOutgroupID = trimmedOutgroupID
+        self.coverageID = coverageID
+        self.blastOptions = blastOptions
+        self.outgroupName = outgroupName
+        self.outgroupNumber = outgroupNumber
+        self.lastRound = lastRound
 
-        if len(self.outgroupSequenceIDs) > 1:
-            # Trim ingroup seqs and recurse on the next outgroup.
-            trimmedSeqs = []
-            # Use the accumulated results so far to trim away the
-            # aligned parts of the ingroups.
-            for i, sequenceFile in enumerate(untrimmedSequenceFiles):
-                outgroupCoverageFile = ingroupCoverageFiles[i]
-                selfCoverageFile = fileStore.getLocalTempFile()
-                coverageFile = fileStore.getLocalTempFile()
-                if self.blastOptions.keepParalogs:
-                    subtractBed(outgroupCoverageFile, selfCoverageFile, coverageFile)
-                else:
-                    coverageFile = outgroupCoverageFile
-
-                trimmed = fileStore.getLocalTempFile()
-                trimSequences(sequenceFile, coverageFile, trimmed,
-                              complement=True, flanking=self.blastOptions.trimFlanking,
+    def run(self, fileStore):
+        # Convert the alignments' outgroup coordinates, and their ingroup
+        # coordinates too, except on the first run, and add them to the
+        # coverage of the previous outgroups on the ingroup, saved by the
+        # previous round. The alignments are read once in all.
+        sequenceFile = fileStore.readGlobalFile(self.sequenceID)
+        untrimmedSequenceFile = fileStore.readGlobalFile(self.untrimmedSequenceID)
+        trimmedOutgroup = fileStore.readGlobalFile(self.trimmedOutgroupID)
+        resultsFile = fileStore.readGlobalFile(self.resultsID)
+        trimmedCoverage = getFastaCoverage(sequenceFile)
+        coverage = getFastaCoverage(untrimmedSequenceFile, depthById=self.blastOptions.trimOutgroupDepth > 1)
+        if self.coverageID is not None:
+            with fileStore.jobStore.readFileStream(self.coverageID) as f:
+                coverage.loadRuns(f)
+            fileStore.deleteGlobalFile(self.coverageID)
+        convertedResultsFile = fileStore.getLocalTempFile()
+        convertStart = time.time()
+        with open(convertedResultsFile, 'w') as f:
+            numAlignments = convertRoundAlignments(resultsFile, trimmedOutgroup,
+                                                   convertIngroups=self.sequenceID != self.untrimmedSequenceID,
+                                                   outputFile=f, trimmedCoverages=[trimmedCoverage],
+                                                   coverages=[coverage])
+        logger.info("Converted the coordinates of %i alignments in %.1f s" %
+                    (numAlignments, time.time() - convertStart))
+        convertedResultsID = fileStore.writeGlobalFile(convertedResultsFile)
+        fileStore.deleteGlobalFile(self.resultsID)
+
+        # Report coverage of the latest outgroup on the trimmed ingroup,
+        # and of all the outgroup alignments so far on the ingroup.
+        fileStore.logToMaster("Coverage on %s from outgroup #%d, %s: %s%% (current ingroup length %d, untrimmed length %d)" % (self.ingroupName, self.outgroupNumber, self.outgroupName, trimmedCoverage.getPercentCoverage(), trimmedCoverage.getTotalLength(), coverage.getTotalLength()))
+        fileStore.logToMaster("Cumulative coverage of %d outgroups on ingroup %s: %s" % (self.outgroupNumber, self.ingroupName, coverage.getPercentCoverage()))
+
+        if self.lastRound:
+            # Finally, the coverage on the ingroup goes in a BED file.
+            with fileStore.writeGlobalFileStream() as (output, coverageID):
+                coverage.writeBed(output)
+            return (convertedResultsID, coverageID, None)
+
+        # Use the accumulated coverage so far to trim away the aligned
+        # parts of the ingroup. (There is no self coverage to subtract
+        # from it if keepParalogs is set.)
+        trimmed = fileStore.getLocalTempFile()
+        trimSequencesToBlocks(untrimmedSequenceFile, coverage.getBlocks(self.blastOptions.trimOutgroupDepth),
+                              trimmed, complement=True, flanking=self.blastOptions.trimFlanking,
                               minSize=self.blastOptions.trimMinSize,
                               threshold=self.blastOptions.trimThreshold,
-                              windowSize=self.blastOptions.trimWindowSize,
-                              depth=self.blastOptions.trimOutgroupDepth)
-                trimmedSeqs.append(trimmed)
-            trimmedSeqIDs = [fileStore.writeGlobalFile(path, cleanup=True) for path in trimmedSeqs]
+                              windowSize=self.blastOptions.trimWindowSize)
+        # Removed by the next round (this job has no successors to wait
+        # for, so it can't be cleaned up with it).
+        trimmedID = fileStore.writeGlobalFile(trimmed)
+        # Save the coverage for the next round to carry on from.
+        with fileStore.writeGlobalFileStream() as (output, coverageID):
+            coverage.saveRuns(output)
+        return (convertedResultsID, coverageID, trimmedID)
+
+class RecurseOnOutgroups(RoundedJob):
+    """Add the converted alignments of each ingroup from a round to the
+    accumulated outgroup results, then recurse on the next outgroup or,
+    after the last, return the results.
+    """
+    def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
+                 outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
+                 outgroupResultsID, blastOptions, outgroupNumber, ingroupResults):
+        super(RecurseOnOutgroups, self).__init__(preemptable=True)
+        self.ingroupNames = ingroupNames
+        self.untrimmedSequenceIDs = untrimmedSequenceIDs
+        self.sequenceIDs = sequenceIDs
+        self.outgroupNames = outgroupNames
+        self.outgroupSequenceIDs = outgroupSequenceIDs
+        self.outgroupFragmentIDs = outgroupFragmentIDs
+        self.outgroupResultsID = outgroupResultsID
+        self.blastOptions = blastOptions
+        self.outgroupNumber = outgroupNumber
+        self.ingroupResults = ingroupResults
+
+    def run(self, fileStore):
+        convertedResultsIDs = [results[0] for results in self.ingroupResults]
+        ingroupCoverageIDs = [results[1] for results in self.ingroupResults]
+        trimmedSeqIDs = [results[2] for results in self.ingroupResults]
+
+        # Add the latest results to the accumulated outgroup results,
+        # which are kept as a manifest of each round's results so none of
+        # them are copied again.
+        resultsPartIDs = []
+        resultsPartSizes = []
+        if self.outgroupResultsID:
+            resultsPartIDs = getAlignmentsPartIDs(fileStore.jobStore, self.outgroupResultsID)
+            resultsPartSizes = getAlignmentsPartSizes(fileStore.jobStore, self.outgroupResultsID)
+            fileStore.deleteGlobalFile(self.outgroupResultsID)
+        resultsPartIDs.extend(convertedResultsIDs)
+        resultsPartSizes.extend(getattr(resultsID, "size", None) for resultsID in convertedResultsIDs)
+        self.outgroupResultsID = writeAlignmentsManifest(fileStore, resultsPartIDs, resultsPartSizes)
+
+        # The ingroups trimmed for this round are no longer needed.
+        if self.sequenceIDs != self.untrimmedSequenceIDs:
+            for sequenceID in self.sequenceIDs:
+                fileStore.deleteGlobalFile(sequenceID)
+
+        if len(self.outgroupSequenceIDs) > 1:
+            # Recurse on the next outgroup with the trimmed ingroups.
             return self.addChild(BlastFirstOutgroup(
                 ingroupNames=self.ingroupNames,
                 untrimmedSequenceIDs=self.untrimmedSequenceIDs,
@@ -368,10 +510,11 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
                 outgroupResultsID=self.outgroupResultsID,
                 blastOptions=self.blastOptions,
                 outgroupNumber=self.outgroupNumber + 1,
-                ingroupCoverageIDs=self.ingroupCoverageIDs)).rv()
+                ingroupCoverageIDs=ingroupCoverageIDs)).rv()
         else:
-            # Finally, put the ingroups and outgroups results together
-            return (self.outgroupResultsID, self.outgroupFragmentIDs, self.ingroupCoverageIDs)
+            # Finally, put the ingroups and outgroups results together,
+            # with the coverage on the ingroups as BED files.
+            return (self.outgroupResultsID, self.outgroupFragmentIDs, ingroupCoverageIDs)
 
 def compressFastaFile(fileName):
     """Compress a fasta file.
@@ -415,7 +558,7 @@ class RunSelfBlast(RoundedJob):
             #TODO: This throws away the compressed file
             seqFile = compressFastaFile(seqFile)
         logger.info("Ran the self blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        return writeGlobalResultsFile(fileStore, resultsFile, self.blastOptions)
     
 class RunBlast(RoundedJob):
     """Runs blast as a job.
@@ -454,46 +597,196 @@ class RunBlast(RoundedJob):
                                 resultsFile,
                                 str(self.blastOptions.roundsOfCoordinateConversion)])
         logger.info("Ran the blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        return writeGlobalResultsFile(fileStore, resultsFile, self.blastOptions)
+
+def writeGlobalResultsFile(fileStore, resultsFile, blastOptions):
+    """Write a cigar file of blast results to the job store, converting it
+    to the binary alignment format if binaryAlignments is set."""
+    if blastOptions.binaryAlignments:
+        binaryResultsFile = fileStore.getLocalTempFile()
+        cigarToAlignmentFile(resultsFile, binaryResultsFile)
+        resultsFile = binaryResultsFile
+    return fileStore.writeGlobalFile(resultsFile)
+
+# Start of a file listing the parts of a set of alignments, rather
+# than holding the alignments themselves
+ALIGNMENTS_MANIFEST_MAGIC = "CACTUS_ALIGNMENTS_MANIFEST\n"
+
+def _readAlignmentsManifest(jobStore, fileID):
+    with jobStore.readFileStream(fileID) as f:
+        if f.read(len(ALIGNMENTS_MANIFEST_MAGIC)) != ALIGNMENTS_MANIFEST_MAGIC:
+            return None
+        return json.load(f)
+
+def readAlignmentsManifest(jobStore, fileID):
+    """Get the IDs of the part files listed by an alignments manifest, or
+    None if the file holds the alignments themselves."""
+    manifest = _readAlignmentsManifest(jobStore, fileID)
+    return None if manifest is None else manifest['parts']
+
+def writeAlignmentsManifest(fileStore, parts, sizes=None):
+    """Write a manifest listing the IDs of the files that make up a set of
+    alignments, and their sizes (None where unknown) if given, returning
+    its ID."""
+    if sizes is None:
+        sizes = [None] * len(parts)
+    assert len(sizes) == len(parts)
+    with fileStore.writeGlobalFileStream() as (output, manifestID):
+        output.write(ALIGNMENTS_MANIFEST_MAGIC)
+        json.dump({'parts': map(str, parts), 'sizes': sizes}, output)
+    return manifestID
+
+def getAlignmentsPartIDs(jobStore, fileID):
+    """Get the IDs of the files that, read in sequence, make up a set of
+    alignments (either a plain alignments file or a manifest)."""
+    parts = readAlignmentsManifest(jobStore, fileID)
+    return [fileID] if parts is None else parts
+
+def getAlignmentsPartSizes(jobStore, fileID):
+    """Get the sizes (None where unknown) of the files getAlignmentsPartIDs
+    lists."""
+    manifest = _readAlignmentsManifest(jobStore, fileID)
+    if manifest is None:
+        return [getattr(fileID, "size", None)]
+    return manifest.get('sizes', [None] * len(manifest['parts']))
+
+def getAlignmentsSize(jobStore, fileID):
+    """Get the total size of a set of alignments (either a plain
+    alignments file or a manifest), or None if it isn't known."""
+    sizes = getAlignmentsPartSizes(jobStore, fileID)
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+def deleteAlignmentsManifest(fileStore, fileID):
+    """Delete a manifest and the part files it lists. A plain alignments
+    file is left alone, as is a manifest already deleted by an earlier
+    run of a restarted job."""
+    if not fileStore.jobStore.fileExists(fileID):
+        return
+    parts = readAlignmentsManifest(fileStore.jobStore, fileID)
+    if parts is None:
+        return
+    for part in parts:
+        fileStore.deleteGlobalFile(part)
+    fileStore.deleteGlobalFile(fileID)
+
+def isGlobalAlignmentFile(jobStore, fileID):
+    """Is the file in the job store a binary alignment file?"""
+    with jobStore.readFileStream(fileID) as f:
+        return isAlignmentFileHandle(f)
+
+def readGlobalAlignmentsFile(fileStore, fileID, binary=False):
+    """Read a set of alignments (either a plain alignments file or a
+    manifest, of cigar or binary alignment files) to a local file,
+    returning its path. The file is cigar, or a binary alignment file if
+    binary is set."""
+    parts = readAlignmentsManifest(fileStore.jobStore, fileID)
+    if parts is None and isGlobalAlignmentFile(fileStore.jobStore, fileID) == binary:
+        return fileStore.readGlobalFile(fileID)
+    alignmentsFile = fileStore.getLocalTempFile()
+    with open(alignmentsFile, 'wb') as output:
+        writeAlignments(fileStore.jobStore, getAlignmentsPartIDs(fileStore.jobStore, fileID), output, binary)
+    return alignmentsFile
+
+def writeAlignments(jobStore, resultsFileIDs, output, binary):
+    """Stream the alignments of a list of files in the job store into one
+    cigar or binary alignment file."""
+    if binary:
+        with AlignmentWriter(output) as writer:
+            for resultsFileID in resultsFileIDs:
+                with jobStore.readFileStream(resultsFileID) as f:
+                    for alignment in iterAlignmentsFromStream(f):
+                        writer.write(alignment)
+    else:
+        for resultsFileID in resultsFileIDs:
+            with jobStore.readFileStream(resultsFileID) as f:
+                copyStreamAsCigar(f, output)
 
 class CollateBlasts(RoundedJob):
+    """Collates the blast results, merging at most collateFanIn files per
+    job in a tree of jobs.
+    """
     def __init__(self, blastOptions, resultsFileIDs):
         super(CollateBlasts, self).__init__(preemptable=True)
         self.blastOptions = blastOptions
         self.resultsFileIDs = resultsFileIDs
 
     def run(self, fileStore):
-        return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs)).rv()
+        fanIn = max(2, self.blastOptions.collateFanIn)
+        if len(self.resultsFileIDs) <= fanIn:
+            resultsSize = None
+            if self.blastOptions.binaryAlignments and not self.blastOptions.collateManifest:
+                # Sized for the index of the merged alignments
+                resultsSizes = [getAlignmentsSize(fileStore.jobStore, resultsFileID)
+                                for resultsFileID in self.resultsFileIDs]
+                if None not in resultsSizes:
+                    resultsSize = sum(resultsSizes)
+            return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs,
+                                                   resultsSize=resultsSize)).rv()
+        groupIDs = [self.addChild(CollateBlasts(self.blastOptions, self.resultsFileIDs[i:i + fanIn])).rv()
+                    for i in xrange(0, len(self.resultsFileIDs), fanIn)]
+        return self.addFollowOn(CollateBlasts(self.blastOptions, groupIDs)).rv()
 
 class CollateBlasts2(RoundedJob):
-    """Collates all the blasts into a single alignments file.
+    """Collates a group of blast results into a single alignments file.
+
+    The results are streamed from the job store straight into the
+    output, so nothing is kept on the local disk. The output is a binary
+    alignment file if binaryAlignments is set, and cigar otherwise;
+    binary results are merged record by record, since they can't just
+    be concatenated, and the index of all of them is kept in memory
+    until the output is closed. If collateManifest is set, the results
+    are instead left where they are and a manifest listing them is
+    written, to be read with readGlobalAlignmentsFile.
     """
-    def __init__(self, blastOptions, resultsFileIDs):
-        disk = 8*sum([alignmentID.size for alignmentID in resultsFileIDs])
+    def __init__(self, blastOptions, resultsFileIDs, resultsSize=None):
         memory = blastOptions.memory
-        super(CollateBlasts2, self).__init__(memory=memory, disk=disk, preemptable=True)
+        if blastOptions.binaryAlignments and not blastOptions.collateManifest and resultsSize is not None:
+            memory = max(memory or 0, estimateWriterMemory(resultsSize))
+        super(CollateBlasts2, self).__init__(memory=memory, preemptable=True)
+        self.blastOptions = blastOptions
         self.resultsFileIDs = resultsFileIDs
-    
+
     def run(self, fileStore):
         logger.info("Results IDs: %s" % self.resultsFileIDs)
-        resultsFiles = [readGlobalFileWithoutCache(fileStore, fileID) for fileID in self.resultsFileIDs]
-        collatedResultsFile = fileStore.getLocalTempFile()
-        catFiles(resultsFiles, collatedResultsFile)
-        logger.info("Collated the alignments to the file: %s",  collatedResultsFile)
-        collatedResultsID = fileStore.writeGlobalFile(collatedResultsFile)
+        if self.blastOptions.collateManifest:
+            return self.collateManifest(fileStore)
+        # Results that are manifests (such as the accumulated outgroup
+        # results) are read from the parts they list
+        resultsPartIDs = []
         for resultsFileID in self.resultsFileIDs:
+            resultsPartIDs.extend(getAlignmentsPartIDs(fileStore.jobStore, resultsFileID))
+        with fileStore.writeGlobalFileStream() as (output, collatedResultsID):
+            writeAlignments(fileStore.jobStore, resultsPartIDs, output,
+                            self.blastOptions.binaryAlignments)
+        logger.info("Collated the alignments to the file: %s",  collatedResultsID)
+        for resultsFileID in set(map(str, self.resultsFileIDs + resultsPartIDs)):
             fileStore.deleteGlobalFile(resultsFileID)
         return collatedResultsID
 
+    def collateManifest(self, fileStore):
+        """Write a manifest of the parts of all the results. Manifests
+        among the results are replaced by the parts they list, so there
+        is only ever one level of manifest."""
+        parts = []
+        sizes = []
+        for resultsFileID in self.resultsFileIDs:
+            resultsParts = readAlignmentsManifest(fileStore.jobStore, resultsFileID)
+            sizes.extend(getAlignmentsPartSizes(fileStore.jobStore, resultsFileID))
+            if resultsParts is None:
+                parts.append(str(resultsFileID))
+            else:
+                parts.extend(resultsParts)
+                fileStore.deleteGlobalFile(resultsFileID)
+        manifestID = writeAlignmentsManifest(fileStore, parts, sizes)
+        logger.info("Collated the alignments to the manifest %s of %i parts", manifestID, len(parts))
+        return manifestID
+
 def sequenceLength(sequenceFile):
     """Get the total # of bp from a fasta file."""
-    seqLength = 0
-    for line in open(sequenceFile):
-        line = line.strip()
-        if line == '' or line[0] == '>':
-            continue
-        seqLength += len(line)
-    return seqLength
+    with FastaFile(sequenceFile) as fastaFile:
+        return sum(record.length for record in fastaFile)
 
 def percentCoverage(sequenceFile, coverageFile):
     """Get the % coverage of a sequence from a coverage file."""
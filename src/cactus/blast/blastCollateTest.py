@@ -0,0 +1,157 @@
+import os
+import uuid
+import shutil
+import unittest
+from contextlib import contextmanager
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.blast.blast import BlastOptions, CollateBlasts2, readGlobalAlignmentsFile, \
+                               getAlignmentsPartIDs, writeAlignmentsManifest, \
+                               deleteAlignmentsManifest, getAlignmentsSize
+from cactus.blast.alignmentFile import AlignmentReader, AlignmentWriter, parseCigarLine, formatCigarLine
+
+class FakeFileID(str):
+    """A file ID that, like Toil's, knows the size of its file."""
+    def __new__(cls, fileID, size):
+        self = str.__new__(cls, fileID)
+        self.size = size
+        return self
+
+class FakeJobStore(object):
+    def __init__(self, tempDir):
+        self.tempDir = tempDir
+
+    @contextmanager
+    def readFileStream(self, fileID):
+        with open(os.path.join(self.tempDir, fileID)) as f:
+            yield f
+
+    def fileExists(self, fileID):
+        return os.path.exists(os.path.join(self.tempDir, fileID))
+
+class FakeFileStore(object):
+    """Just enough of a file store to collate blast results."""
+    def __init__(self, tempDir):
+        self.jobStore = FakeJobStore(tempDir)
+        self.tempDir = tempDir
+
+    def getLocalTempFile(self):
+        return os.path.join(getTempDirectory(self.tempDir), "tmp")
+
+    def readGlobalFile(self, fileID):
+        localPath = self.getLocalTempFile()
+        shutil.copyfile(os.path.join(self.tempDir, fileID), localPath)
+        return localPath
+
+    def writeFile(self, contents):
+        fileID = FakeFileID(uuid.uuid4(), len(contents))
+        with open(os.path.join(self.tempDir, fileID), 'w') as f:
+            f.write(contents)
+        return fileID
+
+    @contextmanager
+    def writeGlobalFileStream(self):
+        fileID = str(uuid.uuid4())
+        with open(os.path.join(self.tempDir, fileID), 'w') as f:
+            yield f, fileID
+
+    def deleteGlobalFile(self, fileID):
+        os.remove(os.path.join(self.tempDir, fileID))
+
+    def exists(self, fileID):
+        return os.path.exists(os.path.join(self.tempDir, fileID))
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.fileStore = FakeFileStore(self.tempDir)
+        self.results = ["cigar: a 0 10 + b 0 10 + 10 M 10\n" * i for i in xrange(1, 6)]
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def readAlignments(self, fileID):
+        with open(readGlobalAlignmentsFile(self.fileStore, fileID)) as f:
+            return f.read()
+
+    def testStreamingCollation(self):
+        resultsIDs = [self.fileStore.writeFile(results) for results in self.results]
+        collatedID = CollateBlasts2(BlastOptions(), resultsIDs).run(self.fileStore)
+        self.assertEquals("".join(self.results), self.readAlignments(collatedID))
+        self.assertEquals([collatedID], getAlignmentsPartIDs(self.fileStore.jobStore, collatedID))
+        # A plain alignments file isn't a manifest to delete
+        deleteAlignmentsManifest(self.fileStore, collatedID)
+        self.assertTrue(self.fileStore.exists(collatedID))
+        for resultsID in resultsIDs:
+            self.assertFalse(self.fileStore.exists(resultsID))
+
+    def testManifestCollation(self):
+        blastOptions = BlastOptions(collateManifest=True)
+        resultsIDs = [self.fileStore.writeFile(results) for results in self.results]
+        # Collate in two levels, as the tree of collation jobs would
+        firstID = CollateBlasts2(blastOptions, resultsIDs[:2]).run(self.fileStore)
+        secondID = CollateBlasts2(blastOptions, resultsIDs[2:]).run(self.fileStore)
+        manifestID = CollateBlasts2(blastOptions, [firstID, secondID]).run(self.fileStore)
+        self.assertEquals(resultsIDs, getAlignmentsPartIDs(self.fileStore.jobStore, manifestID))
+        self.assertEquals("".join(self.results), self.readAlignments(manifestID))
+        # Only the intermediate manifests are removed
+        self.assertFalse(self.fileStore.exists(firstID))
+        self.assertFalse(self.fileStore.exists(secondID))
+        for resultsID in resultsIDs:
+            self.assertTrue(self.fileStore.exists(resultsID))
+        # Once the alignments have been read, the manifest and its parts
+        # can be deleted
+        deleteAlignmentsManifest(self.fileStore, manifestID)
+        self.assertFalse(self.fileStore.exists(manifestID))
+        for resultsID in resultsIDs:
+            self.assertFalse(self.fileStore.exists(resultsID))
+        # Again, as a restarted job would
+        deleteAlignmentsManifest(self.fileStore, manifestID)
+
+    def testAlignmentsSize(self):
+        """The size of a set of alignments is known through the manifests
+        listing it, but not when a part's size is unknown."""
+        blastOptions = BlastOptions(collateManifest=True)
+        resultsIDs = [self.fileStore.writeFile(results) for results in self.results]
+        self.assertEquals(len(self.results[0]), getAlignmentsSize(self.fileStore.jobStore, resultsIDs[0]))
+        firstID = CollateBlasts2(blastOptions, resultsIDs[:2]).run(self.fileStore)
+        secondID = CollateBlasts2(blastOptions, resultsIDs[2:]).run(self.fileStore)
+        manifestID = CollateBlasts2(blastOptions, [firstID, secondID]).run(self.fileStore)
+        self.assertEquals(len("".join(self.results)), getAlignmentsSize(self.fileStore.jobStore, manifestID))
+        unsizedID = writeAlignmentsManifest(self.fileStore, resultsIDs[:2])
+        self.assertEquals(None, getAlignmentsSize(self.fileStore.jobStore, unsizedID))
+
+    def testCollatingManifests(self):
+        """Results that are manifests, like the accumulated outgroup
+        results, are collated from their parts."""
+        resultsIDs = [self.fileStore.writeFile(results) for results in self.results]
+        manifestID = writeAlignmentsManifest(self.fileStore, resultsIDs[1:4])
+        collatedID = CollateBlasts2(BlastOptions(), [resultsIDs[0], manifestID, resultsIDs[4]]).run(self.fileStore)
+        self.assertEquals("".join(self.results), self.readAlignments(collatedID))
+        self.assertFalse(self.fileStore.exists(manifestID))
+        for resultsID in resultsIDs:
+            self.assertFalse(self.fileStore.exists(resultsID))
+
+    def testBinaryCollation(self):
+        """Binary results are merged, with any cigar results, into a
+        binary alignment file, which can be read back as cigar."""
+        resultsIDs = []
+        for i, results in enumerate(self.results):
+            if i % 2 == 0:
+                resultsIDs.append(self.fileStore.writeFile(results))
+                continue
+            with self.fileStore.writeGlobalFileStream() as (output, resultsID):
+                with AlignmentWriter(output) as writer:
+                    for line in results.splitlines():
+                        writer.write(parseCigarLine(line))
+            resultsIDs.append(resultsID)
+        collatedID = CollateBlasts2(BlastOptions(binaryAlignments=True), resultsIDs).run(self.fileStore)
+        with AlignmentReader(readGlobalAlignmentsFile(self.fileStore, collatedID, binary=True)) as reader:
+            self.assertEquals("".join(self.results), "".join(map(formatCigarLine, reader)))
+        self.assertEquals("".join(self.results), self.readAlignments(collatedID))
+
+if __name__ == '__main__':
+    unittest.main()
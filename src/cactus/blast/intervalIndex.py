@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""An index of sorted, non-overlapping intervals on each of a set of
+contigs, for finding the interval containing each of a batch of
+positions by binary search.
+
+The interval starts and ends of each contig are kept in sorted NumPy
+arrays if NumPy is installed, so a whole batch of positions on a contig
+is looked up with one searchsorted call, and in sorted lists searched
+with bisect otherwise.
+"""
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class IntervalIndex(object):
+    def __init__(self, intervals):
+        """Takes a dict of contig -> [(start, non-inclusive end)]. The
+        intervals of a contig mustn't overlap."""
+        self.starts = {}
+        self.ends = {}
+        for contig, contigIntervals in intervals.items():
+            contigIntervals = sorted(contigIntervals)
+            for i in xrange(1, len(contigIntervals)):
+                if contigIntervals[i][0] < contigIntervals[i - 1][1]:
+                    raise RuntimeError("Overlapping intervals %s and %s on %s" %
+                                       (contigIntervals[i - 1], contigIntervals[i], contig))
+            starts = [interval[0] for interval in contigIntervals]
+            ends = [interval[1] for interval in contigIntervals]
+            if numpy is not None:
+                starts = numpy.array(starts, dtype=numpy.int64)
+                ends = numpy.array(ends, dtype=numpy.int64)
+            self.starts[contig] = starts
+            self.ends[contig] = ends
+
+    def __contains__(self, contig):
+        return contig in self.starts
+
+    def findContaining(self, contig, positions):
+        """Get the (start, end) of the interval of the contig containing
+        each of a list of positions, or None for those not in any
+        interval."""
+        starts = self.starts[contig]
+        ends = self.ends[contig]
+        if numpy is not None:
+            if len(starts) == 0:
+                return [None] * len(positions)
+            positions = numpy.asarray(positions, dtype=numpy.int64)
+            # The last interval starting at or before each position (or the
+            # first interval, for positions before it)
+            found = numpy.maximum(numpy.searchsorted(starts, positions, side='right') - 1, 0)
+            intervalStarts = starts[found]
+            intervalEnds = ends[found]
+            contained = (positions >= intervalStarts) & (positions < intervalEnds)
+            return [(start, end) if isContained else None
+                    for start, end, isContained in zip(intervalStarts.tolist(), intervalEnds.tolist(),
+                                                       contained.tolist())]
+        ret = []
+        for position in positions:
+            i = bisect.bisect_right(starts, position) - 1
+            ret.append((starts[i], ends[i]) if i >= 0 and position < ends[i] else None)
+        return ret
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""The steps of one round of aligning the ingroups to a succession of
+outgroups (see TrimAndRecurseOnOutgroups in blast.py), fused so that the
+round's alignments are read twice in all, rather than once by each
+cactus_coverage, coordinate conversion and append, for each ingroup.
+
+The first pass calculates the coverage of the alignments on the outgroup,
+which is trimmed to it, and splits the alignments up by the ingroup they
+are on, so the rest of the round can be done for each ingroup in
+parallel. The second, over an ingroup's alignments, calculates their
+coverage on the trimmed ingroup, converts them to the coordinates of the
+trimmed outgroup and of the untrimmed ingroup and adds them to the
+cumulative coverage on the untrimmed ingroup, which carries on from the
+previous round's coverage rather than being recalculated from all the
+alignments so far.
+"""
+from cactus.shared.fasta import FastaFile
+from cactus.blast.intervalIndex import IntervalIndex
+from cactus.blast.trimSequences import trimSequencesToBlocks
+from cactus.blast.upconvertCoordinates import UPCONVERT_BATCH_SIZE, getSequenceRanges, \
+                                             iterCigarFields, iterBatches, convertFields, \
+                                             downconvertFields, writeBatch
+
+def getContigIngroups(ingroupPaths):
+    """Get a dict of the name of each sequence of a list of ingroup FASTA
+    files to the index of the ingroup it is in."""
+    contigIngroups = {}
+    for i, path in enumerate(ingroupPaths):
+        with FastaFile(path) as fastaFile:
+            for record in fastaFile:
+                contigIngroups[record.name] = i
+    return contigIngroups
+
+def partitionAlignments(alignmentsPath, outgroupCoverage, contigIngroups, outputFiles):
+    """Add the alignments of a cigar or binary alignment file to the
+    coverage on the outgroup, in one pass, writing each of them as cigar
+    to the one of outputFiles for the ingroup it is on (see
+    getContigIngroups). Returns the number of alignments written to each."""
+    numAlignments = [0] * len(outputFiles)
+    for batch in iterBatches(iterCigarFields(alignmentsPath)):
+        batches = [[] for outputFile in outputFiles]
+        for fields in batch:
+            outgroupCoverage.addAlignment(fields)
+            ingroup = contigIngroups.get(fields[1], contigIngroups.get(fields[5]))
+            if ingroup is None:
+                raise RuntimeError("Alignment between %s and %s is on none of the ingroups" %
+                                   (fields[1], fields[5]))
+            batches[ingroup].append(fields)
+        for i, outputFile in enumerate(outputFiles):
+            numAlignments[i] += writeBatch(batches[i], outputFile)
+    return numAlignments
+
+def trimOutgroup(outgroupPath, outgroupCoverage, trimmedOutgroupPath, flanking):
+    """Write the regions of the outgroup covered by the round's alignments,
+    plus flanking bases, as trimmed sequences named contig|start."""
+    # The windowSize and threshold are fixed at 1: anything more
+    # and we will run into problems with alignments that aren't
+    # covered in a matching trimmed sequence.
+    trimSequencesToBlocks(outgroupPath, outgroupCoverage.getBlocks(), trimmedOutgroupPath,
+                          flanking=flanking, windowSize=1, threshold=1)
+
+def convertRoundAlignments(alignmentsPath, trimmedOutgroupPath, convertIngroups, outputFile,
+                           trimmedCoverages=(), coverages=(), batchSize=UPCONVERT_BATCH_SIZE):
+    """Write the alignments of a cigar or binary alignment file as cigar,
+    converting sequence 1 (the outgroup, which lastz puts first) to the
+    trimmed outgroup sequence containing it, and then, if convertIngroups
+    is set, sequence 2 from the trimmed ingroup sequence it is on back to
+    the one it was cut from, as cactus_blast_convertCoordinates
+    --onlyContig1 did (its contig 1 being the second on the line). The
+    alignments are added to each of a list of AlignmentCoverages before
+    they are converted, and to each of another after. Returns the number
+    of alignments."""
+    trimmedIndex = IntervalIndex(getSequenceRanges(trimmedOutgroupPath))
+    numAlignments = 0
+    for batch in iterBatches(iterCigarFields(alignmentsPath), batchSize):
+        for fields in batch:
+            for coverage in trimmedCoverages:
+                coverage.addAlignment(fields)
+        convertFields(batch, trimmedIndex, 1)
+        if convertIngroups:
+            downconvertFields(batch, 2)
+        for fields in batch:
+            for coverage in coverages:
+                coverage.addAlignment(fields)
+        numAlignments += writeBatch(batch, outputFile)
+    return numAlignments
@@ -0,0 +1,120 @@
+import os
+import unittest
+from StringIO import StringIO
+from textwrap import dedent
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.blast.alignmentCoverage import getFastaCoverage
+from cactus.blast.outgroupRound import getContigIngroups, partitionAlignments, trimOutgroup, \
+                                       convertRoundAlignments
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.outgroupPath = self.writeFile("outgroup.fa", ">id=9|out\n" + "ACGT" * 10 + "\n")
+        self.ingroupPath = self.writeFile("ingroup.fa", ">id=0|ing\n" + "ACG" * 10 + "\n")
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def writeFile(self, name, text):
+        path = os.path.join(self.tempDir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def runRound(self, name, alignments, trimmedIngroupPath, ingroupCoverage, convertIngroups, flanking):
+        """Run the steps of a round, returning the trimmed outgroup, the
+        converted alignments and the coverage on the trimmed ingroups."""
+        alignmentsPath = self.writeFile(name + ".cigar", alignments)
+        outgroupCoverage = getFastaCoverage(self.outgroupPath)
+        ingroupAlignments = StringIO()
+        self.assertEquals([len(alignments.splitlines())],
+                          partitionAlignments(alignmentsPath, outgroupCoverage,
+                                              getContigIngroups([trimmedIngroupPath]), [ingroupAlignments]))
+        ingroupAlignmentsPath = self.writeFile(name + ".ingroup.cigar", ingroupAlignments.getvalue())
+        trimmedOutgroupPath = os.path.join(self.tempDir, name + ".trimmed.fa")
+        trimOutgroup(self.outgroupPath, outgroupCoverage, trimmedOutgroupPath, flanking=flanking)
+        trimmedIngroupCoverage = getFastaCoverage(trimmedIngroupPath)
+        converted = StringIO()
+        convertRoundAlignments(ingroupAlignmentsPath, trimmedOutgroupPath, convertIngroups, converted,
+                               trimmedCoverages=[trimmedIngroupCoverage], coverages=[ingroupCoverage],
+                               batchSize=1)
+        with open(trimmedOutgroupPath) as f:
+            return f.read(), converted.getvalue(), trimmedIngroupCoverage.getPercentCoverage()
+
+    def testRounds(self):
+        ingroupCoverage = getFastaCoverage(self.ingroupPath)
+        # On the first round, the outgroup coordinates are converted to
+        # the trimmed outgroup
+        trimmedOutgroup, converted, percentCoverage = self.runRound("round1", dedent('''\
+        cigar: id=9|out 5 10 + id=0|ing 0 5 + 1 M 5
+        cigar: id=9|out 30 20 - id=0|ing 10 20 + 1 M 10
+        '''), self.ingroupPath, ingroupCoverage, convertIngroups=False, flanking=2)
+        self.assertEquals(">id=9|out|3\nTACGTACGT\n>id=9|out|18\nGTACGTACGTACGT\n", trimmedOutgroup)
+        self.assertEquals(dedent('''\
+        cigar: id=9|out|3 2 7 + id=0|ing 0 5 + 1 M 5
+        cigar: id=9|out|18 12 2 - id=0|ing 10 20 + 1 M 10
+        '''), converted)
+        self.assertEquals(50.0, percentCoverage)
+        bed = StringIO()
+        ingroupCoverage.writeBed(bed)
+
+        # On the next, the coverage carries on from the first round's, and
+        # the trimmed ingroup coordinates are converted back
+        ingroupCoverage = getFastaCoverage(self.ingroupPath)
+        ingroupCoverage.addBed(StringIO(bed.getvalue()))
+        trimmedIngroupPath = self.writeFile("trimmedIngroup.fa", ">id=0|ing|10\nACGACGACGA\n>id=0|ing|25\nCGACG\n")
+        trimmedOutgroup, converted, percentCoverage = self.runRound("round2", dedent('''\
+        cigar: id=9|out 0 4 + id=0|ing|10 2 6 + 1 M 4
+        cigar: id=9|out 35 40 + id=0|ing|25 0 5 + 1 M 5
+        '''), trimmedIngroupPath, ingroupCoverage, convertIngroups=True, flanking=0)
+        self.assertEquals(">id=9|out|0\nACGT\n>id=9|out|35\nTACGT\n", trimmedOutgroup)
+        self.assertEquals(dedent('''\
+        cigar: id=9|out|0 0 4 + id=0|ing 12 16 + 1 M 4
+        cigar: id=9|out|35 0 5 + id=0|ing 25 30 + 1 M 5
+        '''), converted)
+        self.assertEquals(60.0, percentCoverage)
+        bed = StringIO()
+        ingroupCoverage.writeBed(bed)
+        self.assertEquals(dedent('''\
+        id=0|ing\t0\t5\t\t1
+        id=0|ing\t10\t12\t\t1
+        id=0|ing\t12\t16\t\t2
+        id=0|ing\t16\t20\t\t1
+        id=0|ing\t25\t30\t\t1
+        '''), bed.getvalue())
+
+    def testPartition(self):
+        """The alignments are split up by the ingroup they are on, whichever
+        sequence of the alignment it is."""
+        otherIngroupPath = self.writeFile("other.fa", ">id=1|other|0\nACGT\n>id=1|other|8\nACGT\n")
+        contigIngroups = getContigIngroups([self.ingroupPath, otherIngroupPath])
+        self.assertEquals({"id=0|ing": 0, "id=1|other|0": 1, "id=1|other|8": 1}, contigIngroups)
+        alignmentsPath = self.writeFile("alignments.cigar", dedent('''\
+        cigar: id=9|out 0 4 + id=1|other|8 0 4 + 1 M 4
+        cigar: id=0|ing 0 4 + id=9|out 4 8 + 1 M 4
+        cigar: id=9|out 8 12 + id=1|other|0 0 4 + 1 M 4
+        '''))
+        outgroupCoverage = getFastaCoverage(self.outgroupPath)
+        outputs = [StringIO(), StringIO()]
+        self.assertEquals([1, 2], partitionAlignments(alignmentsPath, outgroupCoverage, contigIngroups, outputs))
+        self.assertEquals("cigar: id=0|ing 0 4 + id=9|out 4 8 + 1 M 4\n", outputs[0].getvalue())
+        self.assertEquals(dedent('''\
+        cigar: id=9|out 0 4 + id=1|other|8 0 4 + 1 M 4
+        cigar: id=9|out 8 12 + id=1|other|0 0 4 + 1 M 4
+        '''), outputs[1].getvalue())
+        self.assertEquals(30.0, outgroupCoverage.getPercentCoverage())
+        alignmentsPath = self.writeFile("unknown.cigar", "cigar: id=9|out 0 4 + id=2|unknown 0 4 + 1 M 4\n")
+        self.assertRaises(RuntimeError, partitionAlignments, alignmentsPath, outgroupCoverage,
+                          contigIngroups, outputs)
+
+    def testUntrimmedIngroupName(self):
+        self.assertRaises(RuntimeError, self.runRound, "round", "cigar: id=9|out 0 4 + id=0|ing 0 4 + 1 M 4\n",
+                          self.ingroupPath, getFastaCoverage(self.ingroupPath), convertIngroups=True, flanking=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,16 @@
 #!/usr/bin/env python
 from collections import defaultdict
 from operator import itemgetter
+from cactus.shared.fasta import FastaFile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of positions whose window scores are computed at once by the
+# NumPy window filter, which bounds its memory use
+WINDOW_FILTER_CHUNK_SIZE = 2**22
 
 def windowFilter(windowSize, threshold, blockDict, seqLengths):
     if windowSize == 1 and threshold == 1:
@@ -8,27 +18,102 @@ def windowFilter(windowSize, threshold, blockDict, seqLengths):
         return blockDict
     ret = defaultdict(list)
     for seq, blocks in blockDict.items():
-        curBlock = 0
-        inRegion = False
-        regionStart = 0
-        for i in xrange(seqLengths[seq]):
-            score = 0
-            while curBlock < len(blocks) and blocks[curBlock][1] < i:
-                curBlock += 1
-            for blockNum in xrange(curBlock, len(blocks)):
-                block = blocks[blockNum]
-                if block[0] > i + windowSize:
-                    break
-                size = min(block[1], i + windowSize) - max(i, block[0])
-                if block[2] >= 1:
-                    score += size
-            score /= float(windowSize)
-            if score >= threshold and not inRegion:
+        if numpy is not None and windowSize >= 1 and isSortedAndDisjoint(blocks):
+            regions = windowFilterSequenceNumpy(windowSize, threshold, blocks, seqLengths[seq])
+        else:
+            regions = windowFilterSequence(windowSize, threshold, blocks, seqLengths[seq])
+        if len(regions) > 0:
+            ret[seq] = regions
+    return ret
+
+def windowFilterSequence(windowSize, threshold, blocks, seqLength):
+    """Get the regions of a sequence where the fraction of each window
+    covered by the blocks is at least threshold. A region still open at
+    the end of the sequence is left out."""
+    ret = []
+    curBlock = 0
+    inRegion = False
+    regionStart = 0
+    for i in xrange(seqLength):
+        score = 0
+        while curBlock < len(blocks) and blocks[curBlock][1] < i:
+            curBlock += 1
+        for blockNum in xrange(curBlock, len(blocks)):
+            block = blocks[blockNum]
+            if block[0] > i + windowSize:
+                break
+            size = min(block[1], i + windowSize) - max(i, block[0])
+            if block[2] >= 1:
+                score += size
+        score /= float(windowSize)
+        if score >= threshold and not inRegion:
+            regionStart = i
+            inRegion = True
+        elif score < threshold and inRegion:
+            ret.append((regionStart, i + windowSize - 1))
+            inRegion = False
+    return ret
+
+def isSortedAndDisjoint(blocks):
+    """Are the blocks sorted and non-overlapping? The NumPy window filter
+    only gives the same regions as windowFilterSequence for these."""
+    prevEnd = None
+    for block in blocks:
+        if block[0] > block[1] or (prevEnd is not None and block[0] < prevEnd):
+            return False
+        prevEnd = block[1]
+    return True
+
+def windowFilterSequenceNumpy(windowSize, threshold, blocks, seqLength,
+                              chunkSize=WINDOW_FILTER_CHUNK_SIZE):
+    """Same as windowFilterSequence, for sorted, non-overlapping blocks,
+    but scoring each chunk of windows at once with NumPy.
+
+    The coverage of the chunk (and the window past its end) is built as
+    runs of uncovered and covered positions between the block starts and
+    ends, and the number of covered positions in each window is then the
+    difference of two entries of its cumulative sum."""
+    # The fewest covered positions that put a window in a region, found
+    # with the same floating-point division as windowFilterSequence
+    minCovered = windowSize + 1
+    for covered in xrange(windowSize + 1):
+        if covered / float(windowSize) >= threshold:
+            minCovered = covered
+            break
+    blocks = [block for block in blocks if block[2] >= 1]
+    starts = numpy.array([block[0] for block in blocks], dtype=numpy.int64)
+    ends = numpy.array([block[1] for block in blocks], dtype=numpy.int64)
+    ret = []
+    inRegion = False
+    regionStart = 0
+    for chunkStart in xrange(0, seqLength, chunkSize):
+        chunkLength = min(chunkSize, seqLength - chunkStart)
+        coverageLength = chunkLength + windowSize
+        # Blocks overlapping the chunk and its last window
+        first = numpy.searchsorted(ends, chunkStart, side='right')
+        last = numpy.searchsorted(starts, chunkStart + coverageLength, side='left')
+        boundaries = numpy.empty(2 * (last - first) + 2, dtype=numpy.int64)
+        boundaries[0] = 0
+        boundaries[1:-1:2] = starts[first:last] - chunkStart
+        boundaries[2:-1:2] = ends[first:last] - chunkStart
+        boundaries[-1] = coverageLength
+        numpy.clip(boundaries, 0, coverageLength, out=boundaries)
+        runs = numpy.zeros(len(boundaries) - 1, dtype=numpy.int8)
+        runs[1::2] = 1
+        coverage = numpy.repeat(runs, numpy.diff(boundaries))
+        covered = numpy.zeros(coverageLength + 1, dtype=numpy.int32)
+        numpy.cumsum(coverage, dtype=numpy.int32, out=covered[1:])
+        inRegions = covered[windowSize:coverageLength] - covered[:chunkLength] >= minCovered
+        # The positions where windows go in or out of a region
+        changes = numpy.flatnonzero(inRegions[1:] != inRegions[:-1]) + 1
+        if inRegions[0] != inRegion:
+            changes = numpy.concatenate(([0], changes))
+        for i in (changes + chunkStart).tolist():
+            if inRegion:
+                ret.append((regionStart, i + windowSize - 1))
+            else:
                 regionStart = i
-                inRegion = True
-            elif score < threshold and inRegion:
-                ret[seq].append((regionStart, i + windowSize - 1))
-                inRegion = False
+            inRegion = not inRegion
     return ret
 
 def uniquifyBlocks(blocksDict, mergeDistance):
@@ -88,16 +173,8 @@ def getSeparateBedBlocks(bedFile, depth=1):
 def getSeqLengths(fastaFile):
     """Get a dict which maps header -> sequence size."""
     ret = defaultdict(int)
-    chr = ""
-    for line in fastaFile:
-        line = line.strip()
-        if len(line) == 0:
-            # Blank line
-            continue
-        if line[0] == '>':
-            chr = line.split()[0][1:]
-        else:
-            ret[chr] += len(line)
+    for record in fastaFile:
+        ret[record.name] += record.length
     return ret
 
 def complementBlocks(blocksDict, seqLengths):
@@ -117,37 +194,32 @@ def complementBlocks(blocksDict, seqLengths):
             ret[chr].append((0, len))
     return ret
 
-def printTrimmedSeq(header, seq, blocks, outFile):
+def printTrimmedSeq(fastaFile, record, blocks, outFile):
     for block in blocks:
-        outFile.write(">%s|%d\n" % (header, block[0]))
-        outFile.write(seq[block[0]:block[1]])
+        outFile.write(">%s|%d\n" % (record.name, block[0]))
+        for chunk in fastaFile.iterSequence(record, block[0], block[1]):
+            outFile.write(chunk)
         outFile.write("\n")
 
 def printTrimmedFasta(fastaFile, toTrim, outFile):
-    header = None
-    seq = None
-    for line in fastaFile:
-        line = line.strip()
-        if len(line) == 0:
-            # Blank line
-            continue
-        if line[0] == '>':
-            if seq is not None:
-                printTrimmedSeq(header, seq, toTrim[header], outFile)
-            seq = ""
-            header = line[1:].split()[0]
-            continue
-        seq += line
-    if seq is not None:
-        printTrimmedSeq(header, seq, toTrim[header], outFile)
+    for record in fastaFile:
+        printTrimmedSeq(fastaFile, record, toTrim[record.name], outFile)
 
 def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
                   windowSize=10, threshold=0.8, depth=1, complement=False):
-    fastaFile = open(fastaPath)
-    seqLengths = getSeqLengths(fastaFile)
     with open(bedPath) as bedFile:
-        toTrim = windowFilter(windowSize, threshold,
-                              getSeparateBedBlocks(bedFile, depth), seqLengths)
+        blocks = getSeparateBedBlocks(bedFile, depth)
+    trimSequencesToBlocks(fastaPath, blocks, outputPathOrFile, flanking=flanking,
+                          minSize=minSize, windowSize=windowSize, threshold=threshold,
+                          complement=complement)
+
+def trimSequencesToBlocks(fastaPath, blocks, outputPathOrFile, flanking=0, minSize=0,
+                          windowSize=10, threshold=0.8, complement=False):
+    """Trim the sequences given a dict of sequence -> (start, stop, score)
+    covered blocks, already filtered for depth, rather than a BED file."""
+    fastaFile = FastaFile(fastaPath)
+    seqLengths = getSeqLengths(fastaFile)
+    toTrim = windowFilter(windowSize, threshold, blocks, seqLengths)
     if complement:
         toTrim = complementBlocks(toTrim, seqLengths)
     toTrim = uniquifyBlocks(toTrim, 2*flanking)
@@ -160,7 +232,6 @@ def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
                           v))
                   for k, v in toTrim.items())
 
-    fastaFile.seek(0)
     try:
         outputPathOrFile.write('')
         outputFile = outputPathOrFile
@@ -168,3 +239,4 @@ def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
         # Not a file
         outputFile = open(outputPathOrFile, 'w')
     printTrimmedFasta(fastaFile, toTrim, outputFile)
+    fastaFile.close()
@@ -1,9 +1,12 @@
+import random
 import unittest
 from StringIO import StringIO
 from textwrap import dedent
 from sonLib.bioio import getTempFile
 from cactus.shared.test import silentOnSuccess
-from cactus.blast.trimSequences import trimSequences
+from cactus.blast.trimSequences import trimSequences, windowFilterSequence, \
+                                       windowFilterSequenceNumpy, isSortedAndDisjoint
+from cactus.blast import trimSequences as trimSequencesModule
 import os
 
 class TestCase(unittest.TestCase):
@@ -109,5 +112,32 @@ class TestCase(unittest.TestCase):
         >seq1|15
         G''') in output.getvalue())
 
+    def testIsSortedAndDisjoint(self):
+        self.assertTrue(isSortedAndDisjoint([]))
+        self.assertTrue(isSortedAndDisjoint([(0, 5, 1), (5, 5, 1), (7, 10, 2)]))
+        self.assertFalse(isSortedAndDisjoint([(0, 5, 1), (4, 10, 1)]))
+        self.assertFalse(isSortedAndDisjoint([(6, 10, 1), (0, 5, 1)]))
+        self.assertFalse(isSortedAndDisjoint([(5, 0, 1)]))
+
+    @unittest.skipIf(trimSequencesModule.numpy is None, "NumPy is not installed")
+    def testNumpyWindowFilter(self):
+        """The NumPy window filter finds exactly the same regions as the
+        original one, including across the chunks it works in."""
+        random.seed(1)
+        for i in xrange(50):
+            seqLength = random.randint(0, 500)
+            blocks = []
+            pos = random.randint(0, 10)
+            while pos < seqLength + 20:
+                end = pos + random.randint(0, 30)
+                blocks.append((pos, end, random.choice([0, 1, 2])))
+                pos = end + random.randint(0, 30)
+            for windowSize in (1, 2, 10, 37):
+                for threshold in (0.0, 0.5, 0.8, 1.0):
+                    expected = windowFilterSequence(windowSize, threshold, blocks, seqLength)
+                    for chunkSize in (1, 7, 1000):
+                        self.assertEquals(expected, windowFilterSequenceNumpy(windowSize, threshold, blocks,
+                                                                              seqLength, chunkSize=chunkSize))
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,110 +1,140 @@
 #!/usr/bin/env python
+"""Converts the coordinates of a set of alignments so that they refer to
+the trimmed sequences cut from their contigs rather than to the contigs
+themselves.
+"""
 from argparse import ArgumentParser
 from collections import defaultdict
-import sys
 import os
-from sonLib.bioio import cigarRead, cigarWrite, getTempFile, system
+import time
+from cactus.blast.alignmentFile import isAlignmentFile, readAlignments, getCigarFields
+from cactus.blast.intervalIndex import IntervalIndex
+from cactus.shared.fasta import FastaFile
 
-def getSequenceRanges(fa):
+# Number of alignments whose trimmed sequences are looked up at once
+UPCONVERT_BATCH_SIZE = 100000
+
+def getSequenceRanges(fastaPath):
     """Get dict of (untrimmed header) -> [(start, non-inclusive end)] mappings
     from a trimmed fasta."""
     ret = defaultdict(list)
-    curSeq = ""
-    curHeader = None
-    curTrimmedStart = None
-    for line in fa:
-        line = line.strip()
-        if line == '':
-            continue
-        if line[0] == '>':
-            if curHeader is not None:
-                # Add previous seq info to dict
-                trimmedRange = (curTrimmedStart,
-                                curTrimmedStart + len(curSeq))
-                untrimmedHeader = "|".join(curHeader.split("|")[:-1])
-                ret[untrimmedHeader].append(trimmedRange)
-            curHeader = line[1:].split()[0]
-            curTrimmedStart = int(curHeader.split('|')[-1])
-            curSeq = ""
-        else:
-            curSeq += line
-    if curHeader is not None:
-        # Add final seq info to dict
-        trimmedRange = (curTrimmedStart,
-                        curTrimmedStart + len(curSeq))
-        untrimmedHeader = "|".join(curHeader.split("|")[:-1])
-        ret[untrimmedHeader].append(trimmedRange)
+    with FastaFile(fastaPath) as fastaFile:
+        for record in fastaFile:
+            trimmedStart = int(record.name.split('|')[-1])
+            untrimmedHeader = "|".join(record.name.split("|")[:-1])
+            ret[untrimmedHeader].append((trimmedStart, trimmedStart + record.length))
     for key in ret.keys():
         # Sort by range's start pos
         ret[key] = sorted(ret[key], key=lambda x: x[0])
     return ret
 
-def validateRanges(seqRanges):
-    """Fail if the given range dict contains overlapping ranges or if the
-    ranges aren't sorted.
-    """
-    for seq, ranges in seqRanges.items():
-        for i, range in enumerate(ranges):
-            start = range[0]
-            if i - 1 >= 0:
-                range2 = ranges[i - 1]
-                assert start >= range2[1]
-            if i + 1 < len(ranges):
-                range2 = ranges[i + 1]
-                assert start < range2[0]
+def iterCigarFields(cigarPath):
+    """Iterate over the fields of the cigar lines of a cigar or binary
+    alignment file, in the order they are in the file."""
+    if isAlignmentFile(cigarPath):
+        for alignment in readAlignments(cigarPath):
+            yield getCigarFields(alignment)
+        return
+    with open(cigarPath) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 10 and fields[0] == "cigar:":
+                yield fields
+
+def iterBatches(cigarFields, batchSize=UPCONVERT_BATCH_SIZE):
+    """Group the fields of a stream of cigar lines into lists of batchSize
+    lines."""
+    batch = []
+    for fields in cigarFields:
+        batch.append(fields)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def convertFields(batch, trimmedIndex, contigNum):
+    """Convert the contig, start and end fields of sequence 1 or 2 of a
+    batch of cigar lines to the trimmed sequences containing them."""
+    contigField = 1 if contigNum == 1 else 5
+    linesByContig = defaultdict(list)
+    for i, fields in enumerate(batch):
+        if fields[contigField] in trimmedIndex:
+            linesByContig[fields[contigField]].append(i)
+    for contig, lines in linesByContig.items():
+        starts = [int(batch[i][contigField + 1]) for i in lines]
+        ends = [int(batch[i][contigField + 2]) for i in lines]
+        minPositions = map(min, starts, ends)
+        trimmedRanges = trimmedIndex.findContaining(contig, minPositions)
+        for i, start, end, minPos, trimmedRange in zip(lines, starts, ends, minPositions, trimmedRanges):
+            if trimmedRange is None:
+                raise RuntimeError("No trimmed sequence containing alignment "
+                                   "on %s:%d-%d" % (contig, minPos, max(start, end)))
+            if max(start, end) - 1 > trimmedRange[1]:
+                raise RuntimeError("alignment on %s:%d-%d crosses "
+                                   "trimmed sequence boundary" % (contig, minPos, max(start, end)))
+            fields = batch[i]
+            fields[contigField] = "%s|%d" % (contig, trimmedRange[0])
+            fields[contigField + 1] = str(start - trimmedRange[0])
+            fields[contigField + 2] = str(end - trimmedRange[0])
+
+def downconvertFields(batch, contigNum):
+    """Convert the contig, start and end fields of sequence 1 or 2 of a
+    batch of cigar lines from trimmed sequences, named contig|start, back
+    to the contigs they were cut from, as cactus_blast_convertCoordinates
+    does."""
+    contigField = 1 if contigNum == 1 else 5
+    for fields in batch:
+        names = fields[contigField].rsplit('|', 1)
+        if len(names) != 2 or not names[1].isdigit():
+            raise RuntimeError("%s is not the name of a trimmed sequence" % fields[contigField])
+        trimmedStart = int(names[1])
+        fields[contigField] = names[0]
+        fields[contigField + 1] = str(int(fields[contigField + 1]) + trimmedStart)
+        fields[contigField + 2] = str(int(fields[contigField + 2]) + trimmedStart)
 
-def sortCigarByContigAndPos(cigarPath, contigNum):
-    contigNameKey = 2 if contigNum == 1 else 6
-    startPosKey = 3 if contigNum == 1 else 7
-    tempFile = getTempFile()
-    system("sort -k %d,%d -k %d,%dn %s > %s" % (contigNameKey, contigNameKey, startPosKey, startPosKey, cigarPath, tempFile))
-    return tempFile
+def writeBatch(batch, outputFile):
+    outputFile.write("".join(" ".join(fields) + "\n" for fields in batch))
+    return len(batch)
 
-def upconvertCoords(cigarPath, fastaPath, contigNum, outputFile):
+def writeConvertedBatch(batch, trimmedIndex, contigNums, outputFile):
+    for contigNum in contigNums:
+        convertFields(batch, trimmedIndex, contigNum)
+    return writeBatch(batch, outputFile)
+
+def upconvertCoords(cigarPath, fastaPath, contigNum, outputFile, batchSize=UPCONVERT_BATCH_SIZE):
     """Convert the coordinates of the given alignment, so that the
     alignment refers to a set of trimmed sequences originating from a
-    contig rather than to the contig itself."""
-    with open(fastaPath) as f:
-        seqRanges = getSequenceRanges(f)
-    validateRanges(seqRanges)
-    sortedCigarPath = sortCigarByContigAndPos(cigarPath, contigNum)
-    sortedCigarFile = open(sortedCigarPath)
+    contig rather than to the contig itself.
 
-    currentContig = None
-    currentRangeIdx = None
-    currentRange = None
-    for alignment in cigarRead(sortedCigarFile):
-        # contig1 and contig2 are reversed in python api!!
-        contig = alignment.contig2 if contigNum == 1 else alignment.contig1
-        minPos = min(alignment.start2, alignment.end2) if contigNum == 1 else min(alignment.start1, alignment.end1)
-        maxPos = max(alignment.start2, alignment.end2) if contigNum == 1 else max(alignment.start1, alignment.end1)
-        if contig in seqRanges:
-            if contig != currentContig:
-                currentContig = contig
-                currentRangeIdx = 0
-                currentRange = seqRanges[contig][0]
-            while (minPos >= currentRange[1] or minPos < currentRange[0]) and currentRangeIdx < len(seqRanges[contig]) - 1:
-                currentRangeIdx += 1
-                currentRange = seqRanges[contig][currentRangeIdx]
-            if currentRange[0] <= minPos < currentRange[1]:
-                if maxPos - 1 > currentRange[1]:
-                    raise RuntimeError("alignment on %s:%d-%d crosses "
-                                       "trimmed sequence boundary" %\
-                                       (contig,
-                                        minPos,
-                                        maxPos))
-                if contigNum == 1:
-                    alignment.start2 -= currentRange[0]
-                    alignment.end2 -= currentRange[0]
-                    alignment.contig2 = contig + ("|%d" % currentRange[0])
-                else:
-                    alignment.start1 -= currentRange[0]
-                    alignment.end1 -= currentRange[0]
-                    alignment.contig1 = contig + ("|%d" % currentRange[0])
-            else:
-                raise RuntimeError("No trimmed sequence containing alignment "
-                                   "on %s:%d-%d" % (contig,
-                                                    minPos,
-                                                    maxPos))
-        cigarWrite(outputFile, alignment, False)
-    os.remove(sortedCigarPath)
+    contigNum is the sequence (1 or 2) of the alignments to convert, or a
+    list of both. The alignments, either a cigar file or a binary
+    alignment file (see alignmentFile), are streamed in the order they
+    are in the file, and the trimmed sequences containing each batch of
+    them are found through an IntervalIndex, so nothing is sorted. The
+    output is always cigar. Returns the number of alignments."""
+    trimmedIndex = IntervalIndex(getSequenceRanges(fastaPath))
+    contigNums = contigNum if isinstance(contigNum, (list, tuple)) else [contigNum]
+    numAlignments = 0
+    for batch in iterBatches(iterCigarFields(cigarPath), batchSize):
+        numAlignments += writeConvertedBatch(batch, trimmedIndex, contigNums, outputFile)
+    return numAlignments
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("alignments", help="Cigar or binary alignment file")
+    parser.add_argument("trimmedFasta", help="The trimmed sequences, with headers ending in |start")
+    parser.add_argument("output", help="Cigar file to write the converted alignments to")
+    parser.add_argument("--contigNums", type=int, nargs="+", choices=[1, 2], default=[1],
+                        help="The sequences of the alignments to convert")
+    options = parser.parse_args()
+    start = time.time()
+    with open(options.output, 'w') as f:
+        numAlignments = upconvertCoords(options.alignments, options.trimmedFasta, options.contigNums, f)
+    elapsed = max(time.time() - start, 1e-9)
+    megabytes = os.path.getsize(options.alignments) / 1000000.0
+    print "Converted %i alignments (%.1f MB) in %.1f s: %.0f alignments/s, %.1f MB/s" % \
+        (numAlignments, megabytes, elapsed, numAlignments / elapsed, megabytes / elapsed)
+
+if __name__ == '__main__':
+    main()
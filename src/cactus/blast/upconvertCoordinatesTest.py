@@ -0,0 +1,82 @@
+import os
+import unittest
+from StringIO import StringIO
+from textwrap import dedent
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.blast.intervalIndex import IntervalIndex
+from cactus.blast.upconvertCoordinates import upconvertCoords
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.fastaPath = os.path.join(self.tempDir, "trimmed.fa")
+        with open(self.fastaPath, 'w') as f:
+            f.write(dedent('''\
+            >a|0
+            ACGTACGTAC
+            >a|20
+            ACGTA
+            CGTAC
+            >b|100
+            ACGTA'''))
+        self.cigarPath = os.path.join(self.tempDir, "alignments.cigar")
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def upconvert(self, cigar, contigNum, batchSize=2):
+        with open(self.cigarPath, 'w') as f:
+            f.write(cigar)
+        output = StringIO()
+        numAlignments = upconvertCoords(self.cigarPath, self.fastaPath, contigNum, output, batchSize=batchSize)
+        self.assertEquals(len(output.getvalue().splitlines()), numAlignments)
+        return output.getvalue()
+
+    def testIntervalIndex(self):
+        index = IntervalIndex({"a": [(20, 30), (0, 10)], "b": []})
+        self.assertTrue("a" in index)
+        self.assertFalse("c" in index)
+        self.assertEquals([None, (0, 10), (0, 10), None, (20, 30), (20, 30), None],
+                          index.findContaining("a", [-1, 0, 9, 10, 20, 29, 30]))
+        self.assertEquals([None], index.findContaining("b", [5]))
+        self.assertRaises(RuntimeError, IntervalIndex, {"a": [(0, 10), (5, 15)]})
+
+    def testUnsortedAlignments(self):
+        """The alignments are converted in the order they are given, in
+        several batches."""
+        cigar = dedent('''\
+        cigar: a 25 22 - x 0 3 + 1 M 3
+        cigar: c 5 8 + a 2 5 + 1.5 M 3
+        cigar: a 2 5 + b 101 104 + 10 M 3
+        cigar: b 100 105 + a 0 5 + 2 M 5
+        ''')
+        self.assertEquals(dedent('''\
+        cigar: a|20 5 2 - x 0 3 + 1 M 3
+        cigar: c 5 8 + a 2 5 + 1.5 M 3
+        cigar: a|0 2 5 + b 101 104 + 10 M 3
+        cigar: b|100 0 5 + a 0 5 + 2 M 5
+        '''), self.upconvert(cigar, 1))
+        self.assertEquals(dedent('''\
+        cigar: a 25 22 - x 0 3 + 1 M 3
+        cigar: c 5 8 + a|0 2 5 + 1.5 M 3
+        cigar: a 2 5 + b|100 1 4 + 10 M 3
+        cigar: b 100 105 + a|0 0 5 + 2 M 5
+        '''), self.upconvert(cigar, 2))
+        # Both sequences in one pass
+        self.assertEquals(dedent('''\
+        cigar: a|20 5 2 - x 0 3 + 1 M 3
+        cigar: c 5 8 + a|0 2 5 + 1.5 M 3
+        cigar: a|0 2 5 + b|100 1 4 + 10 M 3
+        cigar: b|100 0 5 + a|0 0 5 + 2 M 5
+        '''), self.upconvert(cigar, [1, 2], batchSize=100))
+
+    def testOutsideTrimmedSequences(self):
+        self.assertRaises(RuntimeError, self.upconvert, "cigar: a 12 15 + x 0 3 + 1 M 3\n", 1)
+        self.assertRaises(RuntimeError, self.upconvert, "cigar: a 8 15 + x 0 7 + 1 M 7\n", 1)
+
+if __name__ == '__main__':
+    unittest.main()
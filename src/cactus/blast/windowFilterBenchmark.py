@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Compares the time taken by the original and the NumPy window filters
+of trimSequences on a synthetic genome.
+
+The coverage is simulated as alternating covered and uncovered runs of
+random length, as in the coverage beds of an ingroup against an
+outgroup. The original filter is slow enough that it is only run on a
+prefix of the genome, on which the two must find the same regions; its
+time on the whole genome is extrapolated from that.
+"""
+import random
+import time
+from argparse import ArgumentParser
+
+from cactus.blast import trimSequences
+from cactus.blast.trimSequences import windowFilterSequence, windowFilterSequenceNumpy
+
+def simulateBlocks(genomeLength, meanBlockSize, meanGapSize):
+    """Get sorted, non-overlapping (start, end, depth) blocks covering
+    part of a genome."""
+    blocks = []
+    pos = int(random.expovariate(1.0 / meanGapSize))
+    while pos < genomeLength:
+        end = min(genomeLength, pos + 1 + int(random.expovariate(1.0 / meanBlockSize)))
+        blocks.append((pos, end, 1))
+        pos = end + 1 + int(random.expovariate(1.0 / meanGapSize))
+    return blocks
+
+def timeFilter(windowFilterFn, windowSize, threshold, blocks, seqLength):
+    start = time.time()
+    regions = windowFilterFn(windowSize, threshold, blocks, seqLength)
+    return regions, time.time() - start
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--genomeLength", type=int, default=100000000)
+    parser.add_argument("--pythonLength", type=int, default=1000000,
+                        help="Length of the prefix of the genome to run the original filter on")
+    parser.add_argument("--meanBlockSize", type=int, default=500)
+    parser.add_argument("--meanGapSize", type=int, default=200)
+    parser.add_argument("--windowSize", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    if trimSequences.numpy is None:
+        raise RuntimeError("NumPy is needed for the benchmark")
+    random.seed(options.seed)
+    blocks = simulateBlocks(options.genomeLength, options.meanBlockSize, options.meanGapSize)
+    pythonLength = min(options.pythonLength, options.genomeLength)
+    prefixBlocks = [block for block in blocks if block[0] < pythonLength]
+
+    pythonRegions, pythonTime = timeFilter(windowFilterSequence, options.windowSize, options.threshold,
+                                           prefixBlocks, pythonLength)
+    numpyPrefixRegions, numpyPrefixTime = timeFilter(windowFilterSequenceNumpy, options.windowSize,
+                                                     options.threshold, prefixBlocks, pythonLength)
+    if pythonRegions != numpyPrefixRegions:
+        raise RuntimeError("The window filters found different regions")
+    numpyRegions, numpyTime = timeFilter(windowFilterSequenceNumpy, options.windowSize, options.threshold,
+                                         blocks, options.genomeLength)
+    pythonGenomeTime = pythonTime * options.genomeLength / pythonLength
+
+    print "%i blocks, %i regions on a %i bp genome" % (len(blocks), len(numpyRegions), options.genomeLength)
+    print "%-8s %14s %14s" % ("filter", "prefix (s)", "genome (s)")
+    print "%-8s %14.3f %14.3f (extrapolated)" % ("python", pythonTime, pythonGenomeTime)
+    print "%-8s %14.3f %14.3f" % ("numpy", numpyPrefixTime, numpyTime)
+    print "speedup: %.0fx" % (pythonGenomeTime / numpyTime)
+
+if __name__ == '__main__':
+    main()
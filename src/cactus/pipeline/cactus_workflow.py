@@ -18,6 +18,7 @@ import time
 import random
 import copy
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 
 from sonLib.bioio import newickTreeParser
@@ -43,6 +44,11 @@ from cactus.shared.common import runCactusExtendFlowers
 from cactus.shared.common import runCactusSplitFlowersBySecondaryGrouping
 from cactus.shared.common import encodeFlowerNames
 from cactus.shared.common import decodeFirstFlowerName
+from cactus.shared.common import encodeBinaryFlowerNames
+from cactus.shared.common import getNumberOfFlowers
+from cactus.shared.common import encodeFlowerSizes
+from cactus.shared.common import decodeFlowerSizes
+from cactus.shared.common import packFlowerGroups
 from cactus.shared.common import runCactusConvertAlignmentToCactus
 from cactus.shared.common import runCactusPhylogeny
 from cactus.shared.common import runCactusBar
@@ -59,17 +65,35 @@ from cactus.shared.common import runConvertAlignmentsToInternalNames
 from cactus.shared.common import runStripUniqueIDs
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import readGlobalFileWithoutCache
+from cactus.shared.fasta import FastaFile
 
 from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastOptions
+from cactus.blast.blast import readGlobalAlignmentsFile
+from cactus.blast.blast import deleteAlignmentsManifest
 
 from cactus.preprocessor.cactus_preprocessor import CactusPreprocessor
 
+from cactus.shared.resourceModel import evaluateResourceModel
 from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.shared.experimentWrapper import DbElemWrapper
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.pipeline.ktserverToil import KtServerService
+from cactus.pipeline.ktserverToil import combineShardDatabaseStrings
 from cactus.pipeline.ktserverControl import stopKtserver
+from cactus.pipeline.ktserverControl import snapshotKtserver
+from cactus.pipeline.ktserverControl import getAutoKtTuning
+from cactus.pipeline.ktserverControl import setAutoKtTuning
+from cactus.pipeline.ktserverControl import getKtTuningOptions
+from cactus.pipeline.ktserverControl import getKtServerOptions
+from cactus.pipeline.ktserverSnapshot import getFullSnapshotID
+from cactus.pipeline.embeddedDb import isEmbeddedDb
+from cactus.pipeline.embeddedDb import startEmbeddedDb
+from cactus.pipeline.embeddedDb import saveEmbeddedDb
+from cactus.pipeline.embeddedDb import removeEmbeddedDb
+from cactus.pipeline.embeddedDb import getSecondaryDbDir
+from cactus.shared.profiling import logLatency
+from cactus.shared.profiling import logParameters
 
 ############################################################
 ############################################################
@@ -109,7 +133,7 @@ class CactusJob(RoundedJob):
         if hasattr(self, 'memoryPoly'):
             # Memory should be determined by a polynomial fit on the
             # input size
-            memory = self.evaluateResourcePoly(self.memoryPoly)
+            memory = self.evaluateResourcePoly(self.memoryPoly, useResourceModel=True)
             if hasattr(self, 'memoryCap'):
                 memory = int(min(memory, self.memoryCap))
 
@@ -126,16 +150,29 @@ class CactusJob(RoundedJob):
                                               default=getOptionalAttrib(self.constantsNode, "defaultCpu", int, default=sys.maxint))
         RoundedJob.__init__(self, memory=memory, cores=cores, disk=disk,
                             checkpoint=checkpoint, preemptable=preemptable)
+        # Memory multiples to re-run the job with if it runs out of memory
+        oomMemoryEscalation = getOptionalAttrib(self.constantsNode, "oomMemoryEscalation", default="")
+        self.oomMemoryEscalation = tuple(float(i) for i in oomMemoryEscalation.split(",") if i.strip() != "")
 
-    def evaluateResourcePoly(self, poly):
-        """Evaluate a polynomial based on the total sequence size."""
+    def evaluateResourcePoly(self, poly, useResourceModel=False):
+        """Evaluate a polynomial based on the total sequence size.
+
+        If useResourceModel is set and a resource model learned from
+        previous runs has a fit for this job, the fit is used instead.
+        """
         features = {'totalSequenceSize': self.cactusWorkflowArguments.totalSequenceSize}
         if hasattr(self, 'featuresFn'):
             features.update(self.featuresFn())
         if hasattr(self, 'feature'):
-            x = features[self.feature]
+            feature = self.feature
         else:
-            x = features['totalSequenceSize']
+            feature = 'totalSequenceSize'
+        x = features[feature]
+        if useResourceModel:
+            resource = evaluateResourceModel(getattr(self.cactusWorkflowArguments, 'resourceModelFits', None),
+                                             self.__class__.__name__, feature, x)
+            if resource is not None:
+                return resource
         resource = 0
         for degree, coefficient in enumerate(reversed(poly)):
             resource += coefficient * (x**degree)
@@ -151,6 +188,9 @@ class CactusJob(RoundedJob):
         """
         return getOptionalAttrib(node=self.jobNode, attribName=attribName, typeFn=typeFn, default=default)
 
+    def getProfilePhase(self):
+        return self.phaseNode.tag
+
     def addService(self, job):
         """Works around toil issue #1695, returning a Job rather than a Promise."""
         super(CactusJob, self).addService(job)
@@ -217,6 +257,11 @@ class CactusPhasesJob(CactusJob):
     def getPhaseNumber(self):
         return len(self.cactusWorkflowArguments.configNode.findall(self.phaseNode.tag))
 
+    def useWarmHandoff(self):
+        """Should the primary DB be kept running across the checkpoints?"""
+        return ConfigWrapper(self.cactusWorkflowArguments.configNode).getKtserverWarmHandoff() and \
+            self.cactusWorkflowArguments.experimentWrapper.getDbType() == "kyoto_tycoon"
+
     def setupSecondaryDatabase(self):
         """Setup the secondary database
         """
@@ -258,6 +303,9 @@ class CactusCheckpointJob(CactusPhasesJob):
         promise = self.addChild(startDBJob)
         return promise
 
+# The phases the primary DB is started for, in order
+CHECKPOINT_PHASES = ["setup", "bar", "reference", "hal"]
+
 class StartPrimaryDB(CactusPhasesJob):
     """Launches a primary Cactus DB."""
     def __init__(self, nextJob, ktServerDump=None, *args, **kwargs):
@@ -270,12 +318,19 @@ class StartPrimaryDB(CactusPhasesJob):
     def run(self, fileStore):
         cw = ConfigWrapper(self.cactusWorkflowArguments.configNode)
 
-        if self.cactusWorkflowArguments.experimentWrapper.getDbType() == "kyoto_tycoon":
+        if self.cactusWorkflowArguments.experimentWrapper.getDbType() == "kyoto_tycoon" and \
+           cw.getKtserverShards() > 1:
+            return self.startShardedDB(cw, fileStore)
+        elif self.cactusWorkflowArguments.experimentWrapper.getDbType() == "kyoto_tycoon":
             memory = max(2500000000, self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
             cores = cw.getKtserverCpu(default=0.1)
-            dbElem = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
+            # A copy, so the tuning for this phase isn't carried into later checkpoints
+            dbElem = ExperimentWrapper(copy.deepcopy(self.cactusWorkflowArguments.experimentNode))
+            self.autoTune(cw, [dbElem], memory, fileStore)
             service = self.addService(KtServerService(dbElem=dbElem,
                                                       existingSnapshotID=self.ktServerDump,
+                                                      incrementalSnapshot=cw.getKtserverIncrementalSnapshots(),
+                                                      snapshotInterval=self.getSnapshotInterval(cw),
                                                       isSecondary=False,
                                                       memory=memory, cores=cores))
             dbString = service.rv(0)
@@ -284,35 +339,228 @@ class StartPrimaryDB(CactusPhasesJob):
             # TODO: This part needs to be cleaned up
             self.nextJob.cactusWorkflowArguments.snapshotID = snapshotID
             return self.addChild(self.nextJob).rv()
+        elif isEmbeddedDb(self.cactusWorkflowArguments.experimentWrapper):
+            dbElem = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
+            startTime = time.time()
+            dbElem = startEmbeddedDb(dbElem, fileStore, existingSnapshotID=self.ktServerDump)
+            logLatency(fileStore, "embeddedDbStartup", startTime, time.time() - startTime)
+            secondaryElem = DbElemWrapper(ET.fromstring(self.cactusWorkflowArguments.secondaryDatabaseString))
+            secondaryElem.setDbDir(getSecondaryDbDir(dbElem.getDbDir()))
+            self.nextJob.cactusWorkflowArguments.cactusDiskDatabaseString = dbElem.getConfString()
+            self.nextJob.cactusWorkflowArguments.secondaryDatabaseString = secondaryElem.getConfString()
+            # Runs once the phases using the DB are done
+            self.addFollowOnJobFn(removeEmbeddedDb, dbElem.getDbDir())
+            return self.addChild(self.nextJob).rv()
         else:
             return self.addFollowOn(self.nextJob).rv()
 
+    def getSnapshotInterval(self, cw):
+        """With warm hand-off, the DB saves snapshots in the background for
+        SavePrimaryDB to collect while it keeps running."""
+        return cw.getKtserverSnapshotInterval() if self.useWarmHandoff() else None
+
+    def autoTune(self, cw, dbElems, memory, fileStore):
+        """Size the ktservers of the primary DB for the input and this
+        phase, if the config asks for it, and record what was chosen.
+        With warm hand-off, the servers are sized for the largest of the
+        phases they will serve."""
+        if not cw.getKtserverAutoTune():
+            return
+        seqIDMap = self.cactusWorkflowArguments.experimentWrapper.seqIDMap
+        numGenomes = len(seqIDMap) if seqIDMap is not None else 1
+        phases = [self.phaseName]
+        if self.useWarmHandoff() and self.phaseName in CHECKPOINT_PHASES:
+            phases = CHECKPOINT_PHASES[CHECKPOINT_PHASES.index(self.phaseName):]
+        tuning = getAutoKtTuning(self.cactusWorkflowArguments.totalSequenceSize, numGenomes,
+                                 phases, memory, shards=len(dbElems))
+        for dbElem in dbElems:
+            setAutoKtTuning(dbElem, tuning)
+        parameters = dict(tuning, phase=self.phaseName, phases=phases, shards=len(dbElems), genomes=numGenomes,
+                          totalSequenceSize=self.cactusWorkflowArguments.totalSequenceSize,
+                          tuningOptions=getKtTuningOptions(dbElems[0]),
+                          serverOptions=getKtServerOptions(dbElems[0]))
+        fileStore.logToMaster("Primary DB tuning for the %s phase: %s" % (self.phaseName, parameters))
+        logParameters(fileStore, "ktserverTuning", parameters)
+
+    def startShardedDB(self, cw, fileStore):
+        """Launch a ktserver for each shard of the primary DB, each
+        restoring its own snapshot."""
+        shards = cw.getKtserverShards()
+        if self.ktServerDump is not None and len(self.ktServerDump) != shards:
+            raise RuntimeError("The primary DB was saved with %i shards, but %i shards are configured"
+                               % (len(self.ktServerDump), shards))
+        memory = max(2500000000, self.evaluateResourcePoly([4.10201882, 2.01324291e+08]) / shards)
+        cores = cw.getKtserverCpu(default=0.1)
+        dbElems = [ExperimentWrapper(copy.deepcopy(self.cactusWorkflowArguments.experimentNode))
+                   for i in xrange(shards)]
+        self.autoTune(cw, dbElems, memory, fileStore)
+        dbStrings = []
+        snapshotIDs = []
+        for i, dbElem in enumerate(dbElems):
+            service = self.addService(KtServerService(dbElem=dbElem,
+                                                      existingSnapshotID=self.ktServerDump[i] if self.ktServerDump is not None else None,
+                                                      incrementalSnapshot=cw.getKtserverIncrementalSnapshots(),
+                                                      snapshotInterval=self.getSnapshotInterval(cw),
+                                                      isSecondary=False,
+                                                      memory=memory, cores=cores))
+            dbStrings.append(service.rv(0))
+            snapshotIDs.append(service.rv(1))
+        return self.addChild(CombinePrimaryDBShards(self.nextJob, dbStrings, snapshotIDs,
+                                                    cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                                    phaseName=self.phaseName,
+                                                    topFlowerName=self.topFlowerName)).rv()
+
+class CombinePrimaryDBShards(CactusPhasesJob):
+    """Points the phases at every shard of the primary DB, once the
+    shards' ktservers are running."""
+    def __init__(self, nextJob, shardDatabaseStrings, snapshotIDs, *args, **kwargs):
+        self.nextJob = nextJob
+        self.shardDatabaseStrings = shardDatabaseStrings
+        self.snapshotIDs = snapshotIDs
+        super(CombinePrimaryDBShards, self).__init__(*args, **kwargs)
+
+    def run(self, fileStore):
+        cactusWorkflowArguments = self.nextJob.cactusWorkflowArguments
+        cactusWorkflowArguments.cactusDiskDatabaseString = combineShardDatabaseStrings(self.shardDatabaseStrings)
+        cactusWorkflowArguments.shardDatabaseStrings = self.shardDatabaseStrings
+        cactusWorkflowArguments.snapshotID = self.snapshotIDs
+        return self.addChild(self.nextJob).rv()
+
 class SavePrimaryDB(CactusPhasesJob):
-    """Saves the DB to a file and clears the DB."""
+    """Saves the DB to a file and clears the DB.
+
+    With warm hand-off, the DB is instead left running and the first
+    phase of the next checkpoint is run on it, after a snapshot of it
+    has been saved for the phase to restart from (see ResumePrimaryDB).
+    """
     def __init__(self, *args, **kwargs):
         super(SavePrimaryDB, self).__init__(*args, **kwargs)
 
+    def getHandoffPhase(self):
+        """Get the first phase job and name of the checkpoint after this one."""
+        return {"caf": (CactusBarPhase, "bar"),
+                "avg": (CactusReferencePhase, "reference"),
+                "check": (CactusHalGeneratorPhase, "hal")}.get(self.phaseName, (None, None))
+
     def run(self, fileStore):
         stats = runCactusFlowerStats(cactusDiskDatabaseString=self.cactusWorkflowArguments.cactusDiskDatabaseString,
                                      flowerName=0)
         fileStore.logToMaster("At end of %s phase, got stats %s" % (self.phaseName, stats))
+        if self.useWarmHandoff():
+            nextPhaseJob, nextPhaseName = self.getHandoffPhase()
+            if nextPhaseJob is not None:
+                startTime = time.time()
+                snapshotID = self.saveRunningSnapshot(fileStore)
+                logLatency(fileStore, "ktserverHandoffSnapshot", startTime, time.time() - startTime)
+                self.exportSnapshot(fileStore, snapshotID)
+                fileStore.logToMaster("Handing the primary DB over to the %s phase" % nextPhaseName)
+                job = nextPhaseJob(cactusWorkflowArguments=self.cactusWorkflowArguments, phaseName=nextPhaseName,
+                                   topFlowerName=self.topFlowerName, halID=self.halID, fastaID=self.fastaID)
+                return self.addFollowOn(ResumePrimaryDB(job, ktServerDump=snapshotID,
+                                                        handoffMarkerID=fileStore.jobStore.getEmptyFileStoreID(),
+                                                        cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                                        phaseName=nextPhaseName,
+                                                        topFlowerName=self.topFlowerName)).rv()
         dbElem = DbElemWrapper(ET.fromstring(self.cactusWorkflowArguments.cactusDiskDatabaseString))
-        # Send the terminate message
-        stopKtserver(dbElem)
-        # Wait for the file to appear in the right place. This may take a while
-        while True:
-            with fileStore.readGlobalFileStream(self.cactusWorkflowArguments.snapshotID) as f:
-                if f.read(1) != '':
-                    # The file is no longer empty
-                    break
-            time.sleep(10)
+        startTime = time.time()
+        if isEmbeddedDb(dbElem):
+            # No server to stop, so just copy the DB's files
+            snapshotID = saveEmbeddedDb(dbElem, fileStore)
+            logLatency(fileStore, "embeddedDbSave", startTime, time.time() - startTime)
+        elif getattr(self.cactusWorkflowArguments, 'shardDatabaseStrings', None) is not None:
+            # Stop the shards together, as each has its own snapshot to save
+            def saveShard(shard):
+                dbString, shardSnapshotID = shard
+                return self.saveKtserverSnapshot(fileStore, DbElemWrapper(ET.fromstring(dbString)), shardSnapshotID)
+            shards = zip(self.cactusWorkflowArguments.shardDatabaseStrings, self.cactusWorkflowArguments.snapshotID)
+            pool = ThreadPool(len(shards))
+            try:
+                snapshotID = pool.map(saveShard, shards)
+            finally:
+                pool.close()
+            logLatency(fileStore, "ktserverShutdown", startTime, time.time() - startTime)
+        else:
+            snapshotID = self.saveKtserverSnapshot(fileStore, dbElem, self.cactusWorkflowArguments.snapshotID)
+            logLatency(fileStore, "ktserverShutdown", startTime, time.time() - startTime)
         # We have the file now
+        self.exportSnapshot(fileStore, snapshotID)
+        return snapshotID
+
+    def exportSnapshot(self, fileStore, snapshotID):
+        """Export the DB dumps, if the user requested to keep them in a separate place."""
         intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
         if intermediateResultsUrl is not None:
-            # The user requested to keep the DB dumps in a separate place. Export it there.
             url = intermediateResultsUrl + "-dump-" + self.phaseName
-            fileStore.exportFile(self.cactusWorkflowArguments.snapshotID, url)
-        return self.cactusWorkflowArguments.snapshotID
+            if isinstance(snapshotID, list):
+                for i, shardSnapshotID in enumerate(snapshotID):
+                    fileStore.exportFile(getFullSnapshotID(fileStore, shardSnapshotID), url + "-shard%i" % i)
+            else:
+                fileStore.exportFile(getFullSnapshotID(fileStore, snapshotID), url)
+
+    def saveKtserverSnapshot(self, fileStore, dbElem, snapshotID):
+        """Stop a ktserver, returning the ID of its snapshot once it is saved."""
+        # Send the terminate message, which returns once the snapshot
+        # has been saved
+        if not stopKtserver(dbElem):
+            # We couldn't hear back from the server, so wait for the
+            # file to appear in the right place. This may take a while
+            while True:
+                with fileStore.readGlobalFileStream(snapshotID) as f:
+                    if f.read(1) != '':
+                        # The file is no longer empty
+                        break
+                time.sleep(10)
+        return snapshotID
+
+    def saveRunningSnapshot(self, fileStore):
+        """Save a snapshot of the primary DB (of each of its shards) while
+        it keeps running, returning its ID (or a list of the shards')."""
+        shardDatabaseStrings = getattr(self.cactusWorkflowArguments, 'shardDatabaseStrings', None)
+        dbStrings = shardDatabaseStrings or [self.cactusWorkflowArguments.cactusDiskDatabaseString]
+        def saveShard(dbString):
+            dbElem = DbElemWrapper(ET.fromstring(dbString))
+            snapshotID = fileStore.jobStore.getEmptyFileStoreID()
+            if not snapshotKtserver(dbElem, snapshotID):
+                raise RuntimeError("Couldn't contact the ktserver at %s:%s to save a snapshot"
+                                   % (dbElem.getDbHost(), dbElem.getDbPort()))
+            return snapshotID
+        pool = ThreadPool(len(dbStrings))
+        try:
+            snapshotIDs = pool.map(saveShard, dbStrings)
+        finally:
+            pool.close()
+        return snapshotIDs if shardDatabaseStrings is not None else snapshotIDs[0]
+
+class ResumePrimaryDB(CactusPhasesJob):
+    """Runs the first phase of a checkpoint on the primary DB handed over
+    by SavePrimaryDB, as a checkpoint of its own.
+
+    If the phases after it fail, Toil runs this job again, when the DB
+    may hold part of their work, so a new primary DB is started from the
+    snapshot saved at the hand-off instead. (The old one stays up, idle,
+    until the phases are done.) The file handoffMarkerID is written the
+    first time, to tell the two apart.
+    """
+    def __init__(self, nextJob, ktServerDump, handoffMarkerID, *args, **kwargs):
+        self.nextJob = nextJob
+        self.ktServerDump = ktServerDump
+        self.handoffMarkerID = handoffMarkerID
+        kwargs['checkpoint'] = True
+        kwargs['preemptable'] = False
+        super(ResumePrimaryDB, self).__init__(*args, **kwargs)
+
+    def run(self, fileStore):
+        with fileStore.jobStore.readFileStream(self.handoffMarkerID) as f:
+            restarted = f.read(1) != ''
+        if restarted:
+            fileStore.logToMaster("Restarting the %s phase from the snapshot saved at the hand-off" % self.phaseName)
+            return self.addChild(StartPrimaryDB(self.nextJob, ktServerDump=self.ktServerDump,
+                                                cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                                phaseName=self.phaseName,
+                                                topFlowerName=self.topFlowerName)).rv()
+        with fileStore.jobStore.updateFileStream(self.handoffMarkerID) as f:
+            f.write("handed off\n")
+        return self.addChild(self.nextJob).rv()
 
 class CactusRecursionJob(CactusJob):
     """Base recursive job for traversals up and down the cactus tree.
@@ -325,7 +573,9 @@ class CactusRecursionJob(CactusJob):
     maxSequenceSizeOfFlowerGroupingDefault = 1000000
     def __init__(self, phaseNode, constantsNode, cactusDiskDatabaseString, flowerNames, flowerSizes, overlarge=False, precomputedAlignmentIDs=None, checkpoint = False, cactusWorkflowArguments=None, preemptable=True, memPoly=None):
         self.cactusDiskDatabaseString = cactusDiskDatabaseString
-        self.flowerNames = flowerNames
+        #There can be hundreds of thousands of these jobs in the job store,
+        #so the flowers are kept in their compact binary forms.
+        self.flowerNames = encodeBinaryFlowerNames(flowerNames)
         self.flowerSizes = flowerSizes
         self.cactusWorkflowArguments = cactusWorkflowArguments
 
@@ -336,6 +586,14 @@ class CactusRecursionJob(CactusJob):
 
         CactusJob.__init__(self, phaseNode=phaseNode, constantsNode=constantsNode, overlarge=overlarge, 
                            checkpoint=checkpoint, preemptable=preemptable)
+
+    @property
+    def flowerSizes(self):
+        return decodeFlowerSizes(self.encodedFlowerSizes)
+
+    @flowerSizes.setter
+    def flowerSizes(self, flowerSizes):
+        self.encodedFlowerSizes = encodeFlowerSizes(flowerSizes)
         
     def makeFollowOnRecursiveJob(self, job, phaseNode=None):
         """Sets the followon to the given recursive job
@@ -357,9 +615,18 @@ class CactusRecursionJob(CactusJob):
             overlargeJob = job
         if phaseNode == None:
             phaseNode = self.phaseNode
+
+        #Pack small groups together so they are run by one job, if the
+        #child job is configured to allow it
+        maxPackedFlowerGroupSize = getOptionalAttrib(getJobNode(phaseNode, job), "maxPackedFlowerGroupSize", int, 0)
+        if maxPackedFlowerGroupSize > 0:
+            flowersAndSizes = packFlowerGroups(flowersAndSizes, maxPackedFlowerGroupSize)
         
-        logger.info("Make wrapper jobs: There are %i flowers" % len(flowersAndSizes))
+        # flowersAndSizes may be a stream straight from getFlowers, so
+        # count the groups as we go rather than up front.
+        numGroups = 0
         for overlarge, flowerNames, flowerSizes in flowersAndSizes:
+            numGroups += 1
             if overlarge: #Make sure large flowers are on their own, in their own job
                 flowerStatsString = runCactusFlowerStats(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
                                                          flowerName=decodeFirstFlowerName(flowerNames))
@@ -381,6 +648,7 @@ class CactusRecursionJob(CactusJob):
                                   flowerSizes=flowerSizes,
                                   overlarge=False,
                                   cactusWorkflowArguments=self.cactusWorkflowArguments)).rv()
+        logger.info("Made wrapper jobs: There were %i flower groups" % numGroups)
 
     def makeRecursiveJobs(self, fileStore=None, job=None, phaseNode=None):
         """Make a set of child jobs for a given set of parent flowers.
@@ -427,12 +695,13 @@ class CactusRecursionJob(CactusJob):
         # their flower.
         flowersAndSizes = []
         flowersSoFar = 0
+        flowerSizes = self.flowerSizes
         for overlarge, flowerNames in splitFlowerNames:
             # Number of flowers in this grouping.
-            numFlowers = int(flowerNames.split()[0])
-            flowersAndSizes += [(overlarge, flowerNames, self.flowerSizes[flowersSoFar:flowersSoFar + numFlowers])]
+            numFlowers = getNumberOfFlowers(flowerNames)
+            flowersAndSizes += [(overlarge, flowerNames, flowerSizes[flowersSoFar:flowersSoFar + numFlowers])]
             flowersSoFar += numFlowers
-        totalFlowers = int(self.flowerNames.split()[0])
+        totalFlowers = getNumberOfFlowers(self.flowerNames)
         assert flowersSoFar == totalFlowers, \
                "Didn't process all flowers while going through a secondary grouping."
         return self.makeChildJobs(flowersAndSizes=flowersAndSizes,
@@ -457,14 +726,15 @@ def prependUniqueIDs(fas, outputDir):
     ret = []
     for fa in fas:
         outPath = os.path.join(outputDir, os.path.basename(fa))
-        out = open(outPath, 'w')
-        for line in open(fa):
-            if len(line) > 0 and line[0] == '>':
-                tokens = line[1:].split()
-                tokens[0] = "id=%d|%s" % (uniqueID, tokens[0])
-                out.write(">%s\n" % "".join(tokens))
-            else:
-                out.write(line)
+        with FastaFile(fa) as fastaFile:
+            with open(outPath, 'w') as out:
+                for isHeader, text in fastaFile.iterSections():
+                    if isHeader:
+                        tokens = text[1:].split()
+                        tokens[0] = "id=%d|%s" % (uniqueID, tokens[0])
+                        out.write(">%s\n" % "".join(tokens))
+                    else:
+                        out.write(text)
         ret.append(outPath)
         uniqueID += 1
     return ret
@@ -534,11 +804,15 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                          trimWindowSize=self.getOptionalPhaseAttrib("trimWindowSize", int, 10),
                          trimOutgroupFlanking=self.getOptionalPhaseAttrib("trimOutgroupFlanking", int, 100),
                          trimOutgroupDepth=self.getOptionalPhaseAttrib("trimOutgroupDepth", int, 1),
-                         keepParalogs=self.getOptionalPhaseAttrib("keepParalogs", bool, False)),
+                         keepParalogs=self.getOptionalPhaseAttrib("keepParalogs", bool, False),
+                         collateFanIn=self.getOptionalPhaseAttrib("collateFanIn", int, 100),
+                         collateManifest=self.getOptionalPhaseAttrib("collateManifest", bool, False),
+                         binaryAlignments=self.getOptionalPhaseAttrib("binaryAlignments", bool, False)),
             map(itemgetter(0), ingroupItems), map(itemgetter(1), ingroupItems),
             map(itemgetter(0), outgroupItems), map(itemgetter(1), outgroupItems)))
 
         self.cactusWorkflowArguments.alignmentsID = blastJob.rv(0)
+        self.cactusWorkflowArguments.blastAlignmentsID = blastJob.rv(0)
         self.cactusWorkflowArguments.outgroupFragmentIDs = blastJob.rv(1)
         self.cactusWorkflowArguments.ingroupCoverageIDs = blastJob.rv(2)
 
@@ -565,6 +839,12 @@ def getLongestPath(node, distance=0.0):
 class CactusSetupCheckpoint(CactusCheckpointJob):
     """Start a new DB, run the setup and CAF phases, save the DB, then launch the BAR checkpoint."""
     def run(self, fileStore):
+        if self.useWarmHandoff():
+            # SavePrimaryDB hands the DB on to each of the later phases
+            # in turn, through a ResumePrimaryDB checkpoint. The
+            # reference phase returns the experiment and the result of
+            # the phases after it, the last of which is the HAL phase.
+            return self.runPhaseWithPrimaryDB(CactusSetupPhase).rv(1)
         ktServerDump = self.runPhaseWithPrimaryDB(CactusSetupPhase).rv()
         return self.makeFollowOnCheckpointJob(CactusBarCheckpoint, "bar", ktServerDump=ktServerDump)
 
@@ -650,7 +930,7 @@ class CactusCafPhase(CactusPhasesJob):
             self.cactusWorkflowArguments.constraintsID = fileStore.writeGlobalFile(newConstraintsFile, cleanup=True)
 
         assert self.getPhaseNumber() == 1
-        alignmentsFile = fileStore.readGlobalFile(self.cactusWorkflowArguments.alignmentsID)
+        alignmentsFile = readGlobalAlignmentsFile(fileStore, self.cactusWorkflowArguments.alignmentsID)
         convertedAlignmentsFile = fileStore.getLocalTempFile()
         # Convert the cigar file to use 64-bit cactus Names instead of the headers.
         runConvertAlignmentsToInternalNames(cactusDiskString=self.cactusWorkflowArguments.cactusDiskDatabaseString, alignmentsFile=alignmentsFile, outputFile=convertedAlignmentsFile, flowerName=self.topFlowerName)
@@ -761,6 +1041,11 @@ class CactusBarCheckpoint(CactusCheckpointJob):
 class CactusBarPhase(CactusPhasesJob):
     """Runs bar algorithm."""
     def run(self, fileStore):
+        # The CAF phase has converted the blast alignments, and the setup
+        # checkpoint that would read them again on a restart is over, so
+        # the parts of a manifest and the manifest itself can go.
+        if self.cactusWorkflowArguments.blastAlignmentsID is not None:
+            deleteAlignmentsManifest(fileStore, self.cactusWorkflowArguments.blastAlignmentsID)
         return self.runPhase(CactusBarRecursion, CactusNormalPhase, "normal", doRecursion=self.getOptionalPhaseAttrib("runBar", bool, False))
 
 class CactusBarRecursion(CactusRecursionJob):
@@ -772,8 +1057,9 @@ class CactusBarRecursion(CactusRecursionJob):
         self.makeExtendingJobs(fileStore=fileStore,
                                job=CactusBarWrapper, overlargeJob=CactusBarWrapperLarge)
 
-def runBarForJob(self, fileStore=None, features=None, calculateWhichEndsToComputeSeparately=False, endAlignmentsToPrecomputeOutputFile=None, precomputedAlignments=None):
+def runBarForJob(self, fileStore=None, features=None, calculateWhichEndsToComputeSeparately=False, endAlignmentsToPrecomputeOutputFile=None, precomputedAlignments=None, streaming=False):
     return runCactusBar(jobName=self.__class__.__name__,
+                 streaming=streaming,
                  fileStore=fileStore,
                  features=features,
                  cactusDiskDatabaseString=self.cactusDiskDatabaseString,
@@ -826,7 +1112,8 @@ class CactusBarWrapperLarge(CactusRecursionJob):
         endSizes = []
         precomputedAlignmentIDs = []
         for line in runBarForJob(self, features=self.featuresFn(),
-                                 fileStore=fileStore, calculateWhichEndsToComputeSeparately=True):
+                                 fileStore=fileStore, calculateWhichEndsToComputeSeparately=True,
+                                 streaming=True):
             endToAlign, sequencesInEndAlignment, basesInEndAlignment = line.split()
             sequencesInEndAlignment = int(sequencesInEndAlignment)
             basesInEndAlignment = int(basesInEndAlignment)
@@ -1297,6 +1584,8 @@ class CactusWorkflowArguments:
         self.scratchDbElemNode = ET.parse(self.experimentFile).getroot()
         self.experimentWrapper = ExperimentWrapper(self.experimentNode)
         self.alignmentsID = None
+        #The alignments from blast, as collated, until they are converted
+        self.blastAlignmentsID = None
         self.experimentWrapper.seqIDMap = seqIDMap
         #Get the database string
         self.cactusDiskDatabaseString = ET.tostring(self.experimentNode.find("cactus_disk").find("st_kv_database_conf")).translate(None, '\n')
@@ -1317,6 +1606,8 @@ class CactusWorkflowArguments:
         # -caf, -avg, etc.
         self.intermediateResultsUrl = options.intermediateResultsUrl
         self.ktServerDump = None
+        # Memory fits learned from previous runs (see cactus.shared.resourceModel)
+        self.resourceModelFits = getattr(options, 'resourceModelFits', None)
 
         #Secondary, scratch DB
         secondaryConf = copy.deepcopy(self.experimentNode.find("cactus_disk").find("st_kv_database_conf"))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Embedded primary databases, for runs where every job is on one node.
+
+Tokyo Cabinet keeps the cactus disk in files under the database_dir of
+its conf, which the cactus tools open directly. There is no server to
+start, no port to find and no network round trip per record, but the
+directory has to be visible to every job, so all the jobs must run on
+the same node. A snapshot is just a copy of the directory's files.
+
+A Tokyo Cabinet writer holds an exclusive lock on the DB's files until
+it closes them, which the cactus tools only do when they exit. The
+tools using a DB therefore run one at a time, for the whole of their
+run and not just while they read and write. cactus_call makes this
+explicit by taking a lock on each embedded DB a tool is given for as
+long as it runs (see lockEmbeddedDbs), so that concurrent jobs queue
+for the DB rather than fail to open it. Tools that don't use the DB,
+like the blast jobs, still run side by side.
+"""
+
+import os
+import re
+import fcntl
+import shutil
+import tarfile
+import tempfile
+from contextlib import contextmanager
+
+from sonLib.bioio import getTempDirectory
+
+# The DB types that the cactus tools open in-process
+EMBEDDED_DB_TYPES = ("tokyo_cabinet",)
+
+def isEmbeddedDb(dbElem):
+    return dbElem.getDbType() in EMBEDDED_DB_TYPES
+
+def getEmbeddedDbRootDir(fileStore):
+    """Get a directory that all the jobs on this node can see to keep the
+    DBs in (Toil's work dir, which is also what pooled Docker containers
+    mount)."""
+    workDir = getattr(fileStore.jobStore.config, 'workDir', None)
+    if workDir is None:
+        return tempfile.gettempdir()
+    return workDir
+
+def getSecondaryDbDir(dbDir):
+    """Get the directory of the secondary DB that goes with a primary DB."""
+    return dbDir + "_secondary"
+
+def getEmbeddedDbLockPath(dbDir):
+    """Get the lock file of a DB, which is kept out of its directory so
+    that it isn't saved in snapshots."""
+    return dbDir + ".lock"
+
+# The directory of an embedded DB in a conf string
+EMBEDDED_DB_DIR_RE = re.compile(r'<tokyo_cabinet [^>]*database_dir="([^"]+)"')
+
+def getEmbeddedDbDirs(parameters):
+    """Get the directories of the embedded DBs in the conf strings among
+    a tool's parameters, in the order they are locked in."""
+    dbDirs = set()
+    for parameter in parameters or []:
+        if isinstance(parameter, basestring):
+            dbDirs.update(EMBEDDED_DB_DIR_RE.findall(parameter))
+    return sorted(dbDirs)
+
+@contextmanager
+def lockEmbeddedDbs(parameters):
+    """Hold an exclusive lock on each of the embedded DBs a tool's
+    parameters point it to, waiting for any other job holding them."""
+    lockFiles = []
+    try:
+        # Always locked in the same order, so two tools can't each hold
+        # the DB the other is waiting for
+        for dbDir in getEmbeddedDbDirs(parameters):
+            lockFile = open(getEmbeddedDbLockPath(dbDir), 'a')
+            lockFiles.append(lockFile)
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        for lockFile in reversed(lockFiles):
+            # Closing the file releases the lock
+            lockFile.close()
+
+def saveEmbeddedDbSnapshot(dbDir, snapshotPath):
+    """Copy the files of a DB into a single (uncompressed) snapshot file."""
+    with tarfile.open(snapshotPath, 'w') as tar:
+        for name in sorted(os.listdir(dbDir)):
+            tar.add(os.path.join(dbDir, name), arcname=name)
+
+def restoreEmbeddedDbSnapshot(snapshotPath, dbDir):
+    """Copy the files in a snapshot file into the (existing) directory of a DB."""
+    with tarfile.open(snapshotPath) as tar:
+        for member in tar.getmembers():
+            if os.path.isabs(member.name) or member.name.startswith(".."):
+                raise RuntimeError("Unexpected path %s in DB snapshot %s" % (member.name, snapshotPath))
+        tar.extractall(dbDir)
+
+def startEmbeddedDb(dbElem, fileStore, existingSnapshotID=None):
+    """Give a DB a fresh directory, restoring the given snapshot into it.
+
+    Returns the updated dbElem."""
+    dbDir = getTempDirectory(rootDir=getEmbeddedDbRootDir(fileStore))
+    if existingSnapshotID is not None:
+        restoreEmbeddedDbSnapshot(fileStore.readGlobalFile(existingSnapshotID), dbDir)
+    dbElem.setDbDir(dbDir)
+    return dbElem
+
+def saveEmbeddedDb(dbElem, fileStore):
+    """Save a DB to the file store, returning the ID of the snapshot."""
+    snapshotPath = fileStore.getLocalTempFile()
+    saveEmbeddedDbSnapshot(dbElem.getDbDir(), snapshotPath)
+    return fileStore.writeGlobalFile(snapshotPath)
+
+def removeEmbeddedDb(job, dbDir):
+    """Job function deleting a DB and its secondary DB once they are no
+    longer needed."""
+    for path in (dbDir, getSecondaryDbDir(dbDir)):
+        shutil.rmtree(path, ignore_errors=True)
+        if os.path.exists(getEmbeddedDbLockPath(path)):
+            os.remove(getEmbeddedDbLockPath(path))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Compares the embedded (tokyo_cabinet) primary DB with a ktserver.
+
+Runs dbTestScript (built in dbTest/) as a number of concurrent clients
+on this node, each adding, getting and then setting its own range of
+records, and times each round. It then times saving a snapshot of the
+DB and loading it again: stopping the ktserver and restarting it from
+its snapshot, against copying the embedded DB's files.
+
+Needs dbTestScript and ktserver on the PATH.
+"""
+import os
+import time
+import shutil
+import signal
+import subprocess
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+
+from sonLib.bioio import getTempDirectory
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktserverControl import getKtserverCommand, blockUntilKtserverIsRunning, \
+    blockUntilKtserverIsFinished, KTSERVER_SNAPSHOT_NAME
+from cactus.pipeline.embeddedDb import saveEmbeddedDbSnapshot, restoreEmbeddedDbSnapshot
+
+def makeDbElem(dbType):
+    confElem = ET.Element("st_kv_database_conf", type=dbType)
+    ET.SubElement(confElem, dbType)
+    return DbElemWrapper(confElem)
+
+def runClients(dbElem, options, addRecords=False, setRecords=False, create=False):
+    """Run the clients concurrently and return the wall-clock time they took."""
+    start = time.time()
+    processes = []
+    for client in xrange(1 if create else options.clients):
+        command = ["dbTestScript", "--databaseConf", dbElem.getConfString(),
+                   "--firstKey", str(client * options.keysPerClient),
+                   "--keyNumber", str(0 if create else options.keysPerClient),
+                   "--minRecordSize", str(options.recordSize),
+                   "--maxRecordSize", str(options.recordSize)]
+        if addRecords:
+            command.append("--addRecords")
+        if setRecords:
+            command.append("--setRecords")
+        if create:
+            command.append("--create")
+        processes.append(subprocess.Popen(command))
+    for process in processes:
+        if process.wait() != 0:
+            raise RuntimeError("dbTestScript failed with exit code %i" % process.returncode)
+    return time.time() - start
+
+def runRounds(dbElem, options):
+    return [runClients(dbElem, options, addRecords=True),
+            runClients(dbElem, options),
+            runClients(dbElem, options, setRecords=True)]
+
+def startKtserver(dbElem, logPath, snapshotDir):
+    process = subprocess.Popen(getKtserverCommand(dbElem, logPath, snapshotDir))
+    if not blockUntilKtserverIsRunning(logPath, dbElem=dbElem):
+        raise RuntimeError("ktserver failed to start, see %s" % logPath)
+    return process
+
+def stopKtserver(process, logPath):
+    process.send_signal(signal.SIGINT)
+    process.wait()
+    blockUntilKtserverIsFinished(logPath)
+
+def benchmarkKtserver(options, workDir):
+    dbElem = makeDbElem("kyoto_tycoon")
+    dbElem.setDbHost("localhost")
+    dbElem.setDbPort(options.port)
+    snapshotDir = os.path.join(workDir, "snapshot")
+    os.mkdir(snapshotDir)
+    logPath = os.path.join(workDir, "ktserver.log")
+    process = startKtserver(dbElem, logPath, snapshotDir)
+    try:
+        times = runRounds(dbElem, options)
+    finally:
+        start = time.time()
+        stopKtserver(process, logPath)
+        saveTime = time.time() - start
+    snapshotSize = os.path.getsize(os.path.join(snapshotDir, KTSERVER_SNAPSHOT_NAME))
+    start = time.time()
+    process = startKtserver(dbElem, os.path.join(workDir, "ktserver2.log"), snapshotDir)
+    loadTime = time.time() - start
+    stopKtserver(process, os.path.join(workDir, "ktserver2.log"))
+    return times + [saveTime, loadTime, snapshotSize]
+
+def benchmarkEmbedded(options, workDir):
+    dbElem = makeDbElem("tokyo_cabinet")
+    dbElem.setDbDir(os.path.join(workDir, "db"))
+    runClients(dbElem, options, create=True)
+    times = runRounds(dbElem, options)
+    snapshotPath = os.path.join(workDir, "snapshot")
+    start = time.time()
+    saveEmbeddedDbSnapshot(dbElem.getDbDir(), snapshotPath)
+    saveTime = time.time() - start
+    restoredDir = os.path.join(workDir, "restored")
+    os.mkdir(restoredDir)
+    start = time.time()
+    restoreEmbeddedDbSnapshot(snapshotPath, restoredDir)
+    loadTime = time.time() - start
+    return times + [saveTime, loadTime, os.path.getsize(snapshotPath)]
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--keysPerClient", type=int, default=10000)
+    parser.add_argument("--recordSize", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=1978,
+                        help="Port to run the ktserver on")
+    parser.add_argument("--workDir", default=None,
+                        help="Directory to keep the DBs in (ideally on local SSD)")
+    options = parser.parse_args()
+
+    print "%-14s %9s %9s %9s %9s %9s %14s" % ("backend", "add (s)", "get (s)", "set (s)",
+                                              "save (s)", "load (s)", "snapshot (B)")
+    for name, benchmark in (("kyoto_tycoon", benchmarkKtserver), ("tokyo_cabinet", benchmarkEmbedded)):
+        workDir = getTempDirectory(rootDir=options.workDir)
+        try:
+            add, get, set, save, load, size = benchmark(options, workDir)
+        finally:
+            shutil.rmtree(workDir)
+        print "%-14s %9.2f %9.2f %9.2f %9.2f %9.2f %14i" % (name, add, get, set, save, load, size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import time
+import shutil
+import unittest
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.embeddedDb import isEmbeddedDb, startEmbeddedDb, saveEmbeddedDb, \
+                                       removeEmbeddedDb, getSecondaryDbDir, getEmbeddedDbDirs, \
+                                       lockEmbeddedDbs, getEmbeddedDbLockPath
+
+class FakeConfig(object):
+    def __init__(self, workDir):
+        self.workDir = workDir
+
+class FakeJobStore(object):
+    def __init__(self, workDir):
+        self.config = FakeConfig(workDir)
+
+class FakeFileStore(object):
+    """Just enough of a file store to start and save embedded DBs."""
+    def __init__(self, tempDir):
+        self.jobStore = FakeJobStore(tempDir)
+        self.tempDir = tempDir
+        self.files = {}
+
+    def getLocalTempFile(self):
+        return os.path.join(getTempDirectory(self.tempDir), "tmp")
+
+    def readGlobalFile(self, fileID):
+        return self.files[fileID]
+
+    def writeGlobalFile(self, localPath):
+        fileID = "file%i" % len(self.files)
+        self.files[fileID] = os.path.join(self.tempDir, fileID)
+        shutil.copyfile(localPath, self.files[fileID])
+        return fileID
+
+def makeDbElem(dbType):
+    return DbElemWrapper(ET.fromstring('<st_kv_database_conf type="%s"><%s/></st_kv_database_conf>'
+                                       % (dbType, dbType)))
+
+def writeToDb(confString, logPath, writer):
+    """Stand in for a tool writing to a DB, logging when it starts and
+    stops."""
+    def log(message):
+        with open(logPath, 'a') as f:
+            f.write("%s %i\n" % (message, writer))
+    with lockEmbeddedDbs(["cactus_tool", "--cactusDisk", confString]):
+        log("start")
+        time.sleep(0.1)
+        log("end")
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def testIsEmbeddedDb(self):
+        self.assertTrue(isEmbeddedDb(makeDbElem("tokyo_cabinet")))
+        self.assertFalse(isEmbeddedDb(makeDbElem("kyoto_tycoon")))
+
+    def testDbDirSurvivesConfString(self):
+        dbElem = makeDbElem("tokyo_cabinet")
+        dbElem.setDbDir("/some/dir")
+        self.assertEqual(DbElemWrapper(ET.fromstring(dbElem.getConfString())).getDbDir(), "/some/dir")
+        # The ktserver's dir is meaningless to the client, so it is always faked
+        dbElem = makeDbElem("kyoto_tycoon")
+        dbElem.setDbDir("/some/dir")
+        self.assertEqual(DbElemWrapper(ET.fromstring(dbElem.getConfString())).getDbDir(), "fakepath")
+
+    def testSaveAndRestore(self):
+        fileStore = FakeFileStore(self.tempDir)
+        dbElem = startEmbeddedDb(makeDbElem("tokyo_cabinet"), fileStore)
+        dbDir = dbElem.getDbDir()
+        self.assertTrue(os.path.isdir(dbDir))
+        self.assertEqual(os.listdir(dbDir), [])
+        contents = {"data": os.urandom(100000), "data.wal": "log"}
+        for name, data in contents.items():
+            with open(os.path.join(dbDir, name), 'wb') as f:
+                f.write(data)
+        snapshotID = saveEmbeddedDb(dbElem, fileStore)
+
+        restoredElem = startEmbeddedDb(makeDbElem("tokyo_cabinet"), fileStore, existingSnapshotID=snapshotID)
+        restoredDir = restoredElem.getDbDir()
+        self.assertNotEqual(restoredDir, dbDir)
+        self.assertEqual(sorted(os.listdir(restoredDir)), sorted(contents.keys()))
+        for name, data in contents.items():
+            with open(os.path.join(restoredDir, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        os.mkdir(getSecondaryDbDir(restoredDir))
+        removeEmbeddedDb(None, restoredDir)
+        self.assertFalse(os.path.exists(restoredDir))
+        self.assertFalse(os.path.exists(getSecondaryDbDir(restoredDir)))
+
+    def testGetEmbeddedDbDirs(self):
+        dbElem = makeDbElem("tokyo_cabinet")
+        dbElem.setDbDir("/some/dir")
+        secondaryElem = makeDbElem("tokyo_cabinet")
+        secondaryElem.setDbDir(getSecondaryDbDir("/some/dir"))
+        self.assertEqual(getEmbeddedDbDirs(["cactus_tool", "--cactusDisk", dbElem.getConfString(),
+                                            "--secondaryDisk", secondaryElem.getConfString(), 3]),
+                         ["/some/dir", "/some/dir_secondary"])
+        # A ktserver's dir is fake, and isn't locked
+        self.assertEqual(getEmbeddedDbDirs(["cactus_tool", makeDbElem("kyoto_tycoon").getConfString()]), [])
+        self.assertEqual(getEmbeddedDbDirs(None), [])
+
+    def testConcurrentWriters(self):
+        """Writers to the same embedded DB run one at a time."""
+        dbElem = startEmbeddedDb(makeDbElem("tokyo_cabinet"), FakeFileStore(self.tempDir))
+        logPath = os.path.join(self.tempDir, "log")
+        writers = [multiprocessing.Process(target=writeToDb, args=(dbElem.getConfString(), logPath, i))
+                   for i in xrange(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+            self.assertEqual(writer.exitcode, 0)
+        with open(logPath) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 8)
+        # Every writer finishes before the next starts
+        for start, end in zip(lines[::2], lines[1::2]):
+            self.assertTrue(start.startswith("start "))
+            self.assertEqual(end, start.replace("start", "end"))
+
+        self.assertTrue(os.path.exists(getEmbeddedDbLockPath(dbElem.getDbDir())))
+        removeEmbeddedDb(None, dbElem.getDbDir())
+        self.assertFalse(os.path.exists(getEmbeddedDbLockPath(dbElem.getDbDir())))
+
+if __name__ == '__main__':
+    unittest.main()
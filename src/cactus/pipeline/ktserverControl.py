@@ -4,8 +4,11 @@ Functions to launch and manage KyotoTycoon servers.
 """
 
 import os
+import errno
+import shutil
 import platform
 import random
+import select
 import socket
 import signal
 import sys
@@ -13,10 +16,12 @@ import traceback
 from contextlib import closing
 from glob import glob
 from multiprocessing import Process, Queue
-from time import sleep
+from time import sleep, time
 
 from toil.lib.bioio import logger
 from cactus.shared.common import cactus_call
+from cactus.shared.profiling import logLatency
+from cactus.pipeline.ktserverSnapshot import loadSnapshot, saveSnapshot, deleteSupersededChunks
 
 # For some reason ktserver believes there are only 32768 TCP ports.
 MAX_KTSERVER_PORT = 32767
@@ -24,99 +29,175 @@ MAX_KTSERVER_PORT = 32767
 # The name of the snapshot that KT outputs.
 KTSERVER_SNAPSHOT_NAME = "00000000.ktss"
 
-def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=None):
+# Messages on the control channel to the process babysitting a ktserver
+KTSERVER_TERMINATE = "TERMINATE"
+KTSERVER_SNAPSHOT = "SNAPSHOT"
+KTSERVER_SAVED = "SAVED"
+KTSERVER_FAILED = "FAILED"
+
+# Seconds between checks that the ktserver is still alive
+KTSERVER_CHECK_INTERVAL = 60
+
+# Times to start a ktserver on a new port if its port is taken before
+# it can bind it
+KTSERVER_START_ATTEMPTS = 10
+
+# Exit status of the process babysitting a ktserver if the ktserver
+# exited before starting without logging an error. In docker mode this
+# is how a taken port shows up, since docker reports it on its own
+# stderr rather than in the ktserver log.
+KTSERVER_EXITED_EARLY = 3
+
+# Seconds between the ktserver's background snapshots, unless asked for
+# more often: ~ 10 days, so they never trigger and only the snapshot
+# the DB creates on termination is written.
+KTSERVER_SNAPSHOT_INTERVAL = 1000000
+
+def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=None,
+                incrementalSnapshot=False, snapshotInterval=None):
     """
     Run a KTServer. This function launches a separate python process that manages the server.
 
-    Writing to the special key "TERMINATE" signals this thread to safely shut
-    down the DB and save the results. After finishing, the data will
-    eventually be written to snapshotFile.
+    The process listens on a control port (stored in the dbElem), and
+    stopKtserver sends it the message to safely shut down the DB and
+    save the results to snapshotExportID. If incrementalSnapshot is
+    set, the snapshot is saved as a manifest of chunks (see
+    ktserverSnapshot), uploading only what changed since the snapshot
+    the server was started from.
+
+    If snapshotInterval is given, the ktserver writes a snapshot in the
+    background every snapshotInterval seconds, and snapshotKtserver can
+    save one while the DB keeps running.
 
     Returns a tuple containing an updated version of the database config dbElem and the
     path to the log file.
     """
-    logPath = fileStore.getLocalTempFile()
     dbElem.setDbHost(getHostName())
-
-    # Find a suitable port to run on.
-    try:
-        occupiedPorts = findOccupiedPorts()
-        unoccupiedPorts = set(xrange(1025,MAX_KTSERVER_PORT)) - occupiedPorts
-        port = random.choice(list(unoccupiedPorts))
-    except:
-        logger.warning("Can't find which ports are occupied--likely netstat is not installed."
-                       " Choosing a random port to start the DB on, good luck!")
-        port = random.randint(1025,MAX_KTSERVER_PORT)
-    dbElem.setDbPort(port)
-
-    process = ServerProcess(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID)
-    process.daemon = True
-    process.start()
-
-    if not blockUntilKtserverIsRunning(logPath):
-        try:
-            with open(logPath) as f:
-                log = f.read()
-        except:
-            log = ''
-        raise RuntimeError("Unable to launch ktserver in time. Log: %s" % log)
-
-    return process, dbElem, logPath
+    startTime = time()
+    for attempt in xrange(KTSERVER_START_ATTEMPTS):
+        logPath = fileStore.getLocalTempFile()
+        dbElem.setDbPort(findFreePort())
+
+        # The control channel. The OS picks its port, and the socket is
+        # inherited by the server process.
+        controlSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        controlSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        controlSocket.bind(('', 0))
+        controlSocket.listen(16)
+        dbElem.setDbControlPort(controlSocket.getsockname()[1])
+
+        process = ServerProcess(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID,
+                                controlSocket=controlSocket, incrementalSnapshot=incrementalSnapshot,
+                                snapshotInterval=snapshotInterval)
+        process.daemon = True
+        process.start()
+        controlSocket.close()
+
+        if blockUntilKtserverIsRunning(logPath, dbElem=dbElem, isRunning=process.is_alive):
+            logLatency(fileStore, "ktserverStartup", startTime, time() - startTime)
+            return process, dbElem, logPath
+
+        log = readKtserverLog(logPath)
+        process.terminate()
+        process.join()
+        if not isPortInUseError(log) and process.exitcode != KTSERVER_EXITED_EARLY:
+            raise RuntimeError("Unable to launch ktserver in time. Log: %s" % log)
+        # Something else (most likely) bound the port between us
+        # checking it and the server binding it
+        logger.warning("Port %i was taken before the ktserver could bind it, retrying on another port"
+                       % dbElem.getDbPort())
+    raise RuntimeError("Unable to find a free port for the ktserver in %i attempts" % KTSERVER_START_ATTEMPTS)
 
 class ServerProcess(Process):
     """Independent process that babysits the ktserver process.
 
-    Waits for the TERMINATE flag to be set, then kills the DB and
-    copies the final snapshot to snapshotExportID.
+    Waits for a TERMINATE message on the control socket, then kills
+    the DB and copies the final snapshot to snapshotExportID. Everyone
+    who asked for termination is told once the snapshot is saved (or
+    that saving it failed). Until then, a SNAPSHOT message saves the
+    next background snapshot of the running DB to the file it names.
     """
-    exceptionMsg = Queue()
-
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
+        # Per process, so a failed attempt to start on a taken port
+        # doesn't leave its exception behind for the next attempt
+        self.exceptionMsg = Queue()
         super(ServerProcess, self).__init__()
 
     def run(self):
         """Run the tryRun method, signaling the main thread if an exception occurs."""
         try:
             self.tryRun(*self.args, **self.kwargs)
+        except KtserverExitedEarly:
+            self.exceptionMsg.put("".join(traceback.format_exception(*sys.exc_info())))
+            sys.exit(KTSERVER_EXITED_EARLY)
         except BaseException:
             self.exceptionMsg.put("".join(traceback.format_exception(*sys.exc_info())))
             raise
 
-    def tryRun(self, dbElem, logPath, fileStore, existingSnapshotID=None, snapshotExportID=None):
+    def tryRun(self, dbElem, logPath, fileStore, existingSnapshotID=None, snapshotExportID=None,
+               controlSocket=None, incrementalSnapshot=False, snapshotInterval=None):
+        clients = []
+        try:
+            self.runServer(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID,
+                           controlSocket, clients, incrementalSnapshot, snapshotInterval)
+        except:
+            replyToControlClients(controlSocket, clients, KTSERVER_FAILED)
+            raise
+        else:
+            replyToControlClients(controlSocket, clients, KTSERVER_SAVED)
+        finally:
+            controlSocket.close()
+
+    def runServer(self, dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID,
+                  controlSocket, clients, incrementalSnapshot, snapshotInterval):
         snapshotDir = os.path.join(fileStore.getLocalTempDir(), 'snapshot')
         os.mkdir(snapshotDir)
         snapshotPath = os.path.join(snapshotDir, KTSERVER_SNAPSHOT_NAME)
+        previousManifest = None
         if existingSnapshotID is not None:
             # Extract the existing snapshot to the snapshot
             # directory so it will be automatically loaded
-            fileStore.readGlobalFile(existingSnapshotID, userPath=snapshotPath)
+            previousManifest = loadSnapshot(fileStore, existingSnapshotID, snapshotPath)
+        loadedManifest = previousManifest
         process = cactus_call(server=True, shell=False,
-                              parameters=getKtserverCommand(dbElem, logPath, snapshotDir),
+                              parameters=getKtserverCommand(dbElem, logPath, snapshotDir,
+                                                            snapshotInterval=snapshotInterval),
                               port=dbElem.getDbPort())
 
-        blockUntilKtserverIsRunning(logPath)
-        if existingSnapshotID is not None:
-            # Clear the termination flag from the snapshot
-            cactus_call(parameters=["ktremotemgr", "remove"] + getRemoteParams(dbElem) + ["TERMINATE"])
-
-        while True:
-            # Check for the termination signal
+        if not blockUntilKtserverIsRunning(logPath, dbElem=dbElem, isRunning=lambda: process.poll() is None):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            elif not isKtserverLogFailed(logPath):
+                raise KtserverExitedEarly("KTServer exited with status %i before starting. Log: %s"
+                                          % (process.returncode, readKtserverLog(logPath)))
+            raise RuntimeError("KTServer failed to start. Log: %s" % readKtserverLog(logPath))
+
+        log = KtserverLog(logPath)
+        snapshotRequests = []
+        while len(clients) == 0:
+            # Wait for the termination message
             try:
-                cactus_call(parameters=["ktremotemgr", "get"] + getRemoteParams(dbElem) + ["TERMINATE"],
-                            swallowStdErr=True)
-            except:
-                # No terminate signal sent yet
-                pass
-            else:
-                # Terminate signal received
-                break
+                readable, _, _ = select.select([controlSocket], [], [], KTSERVER_CHECK_INTERVAL)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                acceptControlMessages(controlSocket, clients, snapshotRequests)
+                for connection, snapshotID in snapshotRequests:
+                    previousManifest = self.saveBackgroundSnapshot(process, fileStore, snapshotDir, snapshotPath,
+                                                                   snapshotID, connection, incrementalSnapshot,
+                                                                   previousManifest, loadedManifest)
+                del snapshotRequests[:]
+                continue
             # Check that the DB is still alive
-            if process.poll() is not None or isKtServerFailed(logPath):
+            log.update()
+            if process.poll() is not None or log.failed:
                 with open(logPath) as f:
                     raise RuntimeError("KTServer failed. Log: %s" % f.read())
-            sleep(60)
         process.send_signal(signal.SIGINT)
         process.wait()
         blockUntilKtserverIsFinished(logPath)
@@ -133,56 +214,242 @@ class ServerProcess(Process):
                     raise RuntimeError("KTServer left more than one snapshot. Log: %s" % f.read())
 
             # Export the snapshot file to the file store
-            fileStore.jobStore.updateFile(snapshotExportID, snapshotPath)
+            exportSnapshot(fileStore.jobStore, snapshotPath, snapshotExportID, incrementalSnapshot,
+                           previousManifest, loadedManifest)
+
+    def saveBackgroundSnapshot(self, process, fileStore, snapshotDir, snapshotPath, snapshotID,
+                               connection, incrementalSnapshot, previousManifest, loadedManifest):
+        """Save the next background snapshot of the running DB to
+        snapshotID, telling the connection that asked for it whether it
+        was saved. Returns the manifest for later incremental snapshots
+        to build on."""
+        try:
+            try:
+                copyPath = fileStore.getLocalTempFile()
+                os.remove(copyPath)
+                waitForBackgroundSnapshot(snapshotDir, snapshotPath, copyPath,
+                                          isRunning=lambda: process.poll() is None)
+                manifest = exportSnapshot(fileStore.jobStore, copyPath, snapshotID, incrementalSnapshot,
+                                          previousManifest, loadedManifest)
+                os.remove(copyPath)
+            except Exception:
+                logger.exception("Failed to save a background snapshot to %s" % snapshotID)
+                connection.sendall(KTSERVER_FAILED + "\n")
+                return previousManifest
+            connection.sendall(KTSERVER_SAVED + "\n")
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+        return manifest if incrementalSnapshot else previousManifest
+
+def exportSnapshot(jobStore, snapshotPath, snapshotExportID, incrementalSnapshot, previousManifest=None,
+                   loadedManifest=None):
+    """Upload a snapshot to snapshotExportID, as a manifest of chunks if
+    incrementalSnapshot is set, returning the manifest (or None). The
+    chunks of previousManifest, saved since loadedManifest was loaded,
+    that the new manifest doesn't use are then deleted."""
+    if incrementalSnapshot:
+        manifest, uploadedBytes = saveSnapshot(jobStore, snapshotPath, snapshotExportID,
+                                               previousManifest=previousManifest)
+        deletedChunks = deleteSupersededChunks(jobStore, previousManifest, manifest, loadedManifest)
+        logger.info("Saved a snapshot of %i bytes, uploading %i bytes of changed chunks"
+                    " and deleting %i superseded chunks"
+                    % (manifest['size'], uploadedBytes, deletedChunks))
+        return manifest
+    jobStore.updateFile(snapshotExportID, snapshotPath)
+    return None
+
+def waitForBackgroundSnapshot(snapshotDir, snapshotPath, copyPath, isRunning, pollInterval=1):
+    """Wait for the ktserver to finish a background snapshot that it began
+    after this was called, and link it to copyPath, so that the next one
+    can't replace it while it is being read.
+
+    The ktserver writes each snapshot to a temporary file in snapshotDir
+    and renames it to snapshotPath once it is complete, so a snapshot
+    that is already being written (anything else in the directory) may
+    have begun too early, and the one after it is waited for instead.
+    Raises a RuntimeError if isRunning() says the server has stopped."""
+    def getSnapshotVersion():
+        try:
+            stat = os.stat(snapshotPath)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime
+    version = getSnapshotVersion()
+    inProgress = any(path != snapshotPath for path in glob(os.path.join(snapshotDir, "*")))
+    snapshotsLeft = 2 if inProgress else 1
+    while True:
+        if not isRunning():
+            raise RuntimeError("KTServer stopped while waiting for a background snapshot")
+        sleep(pollInterval)
+        newVersion = getSnapshotVersion()
+        if newVersion is not None and newVersion != version:
+            version = newVersion
+            snapshotsLeft -= 1
+            if snapshotsLeft == 0:
+                break
+    try:
+        os.link(snapshotPath, copyPath)
+    except OSError:
+        # On another filesystem. The snapshot may be replaced while it
+        # is copied, but never in the middle of a complete one.
+        shutil.copyfile(snapshotPath, copyPath)
+
+def acceptControlMessages(controlSocket, clients, snapshotRequests=None):
+    """Accept a connection on the control socket, adding it to clients if
+    it asks for termination, or its connection and the file ID it asks
+    for a snapshot to be saved to to snapshotRequests, if given."""
+    connection, _ = controlSocket.accept()
+    # Don't let a misbehaving client hang the server
+    connection.settimeout(10)
+    try:
+        message = connection.makefile().readline().strip()
+    except socket.error:
+        message = None
+    if message == KTSERVER_TERMINATE:
+        connection.settimeout(None)
+        clients.append(connection)
+    elif message is not None and message.startswith(KTSERVER_SNAPSHOT + " ") and snapshotRequests is not None:
+        connection.settimeout(None)
+        snapshotRequests.append((connection, message[len(KTSERVER_SNAPSHOT) + 1:]))
+    else:
+        connection.close()
+
+def replyToControlClients(controlSocket, clients, reply):
+    """Tell everyone waiting on the control channel (including anyone
+    still queued) how the server finished."""
+    controlSocket.setblocking(0)
+    while True:
+        try:
+            acceptControlMessages(controlSocket, clients)
+        except socket.error:
+            # No more queued connections
+            break
+    for connection in clients:
+        try:
+            connection.sendall(reply + "\n")
+        except socket.error:
+            pass
+        connection.close()
+    del clients[:]
+
+class KtserverLog(object):
+    """Follows a ktserver log incrementally, so that each check only
+    reads what has been written since the last one."""
+    def __init__(self, logPath):
+        self.logPath = logPath
+        self.offset = 0
+        self.partialLine = ""
+        self.running = False
+        self.failed = False
+        self.finished = False
+
+    def update(self):
+        try:
+            f = open(self.logPath)
+        except IOError:
+            # Not created yet
+            return
+        with f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        lines = (self.partialLine + data).split("\n")
+        self.partialLine = lines.pop()
+        for line in lines:
+            lowerLine = line.lower()
+            if "listening" in lowerLine:
+                self.running = True
+            if "error" in lowerLine:
+                self.failed = True
+            if "[FINISH]" in line:
+                self.finished = True
+
+class KtserverExitedEarly(RuntimeError):
+    """The ktserver exited before starting, without logging an error."""
+    pass
+
+def readKtserverLog(logPath):
+    """Read a ktserver log, which is empty if the server never wrote it."""
+    try:
+        with open(logPath) as f:
+            return f.read()
+    except IOError:
+        return ''
+
+def isKtserverLogFailed(logPath):
+    """Does a ktserver log report an error?"""
+    log = KtserverLog(logPath)
+    log.update()
+    return log.failed
+
+def isKtserverAcceptingConnections(dbElem):
+    """Check if anything is accepting connections on the ktserver's port."""
+    try:
+        with closing(socket.create_connection((dbElem.getDbHost() or 'localhost', dbElem.getDbPort()),
+                                              timeout=1)):
+            return True
+    except socket.error:
+        return False
 
-def blockUntilKtserverIsRunning(logPath, createTimeout=1800):
+def blockUntilKtserverIsRunning(logPath, createTimeout=1800, dbElem=None, isRunning=None):
     """Check status until it's successful, an error is found, or we timeout.
 
+    If dbElem is given, the server's port is also probed, except in
+    docker mode, where docker accepts connections on the mapped port
+    before the server is listening. If isRunning is given, the server
+    also counts as failed once it returns False (the process running
+    the server, or babysitting it, has exited).
+
     Returns True if the ktserver is now running, False if something went wrong."""
-    success = False
-    for i in xrange(createTimeout):
-        if isKtServerFailed(logPath):
+    log = KtserverLog(logPath)
+    probePort = dbElem is not None and os.environ.get("CACTUS_BINARIES_MODE", "docker") != "docker"
+    startTime = time()
+    interval = 0.05
+    while time() - startTime < createTimeout:
+        log.update()
+        if log.failed:
             logger.critical('Error starting ktserver.')
-            success = False
-            break
-        if isKtServerRunning(logPath):
+            return False
+        if log.running or (probePort and isKtserverAcceptingConnections(dbElem)):
             logger.info('Ktserver running.')
-            success = True
-            break
-        sleep(1)
-    return success
+            return True
+        if isRunning is not None and not isRunning():
+            logger.critical('Ktserver process exited before the ktserver started.')
+            return False
+        sleep(interval)
+        interval = min(interval * 2, 1)
+    return False
 
 def blockUntilKtserverIsFinished(logPath, timeout=1800,
                                  timeStep=10):
     """Wait for the ktserver log to indicate that it shut down properly.
 
-    Returns True if the server shut down, False if the timeout expired."""
-    for i in xrange(0, timeout, timeStep):
-        with open(logPath) as f:
-            log = f.read()
-            if '[FINISH]' in log:
-                return True
-        sleep(timeStep)
+    Returns True if the server shut down, raises a RuntimeError if the
+    timeout expired."""
+    log = KtserverLog(logPath)
+    startTime = time()
+    interval = 0.05
+    while time() - startTime < timeout:
+        log.update()
+        if log.finished:
+            return True
+        sleep(interval)
+        interval = min(interval * 2, timeStep)
     raise RuntimeError("Timeout reached while waiting for ktserver.")
 
 def isKtServerRunning(logPath):
     """Check if the server started running."""
-    success = False
-    with open(logPath) as f:
-        for line in f:
-            if line.lower().find("listening") >= 0:
-                success = True
-    return success
+    log = KtserverLog(logPath)
+    log.update()
+    return log.running
 
 def isKtServerFailed(logPath):
     """Does the server log contain an error?"""
-    isFailed = False
-    with open(logPath) as f:
-        for line in f:
-            if line.lower().find("error") >= 0:
-                isFailed = True
-                break
-    return isFailed
+    log = KtserverLog(logPath)
+    log.update()
+    return log.failed
 
 def getKtTuningOptions(dbElem):
     """Get the appropriate KTServer tuning parameters (bucket size, etc.)"""
@@ -196,6 +463,66 @@ def getKtTuningOptions(dbElem):
         tuningOptions = dbElem.getDbCreateTuningOptions()
     return tuningOptions
 
+# Records per base of input sequence that the primary DB holds by the
+# start of each checkpoint. Setup only writes the sequences, which
+# cactusDisk stores in records of CACTUS_DISK_SEQUENCE_CHUNK_SIZE (500)
+# bases, so 1/500 a base, and the first flower. caf and bar then add a
+# record for each flower (holding its caps, segments, chains and
+# groups), and reference adds the reference sequences and their
+# flowers. The later figures are estimates rather than measurements,
+# allowing for about a flower every 125 bases, on the high side
+# because too few buckets slow every lookup, while too many only cost
+# a few bytes each. To check them, compare the record count that
+# "ktremotemgr report" gives at each checkpoint with the input size.
+KT_RECORDS_PER_BASE = {"setup": 0.002, "bar": 0.01, "reference": 0.015, "hal": 0.015}
+
+# Bounds on the auto-tuned parameters
+MIN_KT_BUCKETS = 1000000
+MAX_KT_BUCKETS = 2000000000
+MIN_KT_THREADS = 8
+MAX_KT_THREADS = 128
+
+# The fraction of a ktserver's memory given to the memory map. Pages
+# of the map (the bucket array, then the records) count towards the
+# server's memory as they are touched, so the map can't have all of
+# it: the rest is for the server's heap, which holds the request and
+# response buffers of each worker thread (a large flower's record runs
+# to many megabytes, and there are up to MAX_KT_THREADS threads) and the
+# compression buffers of the background snapshots. A fifth is a
+# margin chosen to cover those, not a measured figure; records past
+# the map are still read, just more slowly.
+KT_MSIZ_FRACTION = 0.8
+
+def getAutoKtTuning(totalSequenceSize, numGenomes, phase, memory, shards=1):
+    """Size a primary ktserver for the input and the phase it is started
+    for, or for the largest of a list of phases it will serve.
+
+    The bucket count (bnum) is twice the expected number of records of
+    each shard, as Kyoto's hash DB recommends, and the memory map (msiz)
+    is most of the memory the server is given. The worker threads (-th)
+    follow the number of jobs that can hit the DB at once, which grows
+    with the number of genomes except during setup.
+
+    Returns a dict of the bnum, msiz and threads."""
+    phases = phase if isinstance(phase, (list, tuple)) else [phase]
+    recordsPerBase = max(KT_RECORDS_PER_BASE.get(phase, max(KT_RECORDS_PER_BASE.values())) for phase in phases)
+    records = recordsPerBase * totalSequenceSize / shards
+    bnum = int(min(MAX_KT_BUCKETS, max(MIN_KT_BUCKETS, 2 * records)))
+    if all(phase == "setup" for phase in phases):
+        threads = MIN_KT_THREADS
+    else:
+        threads = int(min(MAX_KT_THREADS, max(MIN_KT_THREADS, 8 * numGenomes)))
+    return {'bnum': bnum, 'msiz': int(memory * KT_MSIZ_FRACTION), 'threads': threads}
+
+def setAutoKtTuning(dbElem, tuning):
+    """Apply auto-tuned parameters to the ktserver options of a dbElem,
+    keeping any options given explicitly in the experiment."""
+    if dbElem.getDbTuningOptions() is None and dbElem.getDbCreateTuningOptions() is None:
+        dbElem.setDbTuningOptions("#opts=ls#bnum=%i#msiz=%i#ktopts=p" % (tuning['bnum'], tuning['msiz']))
+    if dbElem.getDbServerOptions() is None:
+        dbElem.setDbServerOptions("-ls -tout 200000 -th %i" % tuning['threads'])
+    return dbElem
+
 def getKtServerOptions(dbElem):
     # these are some hardcoded defaults.  should think about moving to config
     serverOptions = "-ls -tout 200000 -th 64"
@@ -203,16 +530,17 @@ def getKtServerOptions(dbElem):
         serverOptions = dbElem.getDbServerOptions()
     return serverOptions
 
-def getKtserverCommand(dbElem, logPath, snapshotDir):
+def getKtserverCommand(dbElem, logPath, snapshotDir, snapshotInterval=None):
     """Get a ktserver command line with the proper options (in popen-type list format)."""
     serverOptions = getKtServerOptions(dbElem)
     tuning = getKtTuningOptions(dbElem)
     cmd = ["ktserver", "-port", str(dbElem.getDbPort())]
     cmd += serverOptions.split()
-    # Configure background snapshots, but set the interval between
-    # snapshots to ~ 10 days so it'll never trigger. We are only
-    # interested in the snapshot that the DB creates on termination.
-    cmd += ["-bgs", snapshotDir, "-bgsc", "lzo", "-bgsi", "1000000"]
+    # Configure background snapshots. Unless an interval is given, we are
+    # only interested in the snapshot that the DB creates on termination.
+    if snapshotInterval is None:
+        snapshotInterval = KTSERVER_SNAPSHOT_INTERVAL
+    cmd += ["-bgs", snapshotDir, "-bgsc", "lzo", "-bgsi", str(snapshotInterval)]
     cmd += ["-log", logPath]
     cmd += [":" + tuning]
     return cmd
@@ -223,13 +551,47 @@ def getRemoteParams(dbElem):
     return ['-port', str(dbElem.getDbPort()),
             '-host', host]
 
-def stopKtserver(dbElem):
-    """Attempt to send the terminate signal to a ktserver."""
+def sendKtserverControlMessage(dbElem, message):
+    """Send a message to the process babysitting a ktserver, returning its
+    reply, or None if it couldn't be contacted."""
+    controlPort = dbElem.getDbControlPort()
+    if controlPort is None:
+        return None
     try:
-        cactus_call(parameters=['ktremotemgr', 'set'] + getRemoteParams(dbElem) + ['TERMINATE', '1'])
-    except:
-        # The server is likely already down.
-        pass
+        connection = socket.create_connection((dbElem.getDbHost() or 'localhost', controlPort))
+    except socket.error:
+        return None
+    with closing(connection):
+        try:
+            connection.sendall(message + "\n")
+            return connection.makefile().readline().strip()
+        except socket.error:
+            return None
+
+def stopKtserver(dbElem):
+    """Tell the process babysitting a ktserver to shut it down and save
+    its snapshot, blocking until that's done.
+
+    Returns True once the snapshot is saved, or False if the server
+    couldn't be contacted (likely because it is already down). Raises
+    a RuntimeError if the server failed while shutting down."""
+    reply = sendKtserverControlMessage(dbElem, KTSERVER_TERMINATE)
+    if reply == KTSERVER_FAILED:
+        raise RuntimeError("KTServer at %s:%s failed while shutting down" % (dbElem.getDbHost(), dbElem.getDbPort()))
+    return reply == KTSERVER_SAVED
+
+def snapshotKtserver(dbElem, snapshotID):
+    """Tell the process babysitting a ktserver started with a
+    snapshotInterval to save the next background snapshot of the DB to
+    snapshotID, blocking until that's done. The DB should not be written
+    to meanwhile.
+
+    Returns True once the snapshot is saved, or False if the server
+    couldn't be contacted. Raises a RuntimeError if saving it failed."""
+    reply = sendKtserverControlMessage(dbElem, "%s %s" % (KTSERVER_SNAPSHOT, snapshotID))
+    if reply == KTSERVER_FAILED:
+        raise RuntimeError("KTServer at %s:%s failed to save a snapshot" % (dbElem.getDbHost(), dbElem.getDbPort()))
+    return reply == KTSERVER_SAVED
 
 def getHostName():
     if platform.system() == 'Darwin':
@@ -260,18 +622,29 @@ def getPublicIP():
         # to provide a default argument
         return '127.0.0.1'
 
-def findOccupiedPorts():
-    """Attempt to find all currently taken TCP ports.
-
-    Returns a set of ints, representing taken ports."""
-    netstatOutput = cactus_call(parameters=["netstat", "-tuplen"], check_output=True)
-    ports = set()
-    for line in netstatOutput.split("\n"):
-        fields = line.split()
-        if len(fields) != 9:
-            # Header or other garbage line
-            continue
-        port = int(fields[3].split(':')[-1])
-        ports.add(port)
-    logger.debug('Detected ports in use: %s' % repr(ports))
-    return ports
+def findFreePort(attempts=1000, choosePort=None):
+    """Find a TCP port that nothing on this node is bound to, by binding it.
+
+    Ports are chosen below MAX_KTSERVER_PORT, out of the kernel's
+    ephemeral range, so that outgoing connections can't take the port
+    before the ktserver binds it. choosePort() picks the port to try
+    next (by default, at random)."""
+    if choosePort is None:
+        choosePort = lambda: random.randint(1025, MAX_KTSERVER_PORT)
+    for attempt in xrange(attempts):
+        port = choosePort()
+        testSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            testSocket.bind(('', port))
+            return port
+        except socket.error as e:
+            if e.errno not in (errno.EADDRINUSE, errno.EACCES):
+                raise
+        finally:
+            testSocket.close()
+    raise RuntimeError("Unable to find a free port in %i attempts" % attempts)
+
+def isPortInUseError(log):
+    """Does a ktserver log say that it couldn't bind its port?"""
+    lowerLog = log.lower()
+    return "bind failed" in lowerLog or "address already in use" in lowerLog
@@ -0,0 +1,134 @@
+import os
+import socket
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from contextlib import closing
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktserverControl import getAutoKtTuning, setAutoKtTuning, \
+                                            getKtTuningOptions, getKtServerOptions, \
+                                            findFreePort, isPortInUseError, waitForBackgroundSnapshot, \
+                                            getKtserverCommand, MAX_KTSERVER_PORT, \
+                                            MIN_KT_BUCKETS, MAX_KT_BUCKETS, \
+                                            MIN_KT_THREADS, MAX_KT_THREADS
+
+def makeDbElem(**attribs):
+    dbElem = ET.fromstring('<st_kv_database_conf type="kyoto_tycoon"><kyoto_tycoon/></st_kv_database_conf>')
+    dbElem.find("kyoto_tycoon").attrib.update(attribs)
+    return DbElemWrapper(dbElem)
+
+class TestCase(unittest.TestCase):
+    def testAutoKtTuning(self):
+        # A small bacterial run gets the minimum
+        small = getAutoKtTuning(5 * 10**6, 5, "setup", 2500000000)
+        self.assertEquals(MIN_KT_BUCKETS, small['bnum'])
+        self.assertEquals(MIN_KT_THREADS, small['threads'])
+        # Some of the memory is left for the server's heap and threads
+        self.assertEquals(2000000000, small['msiz'])
+
+        # The buckets grow with the input and with the phase, and are
+        # divided between the shards
+        medium = getAutoKtTuning(10**10, 20, "bar", 50 * 10**9)
+        self.assertTrue(medium['bnum'] > getAutoKtTuning(10**10, 20, "setup", 50 * 10**9)['bnum'])
+        self.assertTrue(medium['bnum'] > getAutoKtTuning(10**10, 20, "bar", 50 * 10**9, shards=4)['bnum'])
+
+        # A 600-genome run is capped
+        big = getAutoKtTuning(600 * 3 * 10**9, 600, "bar", 100 * 10**9)
+        self.assertEquals(MAX_KT_BUCKETS, big['bnum'])
+        self.assertEquals(MAX_KT_THREADS, big['threads'])
+        self.assertEquals(40, getAutoKtTuning(10**9, 5, "reference", 10**9)['threads'])
+
+        # A server kept running through several phases is sized for the
+        # largest
+        warm = getAutoKtTuning(10**10, 20, ["setup", "bar", "reference", "hal"], 50 * 10**9)
+        reference = getAutoKtTuning(10**10, 20, "reference", 50 * 10**9)
+        self.assertEquals(reference['bnum'], warm['bnum'])
+        self.assertEquals(reference['threads'], warm['threads'])
+
+    def testSetAutoKtTuning(self):
+        tuning = {'bnum': 2000000, 'msiz': 3000000000, 'threads': 16}
+        dbElem = setAutoKtTuning(makeDbElem(), tuning)
+        self.assertEquals("#opts=ls#bnum=2000000#msiz=3000000000#ktopts=p", getKtTuningOptions(dbElem))
+        self.assertEquals("-ls -tout 200000 -th 16", getKtServerOptions(dbElem))
+
+        # Options given in the experiment are kept
+        dbElem = setAutoKtTuning(makeDbElem(tuning_options="#bnum=5", server_options="-th 2"), tuning)
+        self.assertEquals("#bnum=5", getKtTuningOptions(dbElem))
+        self.assertEquals("-th 2", getKtServerOptions(dbElem))
+
+    def testFindFreePort(self):
+        port = findFreePort()
+        self.assertTrue(1025 <= port <= MAX_KTSERVER_PORT)
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+            s.bind(('', port))
+
+        # A port that is taken is skipped
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as taken:
+            taken.bind(('', 0))
+            takenPort = taken.getsockname()[1]
+            ports = iter([takenPort, port])
+            self.assertEquals(port, findFreePort(choosePort=lambda: next(ports)))
+
+    def testIsPortInUseError(self):
+        self.assertTrue(isPortInUseError("2017-01-01T00:00:00: [ERROR]: socket error: expr=:1978: msg=bind failed"))
+        self.assertFalse(isPortInUseError("2017-01-01T00:00:00: [ERROR]: could not open the database"))
+
+    def testWaitForBackgroundSnapshot(self):
+        tempDir = getTempDirectory(os.getcwd())
+        try:
+            snapshotDir = os.path.join(tempDir, "snapshot")
+            os.mkdir(snapshotDir)
+            snapshotPath = os.path.join(snapshotDir, "00000000.ktss")
+            def writeSnapshot(contents):
+                # As the ktserver does: to a temporary file, then renamed
+                with open(snapshotPath + ".tmp", 'w') as f:
+                    f.write(contents)
+                os.rename(snapshotPath + ".tmp", snapshotPath)
+            writeSnapshot("old")
+
+            # The snapshot already there is too old, so the next one is
+            # waited for
+            copyPath = os.path.join(tempDir, "copy1")
+            writer = threading.Timer(0.1, writeSnapshot, ["new"])
+            writer.start()
+            waitForBackgroundSnapshot(snapshotDir, snapshotPath, copyPath, isRunning=lambda: True,
+                                      pollInterval=0.01)
+            writer.join()
+            with open(copyPath) as f:
+                self.assertEquals("new", f.read())
+
+            # One being written may have begun too early, so the one after
+            # it is waited for
+            with open(snapshotPath + ".tmp", 'w') as f:
+                f.write("begun early")
+            def writeSnapshots():
+                os.rename(snapshotPath + ".tmp", snapshotPath)
+                time.sleep(0.1)
+                writeSnapshot("newer")
+            writer = threading.Timer(0.1, writeSnapshots)
+            writer.start()
+            copyPath = os.path.join(tempDir, "copy2")
+            waitForBackgroundSnapshot(snapshotDir, snapshotPath, copyPath, isRunning=lambda: True,
+                                      pollInterval=0.01)
+            writer.join()
+            with open(copyPath) as f:
+                self.assertEquals("newer", f.read())
+
+            self.assertRaises(RuntimeError, waitForBackgroundSnapshot, snapshotDir, snapshotPath,
+                              os.path.join(tempDir, "copy3"), isRunning=lambda: False)
+        finally:
+            system("rm -rf %s" % tempDir)
+
+    def testSnapshotInterval(self):
+        dbElem = makeDbElem(port="1978")
+        command = getKtserverCommand(dbElem, "log", "snapshot")
+        self.assertEquals("1000000", command[command.index("-bgsi") + 1])
+        command = getKtserverCommand(dbElem, "log", "snapshot", snapshotInterval=600)
+        self.assertEquals("600", command[command.index("-bgsi") + 1])
+
+if __name__ == '__main__':
+    unittest.main()
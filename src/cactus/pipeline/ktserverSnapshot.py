@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Incremental storage of KyotoTycoon snapshots in the job store.
+
+A snapshot is split into content-defined chunks: after at least
+minChunkSize bytes, a chunk ends just after the next occurrence of a
+marker, or at maxChunkSize bytes if there is none. An edit in one part
+of the snapshot therefore only changes the chunks around it. Each
+chunk is stored in the job store once, and a snapshot is saved as a
+manifest listing its chunks. A snapshot saved after one that was
+loaded from a manifest only uploads the chunks that the loaded one
+doesn't already have. Loading a manifest composes the chunks back into
+the full snapshot file that ktserver expects.
+
+Once a server has saved a new snapshot, the chunks of the one it saved
+before that the new one no longer uses are deleted. The chunks of the
+snapshot it was loaded from, which its checkpoint restarts from, are
+kept.
+"""
+
+import os
+import json
+import mmap
+import hashlib
+
+SNAPSHOT_MANIFEST_MAGIC = "cactus-ktserver-snapshot-manifest\n"
+
+# An arbitrary pair of bytes to cut chunks after
+CHUNK_MARKER = "\x9e\x37"
+
+DEFAULT_MIN_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+def findChunks(data, minChunkSize=DEFAULT_MIN_CHUNK_SIZE, maxChunkSize=DEFAULT_MAX_CHUNK_SIZE):
+    """Get the (offset, length) of the chunks of a string or mmap."""
+    assert 0 < minChunkSize <= maxChunkSize
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        end = min(offset + maxChunkSize, len(data))
+        if offset + minChunkSize < end:
+            i = data.find(CHUNK_MARKER, offset + minChunkSize, end)
+            if i != -1:
+                end = min(i + len(CHUNK_MARKER), end)
+        chunks.append((offset, end - offset))
+        offset = end
+    return chunks
+
+def isSnapshotManifest(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SNAPSHOT_MANIFEST_MAGIC)) == SNAPSHOT_MANIFEST_MAGIC
+
+def readSnapshotManifest(path):
+    with open(path, 'rb') as f:
+        assert f.read(len(SNAPSHOT_MANIFEST_MAGIC)) == SNAPSHOT_MANIFEST_MAGIC
+        return json.load(f)
+
+def writeSnapshotManifest(manifest, path):
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_MANIFEST_MAGIC)
+        json.dump(manifest, f)
+
+def composeSnapshot(jobStore, manifest, snapshotPath):
+    """Write the full snapshot described by a manifest to snapshotPath."""
+    with open(snapshotPath, 'wb') as out:
+        for digest, fileID, length in manifest['chunks']:
+            with jobStore.readFileStream(fileID) as f:
+                data = f.read()
+            if len(data) != length:
+                raise RuntimeError("Snapshot chunk %s has %i bytes, but %i were expected"
+                                   % (fileID, len(data), length))
+            out.write(data)
+
+def loadSnapshot(fileStore, snapshotID, snapshotPath):
+    """Read a snapshot (either a plain snapshot file or a manifest) from the
+    job store to snapshotPath. Returns the manifest, or None if the
+    snapshot wasn't stored as one."""
+    fileStore.readGlobalFile(snapshotID, userPath=snapshotPath)
+    if not isSnapshotManifest(snapshotPath):
+        return None
+    manifest = readSnapshotManifest(snapshotPath)
+    composeSnapshot(fileStore.jobStore, manifest, snapshotPath)
+    return manifest
+
+def saveSnapshot(jobStore, snapshotPath, snapshotExportID, previousManifest=None,
+                 minChunkSize=DEFAULT_MIN_CHUNK_SIZE, maxChunkSize=DEFAULT_MAX_CHUNK_SIZE):
+    """Save a snapshot to snapshotExportID as a manifest, uploading only
+    the chunks not in previousManifest. Returns the manifest and the
+    number of bytes uploaded."""
+    knownChunks = {}
+    if previousManifest is not None:
+        for digest, fileID, length in previousManifest['chunks']:
+            knownChunks[digest] = fileID
+    manifest = {'size': os.path.getsize(snapshotPath), 'chunks': []}
+    uploadedBytes = 0
+    if manifest['size'] > 0:
+        with open(snapshotPath, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset, length in findChunks(data, minChunkSize, maxChunkSize):
+                    chunk = data[offset:offset + length]
+                    digest = hashlib.sha1(chunk).hexdigest()
+                    if digest not in knownChunks:
+                        with jobStore.writeFileStream() as (chunkFile, fileID):
+                            chunkFile.write(chunk)
+                        knownChunks[digest] = fileID
+                        uploadedBytes += length
+                    manifest['chunks'].append([digest, knownChunks[digest], length])
+            finally:
+                data.close()
+    manifestPath = snapshotPath + ".manifest"
+    writeSnapshotManifest(manifest, manifestPath)
+    jobStore.updateFile(snapshotExportID, manifestPath)
+    os.remove(manifestPath)
+    return manifest, uploadedBytes
+
+def deleteSupersededChunks(jobStore, oldManifest, newManifest, loadedManifest=None):
+    """Delete the chunks of oldManifest that the (already saved)
+    newManifest doesn't use, apart from those of loadedManifest. Returns
+    the number of chunks deleted."""
+    if oldManifest is None or oldManifest is loadedManifest:
+        return 0
+    keptIDs = set(fileID for _, fileID, _ in newManifest['chunks'])
+    if loadedManifest is not None:
+        keptIDs.update(fileID for _, fileID, _ in loadedManifest['chunks'])
+    deletedIDs = set(fileID for _, fileID, _ in oldManifest['chunks']) - keptIDs
+    for fileID in deletedIDs:
+        jobStore.deleteFile(fileID)
+    return len(deletedIDs)
+
+def getFullSnapshotID(fileStore, snapshotID):
+    """Get the ID of a plain snapshot file with the contents of the given
+    snapshot, composing it first if it was stored as a manifest."""
+    path = os.path.join(fileStore.getLocalTempDir(), "snapshot")
+    fileStore.readGlobalFile(snapshotID, userPath=path)
+    if not isSnapshotManifest(path):
+        return snapshotID
+    composeSnapshot(fileStore.jobStore, readSnapshotManifest(path), path)
+    return fileStore.writeGlobalFile(path)
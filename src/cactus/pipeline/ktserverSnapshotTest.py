@@ -0,0 +1,135 @@
+import os
+import random
+import shutil
+import unittest
+from contextlib import contextmanager
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.pipeline.ktserverSnapshot import CHUNK_MARKER, findChunks, isSnapshotManifest, \
+                                             loadSnapshot, saveSnapshot, getFullSnapshotID, \
+                                             deleteSupersededChunks
+
+class FakeJobStore(object):
+    """Just enough of a job store to save and load snapshots."""
+    def __init__(self):
+        self.files = {}
+
+    @contextmanager
+    def writeFileStream(self):
+        fileID = "file%i" % len(self.files)
+        path = os.path.join(self.tempDir, fileID)
+        with open(path, 'wb') as f:
+            yield f, fileID
+        self.files[fileID] = path
+
+    @contextmanager
+    def readFileStream(self, fileID):
+        with open(self.files[fileID], 'rb') as f:
+            yield f
+
+    def updateFile(self, fileID, localPath):
+        shutil.copyfile(localPath, self.files[fileID])
+
+    def deleteFile(self, fileID):
+        os.remove(self.files.pop(fileID))
+
+class FakeFileStore(object):
+    def __init__(self, jobStore, tempDir):
+        self.jobStore = jobStore
+        self.tempDir = tempDir
+
+    def getLocalTempDir(self):
+        return getTempDirectory(self.tempDir)
+
+    def readGlobalFile(self, fileID, userPath):
+        shutil.copyfile(self.jobStore.files[fileID], userPath)
+        return userPath
+
+    def writeGlobalFile(self, localPath):
+        with self.jobStore.writeFileStream() as (f, fileID):
+            with open(localPath, 'rb') as localFile:
+                f.write(localFile.read())
+        return fileID
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def testFindChunks(self):
+        data = "a" * 10 + CHUNK_MARKER + "b" * 3 + CHUNK_MARKER + "c" * 30
+        self.assertEquals([(0, 12), (12, 5), (17, 20), (37, 10)], findChunks(data, 2, 20))
+        # Chunks are at least minChunkSize, apart from the last
+        self.assertEquals([(0, 17), (17, 20), (37, 10)], findChunks(data, 11, 20))
+        self.assertEquals([], findChunks("", 2, 20))
+
+    def testSaveAndLoad(self):
+        jobStore = FakeJobStore()
+        jobStore.tempDir = self.tempDir
+        fileStore = FakeFileStore(jobStore, self.tempDir)
+        random.seed(1)
+        # Markers turn up about every 64KB in random data, so put them
+        # in more often to get small chunks
+        records = ["".join(chr(random.randint(0, 255)) for i in xrange(98)) + CHUNK_MARKER
+                   for j in xrange(1000)]
+
+        def save(path, previousManifest):
+            with open(path, 'wb') as f:
+                f.write("".join(records))
+            with jobStore.writeFileStream() as (f, exportID):
+                pass
+            manifest, uploadedBytes = saveSnapshot(jobStore, path, exportID, previousManifest,
+                                                   minChunkSize=1000, maxChunkSize=20000)
+            return exportID, uploadedBytes
+
+        path = os.path.join(self.tempDir, "snapshot")
+        firstID, uploadedBytes = save(path, None)
+        self.assertEquals(100000, uploadedBytes)
+
+        # Restore it, change a record and save again: only the chunks
+        # around the change should be uploaded
+        loadPath = os.path.join(self.tempDir, "loaded")
+        manifest = loadSnapshot(fileStore, firstID, loadPath)
+        with open(loadPath, 'rb') as f:
+            self.assertEquals("".join(records), f.read())
+        records[500] = "changed"
+        secondID, uploadedBytes = save(path, manifest)
+        self.assertTrue(0 < uploadedBytes < 20000)
+
+        manifest = loadSnapshot(fileStore, secondID, loadPath)
+        with open(loadPath, 'rb') as f:
+            self.assertEquals("".join(records), f.read())
+
+        # Full snapshots are passed through, manifests are composed
+        fullID = getFullSnapshotID(fileStore, secondID)
+        self.assertNotEquals(secondID, fullID)
+        self.assertFalse(isSnapshotManifest(jobStore.files[fullID]))
+        self.assertEquals(fullID, getFullSnapshotID(fileStore, fullID))
+        self.assertEquals(None, loadSnapshot(fileStore, fullID, loadPath))
+
+    def testDeleteSupersededChunks(self):
+        jobStore = FakeJobStore()
+        jobStore.tempDir = self.tempDir
+        def chunk(fileID):
+            return ["digest-" + fileID, fileID, 1]
+        for fileID in ["loaded", "shared", "old", "new"]:
+            with open(os.path.join(self.tempDir, fileID), 'w') as f:
+                f.write("x")
+            jobStore.files[fileID] = os.path.join(self.tempDir, fileID)
+        loaded = {'chunks': [chunk("loaded"), chunk("shared")]}
+        old = {'chunks': [chunk("loaded"), chunk("shared"), chunk("old")]}
+        new = {'chunks': [chunk("shared"), chunk("new")]}
+        # Nothing saved since the load is deleted
+        self.assertEquals(0, deleteSupersededChunks(jobStore, loaded, new, loaded))
+        # Only the chunks saved since the load that are no longer used
+        # go, the loaded snapshot's chunks are kept for a restart
+        self.assertEquals(1, deleteSupersededChunks(jobStore, old, new, loaded))
+        self.assertEquals(["loaded", "new", "shared"], sorted(jobStore.files))
+
+if __name__ == '__main__':
+    unittest.main()
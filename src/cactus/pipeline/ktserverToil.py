@@ -6,41 +6,58 @@
 
 import os
 import stat
+import time
+import xml.etree.ElementTree as ET
 from toil.job import Job
 from cactus.pipeline.ktserverControl import runKtserver, blockUntilKtserverIsRunning, stopKtserver, \
     blockUntilKtserverIsFinished
+from cactus.shared.profiling import logLatency
+from cactus.shared.experimentWrapper import DbElemWrapper
 
 class KtServerService(Job.Service):
-    def __init__(self, dbElem, isSecondary, existingSnapshotID=None,
-                 memory=None, cores=None, disk=None):
+    def __init__(self, dbElem, isSecondary, existingSnapshotID=None, incrementalSnapshot=False,
+                 snapshotInterval=None, memory=None, cores=None, disk=None):
         Job.Service.__init__(self, memory=memory, cores=cores, disk=disk, preemptable=False)
         self.dbElem = dbElem
         self.isSecondary = isSecondary
         self.existingSnapshotID = existingSnapshotID
+        self.incrementalSnapshot = incrementalSnapshot
+        self.snapshotInterval = snapshotInterval
         self.failed = False
         self.process = None
 
     def start(self, job):
-        snapshotExportID = job.fileStore.jobStore.getEmptyFileStoreID()
-        # We need to run this garbage in case we are on a file-based
-        # jobStore with caching enabled. The caching jobStore sets
-        # this empty file to be unwritable for some reason. Since we
-        # need to write something to it, obviously that won't do.
-        path = job.fileStore.readGlobalFile(snapshotExportID)
-        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
+        snapshotExportID = None
+        if not self.isSecondary:
+            # Secondary DBs are thrown away, so there's no need to
+            # save them.
+            snapshotExportID = job.fileStore.jobStore.getEmptyFileStoreID()
+            # We need to run this garbage in case we are on a file-based
+            # jobStore with caching enabled. The caching jobStore sets
+            # this empty file to be unwritable for some reason. Since we
+            # need to write something to it, obviously that won't do.
+            path = job.fileStore.readGlobalFile(snapshotExportID)
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
         self.process, self.dbElem, self.logPath = runKtserver(self.dbElem, fileStore=job.fileStore,
                                                               existingSnapshotID=self.existingSnapshotID,
-                                                              snapshotExportID=snapshotExportID)
+                                                              snapshotExportID=snapshotExportID,
+                                                              incrementalSnapshot=self.incrementalSnapshot,
+                                                              snapshotInterval=self.snapshotInterval)
         assert self.dbElem.getDbHost() != None
-        blockUntilKtserverIsRunning(self.logPath)
+        blockUntilKtserverIsRunning(self.logPath, dbElem=self.dbElem)
         self.check()
         return self.dbElem.getConfString(), snapshotExportID
 
     def stop(self, job):
         self.check()
-        stopKtserver(self.dbElem)
+        startTime = time.time()
+        # Blocks until the server has shut down and saved its snapshot
+        stopped = stopKtserver(self.dbElem)
         if not self.failed:
             blockUntilKtserverIsFinished(self.logPath, timeout=1200)
+            if stopped:
+                # Otherwise someone else already stopped the server
+                logLatency(job.fileStore, "ktserverShutdown", startTime, time.time() - startTime)
 
     def check(self):
         if self.process.exceptionMsg.empty():
@@ -49,3 +66,10 @@ class KtServerService(Job.Service):
             self.failed = True
             msg = self.process.exceptionMsg.get()
             raise RuntimeError(msg)
+
+def combineShardDatabaseStrings(dbStrings):
+    """Get the database string of a DB sharded over the ktservers with
+    the given database strings (see cactusDisk_construct2)."""
+    dbElems = [DbElemWrapper(ET.fromstring(dbString)) for dbString in dbStrings]
+    dbElems[0].setDbShards([(dbElem.getDbHost(), dbElem.getDbPort()) for dbElem in dbElems])
+    return dbElems[0].getConfString()
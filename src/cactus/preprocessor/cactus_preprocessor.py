@@ -25,6 +25,7 @@ from cactus.shared.common import runGetChunks
 from cactus.shared.common import makeURL
 from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.configWrapper import ConfigWrapper
+from cactus.shared.fasta import FastaFile
 
 from toil.lib.bioio import setLoggingFromOptions
 
@@ -149,12 +150,10 @@ class PreprocessSequence(RoundedJob):
 
 def unmaskFasta(inFasta, outFasta):
     """Uppercase a fasta file (removing the soft-masking)."""
-    with open(outFasta, 'w') as out:
-        for line in open(inFasta):
-            if len(line) > 0 and line[0] != ">":
-                out.write(line.upper())
-            else:
-                out.write(line)
+    with FastaFile(inFasta) as fastaFile:
+        with open(outFasta, 'w') as out:
+            for isHeader, text in fastaFile.iterSections():
+                out.write(text if isHeader else text.upper())
 
 class BatchPreprocessor(RoundedJob):
     def __init__(self, prepXmlElems, inSequenceID, iteration = 0):
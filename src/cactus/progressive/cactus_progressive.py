@@ -11,6 +11,7 @@ tree.
 """
 
 import os
+import logging
 import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
 from subprocess import check_call
@@ -27,6 +28,13 @@ from cactus.shared.common import catFiles
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import getDockerImage
+from cactus.shared.resourceModel import ResourceModelStore
+from cactus.shared.resourceModel import ResourceModelLogHandler
+from cactus.shared.profiling import ProfileStore
+from cactus.shared.profiling import ProfileLogHandler
+from cactus.shared.profiling import summarizeProfile
+from cactus.shared.profiling import writeProfileReport
+from cactus.shared.profiling import profileJobFunction
 
 from toil.job import Job
 from toil.common import Toil
@@ -267,6 +275,7 @@ class RunCactusPreprocessorThenProgressiveDown2(RoundedJob):
                                      disk=self.configWrapper.getExportHalDisk(),
                                      preemptable=False).rv()
 
+@profileJobFunction("hal")
 def exportHal(job, project, event=None, cacheBytes=None, cacheMDC=None, cacheRDC=None, cacheW0=None, chunk=None, deflate=None, inMemory=False):
 
     HALPath = "tmp_alignment.hal"
@@ -338,6 +347,14 @@ def setupBinaries(options):
                                "system. Please install Docker if possible, or "
                                "use --binaryMode local and add cactus's bin "
                                "directory to your PATH.")
+        if options.dockerContainerPool:
+            os.environ["CACTUS_DOCKER_POOL"] = "1"
+            # Pooled containers can only see work dirs under this
+            # directory, so mount Toil's work dir if one was given.
+            if options.workDir is not None:
+                os.environ["CACTUS_DOCKER_POOL_ROOT"] = os.path.abspath(options.workDir)
+        if options.dockerContainerPoolIdleTimeout is not None:
+            os.environ["CACTUS_DOCKER_POOL_IDLE_TIMEOUT"] = str(options.dockerContainerPoolIdleTimeout)
     # If running without Docker, verify that we can find the Cactus executables
     elif mode == "local":
         from distutils.spawn import find_executable
@@ -389,6 +406,15 @@ def importSingularityImage():
                     "docker://" + getDockerImage()])
         os.chdir(oldCWD)
 
+def checkEmbeddedDbOptions(options):
+    """Check that the jobs can all share an embedded DB's directory."""
+    if options.batchSystem != "singleMachine":
+        raise RuntimeError("The %s database is only visible to jobs on the node it is on,"
+                           " so it requires --batchSystem singleMachine" % options.database)
+    if os.environ["CACTUS_BINARIES_MODE"] == "docker" and os.environ.get("CACTUS_DOCKER_POOL") != "1":
+        raise RuntimeError("The %s database isn't visible to tools run in one-off Docker containers."
+                           " Use --dockerContainerPool, or --binariesMode local or singularity" % options.database)
+
 def main():
     parser = ArgumentParser()
     Job.Runner.addToilOptions(parser)
@@ -399,7 +425,10 @@ def main():
 
     #Progressive Cactus Options
     parser.add_argument("--database", dest="database",
-                      help="Database type: tokyo_cabinet or kyoto_tycoon"
+                      help="Database type: kyoto_tycoon (a server per DB), or tokyo_cabinet"
+                      " (embedded in the tools, which requires every job to run on one node:"
+                      " --batchSystem singleMachine, and --binariesMode local or singularity"
+                      " or --dockerContainerPool. The tools using the DB then run one at a time)"
                       " [default: %(default)s]",
                       default="kyoto_tycoon")
     parser.add_argument("--configFile", dest="configFile",
@@ -416,12 +445,37 @@ def main():
                         "rather than pulling from quay.io")
     parser.add_argument("--binariesMode", choices=["docker", "local", "singularity"],
                         help="The way to run the Cactus binaries", default=None)
+    parser.add_argument("--dockerContainerPool", action="store_true",
+                        help="In docker mode, run the Cactus binaries through "
+                        "\"docker exec\" in one long-lived container per worker "
+                        "node rather than starting a new container for every call")
+    parser.add_argument("--dockerContainerPoolIdleTimeout", type=int, default=None,
+                        help="Seconds a pooled container may sit idle before "
+                        "exiting [default: 600]")
+    parser.add_argument("--resourceModel", default=None,
+                        help="JSON file of memory usage datapoints collected from previous "
+                        "runs. Job memory requirements are estimated from fits to these "
+                        "(where there is enough data), and the datapoints from this run "
+                        "are added to it. Datapoints are only collected in docker mode.")
+    parser.add_argument("--resourceModelMargin", type=float, default=0.2,
+                        help="Fraction to add to the memory estimates from --resourceModel "
+                        "[default: %(default)s]")
+    parser.add_argument("--profile", default=None,
+                        help="Record the wall-clock time, CPU time and peak memory of every "
+                        "job and tool call, and write a report summarizing them per phase, "
+                        "job class and tool to PROFILE.json and PROFILE.html. The raw "
+                        "records are kept in PROFILE.records and carried over on --restart. "
+                        "Requires a log level of INFO or lower.")
 
     options = parser.parse_args()
     options.cactusDir = getTempDirectory()
 
     setupBinaries(options)
     setLoggingFromOptions(options)
+    if options.database == "tokyo_cabinet":
+        checkEmbeddedDbOptions(options)
+    if options.profile is not None:
+        os.environ["CACTUS_PROFILE"] = "1"
 
     # Mess with some toil options to create useful defaults.
 
@@ -456,6 +510,30 @@ def main():
     if not os.path.isdir(options.cactusDir):
         os.makedirs(options.cactusDir)
 
+    resourceModelStore = None
+    if options.resourceModel is not None:
+        resourceModelStore = ResourceModelStore(options.resourceModel)
+        options.resourceModelFits = resourceModelStore.fit(safetyMargin=options.resourceModelMargin)
+        logging.getLogger().addHandler(ResourceModelLogHandler(resourceModelStore))
+
+    profileStore = None
+    if options.profile is not None:
+        profileStore = ProfileStore(options.profile + ".records", restart=options.restart)
+        logging.getLogger().addHandler(ProfileLogHandler(profileStore))
+
+    succeeded = False
+    try:
+        runProgressive(options, project, pjPath)
+        succeeded = True
+    finally:
+        if resourceModelStore is not None:
+            resourceModelStore.save()
+        if profileStore is not None:
+            profileStore.finishRun(succeeded)
+            writeProfileReport(summarizeProfile(profileStore.getRecords()),
+                               options.profile + ".json", options.profile + ".html")
+
+def runProgressive(options, project, pjPath):
     with Toil(options) as toil:
         importSingularityImage()
         #Run the workflow
@@ -16,6 +16,14 @@ import uuid
 import json
 import time
 import signal
+import hashlib
+import tempfile
+import select
+import fcntl
+import errno
+import threading
+import collections
+import bisect
 
 from toil.lib.bioio import logger
 from toil.lib.bioio import system
@@ -26,6 +34,11 @@ from toil.job import Job
 from sonLib.bioio import popenCatch
 
 from cactus.shared.version import cactus_commit
+from cactus.shared.profiling import profilingEnabled
+from cactus.shared.profiling import startJobProfile
+from cactus.shared.profiling import finishJobProfile
+from cactus.shared.profiling import recordToolCall
+from cactus.pipeline.embeddedDb import lockEmbeddedDbs
 
 _log = logging.getLogger(__name__)
 
@@ -92,9 +105,11 @@ def findRequiredNode(configNode, nodeName):
 #############################################
 #############################################  
 
-def readFlowerNames(flowerStrings):
-    ret = []
-    for line in flowerStrings.split("\n"):
+def iterFlowerNames(flowerLines):
+    """Parse the flower groups output by cactus_workflow_getFlowers or
+    cactus_workflow_extendFlowers one line at a time, yielding
+    (overlarge, flowerNames, flowerSizes) tuples."""
+    for line in flowerLines:
         if line == '':
             continue
         flowersAndSizes = line[1:].split()
@@ -112,8 +127,10 @@ def readFlowerNames(flowerStrings):
                 sizes += [int(token)]
                 currentlyAFlower = True
         assert len(sizes) == int(numFlowers)
-        ret += [(bool(int(line[0])), " ".join([numFlowers] + flowers), sizes)]
-    return ret
+        yield (bool(int(line[0])), " ".join([numFlowers] + flowers), sizes)
+
+def readFlowerNames(flowerStrings):
+    return list(iterFlowerNames(flowerStrings.split("\n")))
 
 def runCactusGetFlowers(cactusDiskDatabaseString, flowerNames,
                         jobName=None, features=None, fileStore=None,
@@ -121,21 +138,21 @@ def runCactusGetFlowers(cactusDiskDatabaseString, flowerNames,
                         maxSequenceSizeOfFlowerGrouping=-1, 
                         maxSequenceSizeOfSecondaryFlowerGrouping=-1, 
                         logLevel=None):
-    """Gets a list of flowers attached to the given flower. 
+    """Gets the flowers attached to the given flower, as an iterator
+    of (overlarge, flowerNames, flowerSizes) groups that are parsed as
+    cactus_workflow_getFlowers produces them.
     """
     logLevel = getLogLevelString2(logLevel)
-    flowerStrings = cactus_call(check_output=True, stdin_string=flowerNames,
-                                parameters=["cactus_workflow_getFlowers", logLevel,
-                                            cactusDiskDatabaseString,
-                                            str(minSequenceSizeOfFlower),
-                                            str(maxSequenceSizeOfFlowerGrouping),
-                                            str(maxSequenceSizeOfSecondaryFlowerGrouping)],
-                                job_name=jobName,
-                                features=features,
-                                fileStore=fileStore)
-
-    l = readFlowerNames(flowerStrings)
-    return l
+    flowerLines = cactus_call_lines(stdin_string=flowerNames,
+                                    parameters=["cactus_workflow_getFlowers", logLevel,
+                                                cactusDiskDatabaseString,
+                                                str(minSequenceSizeOfFlower),
+                                                str(maxSequenceSizeOfFlowerGrouping),
+                                                str(maxSequenceSizeOfSecondaryFlowerGrouping)],
+                                    job_name=jobName,
+                                    features=features,
+                                    fileStore=fileStore)
+    return iterFlowerNames(flowerLines)
 
 def runCactusExtendFlowers(cactusDiskDatabaseString, flowerNames, 
                         jobName=None, features=None, fileStore=None,
@@ -146,27 +163,225 @@ def runCactusExtendFlowers(cactusDiskDatabaseString, flowerNames,
     """Extends the terminal groups in the cactus and returns the list
     of their child flowers with which to pass to core.
     The order of the flowers is by ascending depth first discovery time.
+    The groups are returned as an iterator, as in runCactusGetFlowers.
     """
     logLevel = getLogLevelString2(logLevel)
-    flowerStrings = cactus_call(check_output=True, stdin_string=flowerNames,
-                                parameters=["cactus_workflow_extendFlowers", logLevel,
-                                            cactusDiskDatabaseString,
-                                            str(minSequenceSizeOfFlower),
-                                            str(maxSequenceSizeOfFlowerGrouping),
-                                            str(maxSequenceSizeOfSecondaryFlowerGrouping)],
-                                job_name=jobName,
-                                features=features,
-                                fileStore=fileStore)
-
-    l = readFlowerNames(flowerStrings)
-    return l
+    flowerLines = cactus_call_lines(stdin_string=flowerNames,
+                                    parameters=["cactus_workflow_extendFlowers", logLevel,
+                                                cactusDiskDatabaseString,
+                                                str(minSequenceSizeOfFlower),
+                                                str(maxSequenceSizeOfFlowerGrouping),
+                                                str(maxSequenceSizeOfSecondaryFlowerGrouping)],
+                                    job_name=jobName,
+                                    features=features,
+                                    fileStore=fileStore)
+    return iterFlowerNames(flowerLines)
 
 def encodeFlowerNames(flowerNames):
     if len(flowerNames) == 0:
         return "0"
     return "%i %s" % (len(flowerNames), " ".join([ str(flowerNames[0]) ] + [ str(flowerNames[i] - flowerNames[i-1]) for i in xrange(1, len(flowerNames)) ]))
-    
+
+#############################################
+#Compact binary form of the flower names strings.
+#
+#A magic byte, then as varints: the number of flowers, the number of
+#secondary grouping separators, each separator as
+#(flowers since the last separator << 1 | is 'b'), and finally the
+#zigzag-encoded deltas between successive flower names. The C tools
+#read either form from stdin (see cactusFlowerWriter.c).
+#############################################
+
+BINARY_FLOWER_NAMES_MAGIC = '\xca'
+
+def _appendVarint(chars, value):
+    assert value >= 0
+    while value >= 0x80:
+        chars.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    chars.append(chr(value))
+
+def _readVarint(string, i):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(string[i])
+        i += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, i
+        shift += 7
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+def isBinaryFlowerNames(flowerNames):
+    return flowerNames[:1] == BINARY_FLOWER_NAMES_MAGIC
+
+def encodeBinaryFlowerNames(flowerNames):
+    """Converts a flower names string to the binary form. Strings
+    already in binary form are returned unchanged.
+    """
+    if isBinaryFlowerNames(flowerNames):
+        return flowerNames
+    tokens = flowerNames.split()
+    deltas = []
+    separators = []
+    lastSeparator = 0
+    for token in tokens[1:]:
+        if token == 'a' or token == 'b':
+            separators.append(((len(deltas) - lastSeparator) << 1) | (token == 'b'))
+            lastSeparator = len(deltas)
+        else:
+            deltas.append(int(token))
+    assert len(deltas) == int(tokens[0])
+    chars = [BINARY_FLOWER_NAMES_MAGIC]
+    _appendVarint(chars, len(deltas))
+    _appendVarint(chars, len(separators))
+    for separator in separators:
+        _appendVarint(chars, separator)
+    for delta in deltas:
+        _appendVarint(chars, _zigzag(delta))
+    return "".join(chars)
+
+def _decodeBinaryFlowerNames(flowerNames):
+    """Returns the separators (as (position, token) pairs) and the
+    deltas from a binary flower names string."""
+    numFlowers, i = _readVarint(flowerNames, 1)
+    numSeparators, i = _readVarint(flowerNames, i)
+    separators = []
+    position = 0
+    for j in xrange(numSeparators):
+        separator, i = _readVarint(flowerNames, i)
+        position += separator >> 1
+        separators.append((position, 'b' if separator & 1 else 'a'))
+    deltas = []
+    for j in xrange(numFlowers):
+        delta, i = _readVarint(flowerNames, i)
+        deltas.append(_unzigzag(delta))
+    return separators, deltas
+
+def decodeBinaryFlowerNames(flowerNames):
+    """Converts a flower names string to the text form. Strings already
+    in text form are returned unchanged.
+    """
+    if not isBinaryFlowerNames(flowerNames):
+        return flowerNames
+    separators, deltas = _decodeBinaryFlowerNames(flowerNames)
+    tokens = [str(len(deltas))]
+    separators.reverse()
+    for i, delta in enumerate(deltas):
+        while len(separators) > 0 and separators[-1][0] == i:
+            tokens.append(separators.pop()[1])
+        tokens.append(str(delta))
+    tokens += [token for position, token in reversed(separators)]
+    return " ".join(tokens)
+
+def getNumberOfFlowers(flowerNames):
+    """Gets the number of flowers in a flower names string of either form."""
+    if isBinaryFlowerNames(flowerNames):
+        return _readVarint(flowerNames, 1)[0]
+    return int(flowerNames.split(None, 1)[0])
+
+def encodeFlowerSizes(flowerSizes):
+    """Packs a list of (non-negative) flower sizes into a varint string."""
+    chars = []
+    for size in flowerSizes:
+        _appendVarint(chars, size)
+    return "".join(chars)
+
+def decodeFlowerSizes(encodedFlowerSizes):
+    flowerSizes = []
+    i = 0
+    while i < len(encodedFlowerSizes):
+        size, i = _readVarint(encodedFlowerSizes, i)
+        flowerSizes.append(size)
+    return flowerSizes
+
+def concatenateFlowerNames(flowerNamesList):
+    """Joins flower names strings (of either form) into one text string,
+    with a secondary grouping separator between each so that the
+    original groups can be recovered with
+    runCactusSplitFlowersBySecondaryGrouping.
+    """
+    tokens = []
+    numFlowers = 0
+    lastName = 0
+    for flowerNames in flowerNamesList:
+        groupTokens = decodeBinaryFlowerNames(flowerNames).split()[1:]
+        if len(groupTokens) == 0:
+            continue
+        if len(tokens) > 0 and groupTokens[0] not in ('a', 'b'):
+            tokens.append('a')
+        name = 0
+        for token in groupTokens:
+            if token == 'a' or token == 'b':
+                tokens.append(token)
+            else:
+                name += int(token)
+                tokens.append(str(name - lastName))
+                lastName = name
+                numFlowers += 1
+    return " ".join([str(numFlowers)] + tokens)
+
+# The most small flower groups packFlowerGroups holds at once
+FLOWER_PACK_WINDOW = 10000
+
+def packFlowerGroups(flowersAndSizes, maxPackedGroupSize, windowSize=FLOWER_PACK_WINDOW):
+    """Bin-packs the (overlarge, flowerNames, flowerSizes) groups that
+    are smaller than maxPackedGroupSize, so that several small groups
+    can be run by a single job (and a single call of each tool). The
+    groups are placed largest first, each into the fullest pack that
+    still has room (best fit decreasing). Overlarge and already large
+    groups are passed through as they arrive. The small groups are
+    packed windowSize at a time, so that no more of a stream of groups
+    than that is held in memory.
+    """
+    smallGroups = []
+    for overlarge, flowerNames, flowerSizes in flowersAndSizes:
+        if overlarge or sum(flowerSizes) >= maxPackedGroupSize:
+            yield overlarge, flowerNames, flowerSizes
+        else:
+            smallGroups.append((sum(flowerSizes), flowerNames, flowerSizes))
+            if len(smallGroups) >= windowSize:
+                for group in packSmallFlowerGroups(smallGroups, maxPackedGroupSize):
+                    yield group
+                smallGroups = []
+    for group in packSmallFlowerGroups(smallGroups, maxPackedGroupSize):
+        yield group
+
+def packSmallFlowerGroups(smallGroups, maxPackedGroupSize):
+    """Best fit decreasing packing of a list of (size, flowerNames,
+    flowerSizes) groups for packFlowerGroups."""
+    smallGroups.sort(key=lambda group: group[0], reverse=True)
+    packs = []
+    # (room left, pack index), kept sorted so the best fit is a bisection away
+    packsByRoom = []
+    for size, flowerNames, flowerSizes in smallGroups:
+        i = bisect.bisect_left(packsByRoom, (size, -1))
+        if i < len(packsByRoom):
+            room, packIndex = packsByRoom.pop(i)
+            bisect.insort(packsByRoom, (room - size, packIndex))
+            packs[packIndex][0].append(flowerNames)
+            packs[packIndex][1].extend(flowerSizes)
+        else:
+            bisect.insort(packsByRoom, (maxPackedGroupSize - size, len(packs)))
+            packs.append(([flowerNames], list(flowerSizes)))
+    for flowerNamesList, flowerSizes in packs:
+        if len(flowerNamesList) == 1:
+            yield False, flowerNamesList[0], flowerSizes
+        else:
+            yield False, concatenateFlowerNames(flowerNamesList), flowerSizes
+
 def decodeFirstFlowerName(encodedFlowerNames):
+    if isBinaryFlowerNames(encodedFlowerNames):
+        separators, deltas = _decodeBinaryFlowerNames(encodedFlowerNames)
+        if len(deltas) == 0:
+            return None
+        return deltas[0]
     tokens = encodedFlowerNames.split()
     if int(tokens[0]) == 0:
         return None
@@ -175,8 +390,12 @@ def decodeFirstFlowerName(encodedFlowerNames):
     return int(tokens[1])
 
 def runCactusSplitFlowersBySecondaryGrouping(flowerNames):
-    """Splits a list of flowers into smaller lists.
+    """Splits a list of flowers into smaller lists. The groups are in the
+    same form (text or binary) as the given flower names.
     """
+    if isBinaryFlowerNames(flowerNames):
+        return [(overlarge, encodeBinaryFlowerNames(group)) for overlarge, group in \
+                runCactusSplitFlowersBySecondaryGrouping(decodeBinaryFlowerNames(flowerNames))]
     flowerNames = flowerNames.split()
     flowerGroups = []
     stack = []
@@ -280,7 +499,10 @@ def runCactusCaf(cactusDiskDatabaseString, alignments,
                  phylogenyDistanceCorrectionMethod=None,
                  features=None,
                  jobName=None,
-                 fileStore=None):
+                 fileStore=None,
+                 streaming=False):
+    """Runs cactus_caf, returning the list of messages it output, or,
+    if streaming is set, an iterator over them."""
     logLevel = getLogLevelString2(logLevel)
     args = ["--logLevel", logLevel, "--alignments", alignments, "--cactusDisk", cactusDiskDatabaseString]
     if annealingRounds is not None:
@@ -370,11 +592,14 @@ def runCactusCaf(cactusDiskDatabaseString, alignments,
     if maximumMedianSequenceLengthBetweenLinkedEnds is not None:
         args += ["--maximumMedianSequenceLengthBetweenLinkedEnds", str(maximumMedianSequenceLengthBetweenLinkedEnds)]
 
-    masterMessages = cactus_call(stdin_string=flowerNames, check_output=True,
-                                 parameters=["cactus_caf"] + args,
-                                 features=features, job_name=jobName, fileStore=fileStore)
+    masterMessages = cactus_call_lines(stdin_string=flowerNames,
+                                       parameters=["cactus_caf"] + args,
+                                       features=features, job_name=jobName, fileStore=fileStore)
+    if streaming:
+        return masterMessages
+    masterMessages = list(masterMessages)
     logger.info("Ran cactus_caf okay")
-    return [ i for i in masterMessages.split("\n") if i != '' ]
+    return masterMessages
 
 def runCactusPhylogeny(cactusDiskDatabaseString,
                        flowerNames=encodeFlowerNames((0,)),
@@ -446,8 +671,10 @@ def runCactusBar(cactusDiskDatabaseString, flowerNames, logLevel=None,
                  minimumNumberOfSpecies=None,
                  jobName=None,
                  fileStore=None,
-                 features=None):
-    """Runs cactus base aligner."""
+                 features=None,
+                 streaming=False):
+    """Runs cactus base aligner. Returns the list of messages it
+    output, or, if streaming is set, an iterator over them."""
     logLevel = getLogLevelString2(logLevel)
     args = ["--logLevel", logLevel, "--cactusDisk", cactusDiskDatabaseString]
     if maximumLength is not None:
@@ -500,12 +727,14 @@ def runCactusBar(cactusDiskDatabaseString, flowerNames, logLevel=None,
     if minimumNumberOfSpecies is not None:
         args += ["--minimumNumberOfSpecies", str(minimumNumberOfSpecies)]
 
-    masterMessages = cactus_call(stdin_string=flowerNames, check_output=True,
-                                 parameters=["cactus_bar"] + args,
-                                 job_name=jobName, fileStore=fileStore, features=features)
-
+    masterMessages = cactus_call_lines(stdin_string=flowerNames,
+                                       parameters=["cactus_bar"] + args,
+                                       job_name=jobName, fileStore=fileStore, features=features)
+    if streaming:
+        return masterMessages
+    masterMessages = list(masterMessages)
     logger.info("Ran cactus_bar okay")
-    return [ i for i in masterMessages.split("\n") if i != '' ]
+    return masterMessages
 
 def runCactusSecondaryDatabase(secondaryDatabaseString, create=True):
     cactus_call(parameters=["cactus_secondaryDatabase",
@@ -524,8 +753,10 @@ def runCactusReference(cactusDiskDatabaseString, flowerNames, logLevel=None,
                        wiggle=None, 
                        numberOfNs=None,
                        minNumberOfSequencesToSupportAdjacency=None,
-                       makeScaffolds=False):
-    """Runs cactus reference."""
+                       makeScaffolds=False,
+                       streaming=False):
+    """Runs cactus reference. Returns the list of messages it output,
+    or, if streaming is set, an iterator over them."""
     logLevel = getLogLevelString2(logLevel)
     args = ["--logLevel", logLevel, "--cactusDisk", cactusDiskDatabaseString]
     if matchingAlgorithm is not None:
@@ -553,13 +784,16 @@ def runCactusReference(cactusDiskDatabaseString, flowerNames, logLevel=None,
     if makeScaffolds:
         args += ["--makeScaffolds"]
 
-    masterMessages = cactus_call(stdin_string=flowerNames, check_output=True,
-                                 parameters=["cactus_reference"] + args,
-                                 job_name=jobName,
-                                 features=features,
-                                 fileStore=fileStore)
+    masterMessages = cactus_call_lines(stdin_string=flowerNames,
+                                       parameters=["cactus_reference"] + args,
+                                       job_name=jobName,
+                                       features=features,
+                                       fileStore=fileStore)
+    if streaming:
+        return masterMessages
+    masterMessages = list(masterMessages)
     logger.info("Ran cactus_reference okay")
-    return [ i for i in masterMessages.split("\n") if i != '' ]
+    return masterMessages
     
 def runCactusAddReferenceCoordinates(cactusDiskDatabaseString, flowerNames,
                                      jobName=None, fileStore=None, features=None,
@@ -828,7 +1062,10 @@ def maxMemUsageOfContainer(containerInfo):
     # container, in a few different possible locations depending on
     # the distribution
     possibleLocations = ["/sys/fs/cgroup/memory/docker/%s/memory.max_usage_in_bytes",
-                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes"]
+                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes",
+                         # cgroup v2
+                         "/sys/fs/cgroup/system.slice/docker-%s.scope/memory.peak",
+                         "/sys/fs/cgroup/docker/%s/memory.peak"]
     possibleLocations = [s % containerInfo['id'] for s in possibleLocations]
     for location in possibleLocations:
         try:
@@ -839,6 +1076,51 @@ def maxMemUsageOfContainer(containerInfo):
             continue
     return None
 
+def cpuUsageOfContainer(containerInfo):
+    """Return the CPU time (in seconds) used so far by a container, or
+    None if it can't be found."""
+    if containerInfo['id'] is None:
+        return None
+    possibleLocations = ["/sys/fs/cgroup/cpuacct/docker/%s/cpuacct.usage",
+                         "/sys/fs/cgroup/cpuacct/system.slice.docker-%s.scope/cpuacct.usage",
+                         # cgroup v2
+                         "/sys/fs/cgroup/system.slice/docker-%s.scope/cpu.stat",
+                         "/sys/fs/cgroup/docker/%s/cpu.stat"]
+    for location in possibleLocations:
+        try:
+            with open(location % containerInfo['id']) as f:
+                if location.endswith("cpuacct.usage"):
+                    # Nanoseconds
+                    return int(f.read()) / 1e9
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[0] == "usage_usec":
+                        return int(fields[1]) / 1e6
+        except IOError:
+            continue
+    return None
+
+def containerWasOOMKilled(containerInfo):
+    """Return True if the kernel has OOM-killed a process in the
+    container, as far as its cgroup (if it still exists) can tell."""
+    if containerInfo['id'] is None:
+        return False
+    possibleLocations = ["/sys/fs/cgroup/memory/docker/%s/memory.oom_control",
+                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.oom_control",
+                         # cgroup v2
+                         "/sys/fs/cgroup/system.slice/docker-%s.scope/memory.events",
+                         "/sys/fs/cgroup/docker/%s/memory.events"]
+    for location in possibleLocations:
+        try:
+            with open(location % containerInfo['id']) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[0] == "oom_kill":
+                        return int(fields[1]) > 0
+        except IOError:
+            continue
+    return False
+
 def singularityCommand(tool=None,
                        work_dir=None,
                        parameters=None,
@@ -880,6 +1162,155 @@ def dockerCommand(tool=None,
     call = base_docker_call + [tool] + parameters
     return call, containerInfo
 
+# Watchdog run as the main process of a pooled container. Every
+# "docker exec" drops a marker named after its pid into
+# /tmp/cactus-running, and the container exits once no marker has
+# belonged to a live process for longer than the idle timeout ($1).
+_DOCKER_POOL_WATCHDOG = """
+mkdir -p /tmp/cactus-running
+touch /tmp/cactus-heartbeat
+while true; do
+    sleep 5
+    for marker in /tmp/cactus-running/*; do
+        [ -e "$marker" ] || continue
+        if kill -0 "$(basename "$marker")" 2>/dev/null; then
+            touch /tmp/cactus-heartbeat
+        else
+            rm -f "$marker"
+        fi
+    done
+    idle=$(( $(date +%s) - $(stat -c %Y /tmp/cactus-heartbeat) ))
+    if [ "$idle" -gt "$1" ]; then
+        exit 0
+    fi
+done
+"""
+
+# Run by "docker exec" inside a pooled container: register as busy,
+# then run the tool through the usual wrapper so that stdin, stdout
+# and cactus-redirect behave exactly as with "docker run".
+_DOCKER_POOL_EXEC = """
+mkdir -p /tmp/cactus-running
+touch /tmp/cactus-running/$$ /tmp/cactus-heartbeat
+set +e
+bash /opt/cactus/wrapper.sh "$@"
+ret=$?
+rm -f /tmp/cactus-running/$$
+touch /tmp/cactus-heartbeat
+exit $ret
+"""
+
+# How many times a call is made in a pooled container that keeps going
+# away before it can start.
+DOCKER_POOL_EXEC_ATTEMPTS = 3
+
+def dockerPoolEnabled():
+    """Whether tools should be run in long-lived, per-node containers
+    through "docker exec" rather than one "docker run" per call."""
+    return os.environ.get("CACTUS_DOCKER_POOL") == "1"
+
+def getDockerPoolRoot():
+    """Get the host directory mounted (at the same path) into pooled
+    containers. Work dirs outside of it fall back to "docker run"."""
+    return os.path.abspath(os.environ.get("CACTUS_DOCKER_POOL_ROOT", tempfile.gettempdir()))
+
+def getDockerPoolIdleTimeout():
+    """Get the number of idle seconds after which a pooled container exits."""
+    return int(os.environ.get("CACTUS_DOCKER_POOL_IDLE_TIMEOUT", 600))
+
+def getDockerPoolContainerName(image, root):
+    """Get the name of the pooled container for this image, user and
+    root. The name is deterministic so that all the jobs a worker node
+    runs share the same container."""
+    key = "%s:%s:%s:%s" % (image, os.getuid(), os.getgid(), root)
+    return "cactus-pool-%s" % hashlib.md5(key).hexdigest()[:12]
+
+def _getRunningDockerContainerId(name):
+    """Get the ID of a container if it is running, or None."""
+    process = subprocess32.Popen(["docker", "inspect", "-f", "{{.State.Running}} {{.Id}}", name],
+                                 stdout=subprocess32.PIPE, stderr=subprocess32.PIPE)
+    output, _ = process.communicate()
+    fields = output.split()
+    if process.returncode != 0 or len(fields) != 2 or fields[0] != "true":
+        return None
+    return fields[1]
+
+def ensureDockerPoolContainer(image, attempts=3):
+    """Start the pooled container for this image if it isn't already
+    running, and return its ID."""
+    root = getDockerPoolRoot()
+    name = getDockerPoolContainerName(image, root)
+    while not os.path.exists('/etc/resolv.conf'):
+        pass
+    for attempt in xrange(attempts):
+        id = _getRunningDockerContainerId(name)
+        if id is not None:
+            return id
+        call = ['docker', 'run', '--detach', '--rm',
+                '--net=host',
+                '--log-driver=none',
+                '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                '-v', '{0}:{0}'.format(root),
+                '--name', name,
+                '--entrypoint', 'bash',
+                image, '-c', _DOCKER_POOL_WATCHDOG, 'cactus-pool',
+                str(getDockerPoolIdleTimeout())]
+        _log.info("Starting pooled container %s" % name)
+        process = subprocess32.Popen(call, stdout=subprocess32.PIPE,
+                                     stderr=subprocess32.PIPE)
+        output, error = process.communicate()
+        id = _getRunningDockerContainerId(name)
+        if id is not None:
+            # Either we started it or another job on this node beat us to it.
+            return id
+        # The name may still be held by a container that has just
+        # timed out and is being removed.
+        time.sleep(1)
+    raise RuntimeError("Command %s failed with output: %s" % (call, error))
+
+def canUseDockerPool(work_dir):
+    """Whether a work dir is visible inside the pooled containers."""
+    root = getDockerPoolRoot()
+    work_dir = os.path.abspath(work_dir)
+    return work_dir == root or work_dir.startswith(root.rstrip('/') + '/')
+
+def dockerExecCommand(tool=None,
+                      work_dir=None,
+                      parameters=None,
+                      dockstore=None):
+    """Get a "docker exec" call running parameters in the pooled
+    container, from the same directory as the host work dir, and the
+    info of the container.
+
+    The pooled container is shared by every call on the node and
+    outlives this one, so its cgroup's memory, CPU time and OOM kills
+    say nothing about this call: the info is marked as pooled so that
+    they aren't sampled."""
+    image = "%s/%s:%s" % (dockstore, tool, getDockerTag())
+    id = ensureDockerPoolContainer(image)
+    containerInfo = { 'name': getDockerPoolContainerName(image, getDockerPoolRoot()),
+                      'id': id, 'pooled': True }
+    # Exec by ID, so that a container that has gone away can't be
+    # mistaken for a new one with the same name.
+    call = ['docker', 'exec', '--interactive',
+            '-w', os.path.abspath(work_dir),
+            id, 'bash', '-c', _DOCKER_POOL_EXEC, 'cactus-exec'] + parameters
+    return call, containerInfo
+
+def runsInOwnContainer(containerInfo):
+    """Whether a call runs in a container of its own, so that the
+    container's cgroup measures just that call. The cgroup of a pooled
+    container covers every call on the node running in it."""
+    return containerInfo is not None and not containerInfo.get('pooled', False)
+
+def pooledContainerWentAway(containerInfo, process):
+    """Whether a call failed because its pooled container exited (once
+    idle for long enough) before the tool could be started in it. The
+    tool keeps the container alive once it has started, so the call can
+    just be made again."""
+    return containerInfo is not None and containerInfo.get('pooled', False) \
+        and process.returncode != 0 and _getRunningDockerContainerId(containerInfo['id']) is None
+
 def prepareWorkDir(work_dir, parameters):
     def moveToWorkDir(work_dir, arg):
         if isinstance(arg, str) and os.path.isfile(arg):
@@ -927,24 +1358,206 @@ def prepareWorkDir(work_dir, parameters):
         parameters = [adjustPath(par, work_dir) for par in parameters]
     return work_dir, parameters
 
-def cactus_call(tool=None,
-                work_dir=None,
-                parameters=None,
-                rm=True,
-                check_output=False,
-                infile=None,
-                outfile=None,
-                stdin_string=None,
-                server=False,
-                shell=False,
-                port=None,
-                check_result=False,
-                dockstore=None,
-                soft_timeout=None,
-                job_name=None,
-                features=None,
-                fileStore=None,
-                swallowStdErr=False):
+def getMemorySampleInterval():
+    """Get how often (in seconds) a container's memory usage is sampled."""
+    return float(os.environ.get("CACTUS_MEMORY_SAMPLE_INTERVAL", 1))
+
+def superviseProcess(process, status, stdin_string=None, containerInfo=None,
+                     soft_timeout=None, chunkSize=65536):
+    """Generator feeding stdin_string to a process and yielding chunks
+    of its stdout (if piped) as soon as they arrive, until it exits.
+
+    Stderr, if piped, is drained and discarded. A background thread
+    waits on the process, so its exit is noticed immediately rather
+    than on the next poll. In between, the container's memory usage is
+    sampled every getMemorySampleInterval() seconds.
+
+    The max memory usage seen is stored in status['memUsage'], and
+    status['oomKilled'] is set if the container's cgroup reported an
+    OOM kill. A pooled container, shared with other calls, isn't
+    sampled. status['cpuTime'] and status['peakRss'] hold the resource
+    usage of the process itself (for docker, just the client) once it
+    has exited, and status['containerCpuTime'] the CPU time of the
+    container if it could be sampled.
+    status['timedOut'] is set if the soft timeout was hit, in which
+    case the process is sent SIGINT and left to finish on its own. If
+    the generator is closed early the process is terminated.
+    """
+    status['memUsage'] = 0
+    status['timedOut'] = False
+    status['oomKilled'] = False
+    status['cpuTime'] = None
+    status['peakRss'] = None
+    status['containerCpuTime'] = None
+
+    exitRead, exitWrite = os.pipe()
+    def waitForExit():
+        try:
+            # wait4 gives the resource usage of this process alone
+            _, exitStatus, usage = os.wait4(process.pid, 0)
+            if os.WIFSIGNALED(exitStatus):
+                process.returncode = -os.WTERMSIG(exitStatus)
+            else:
+                process.returncode = os.WEXITSTATUS(exitStatus)
+            status['cpuTime'] = usage.ru_utime + usage.ru_stime
+            # ru_maxrss is in kilobytes on Linux
+            status['peakRss'] = usage.ru_maxrss * 1024
+        except OSError:
+            process.wait()
+        try:
+            os.write(exitWrite, "x")
+        except OSError:
+            # The supervisor has already given up on the process
+            pass
+        finally:
+            os.close(exitWrite)
+    waiter = threading.Thread(target=waitForExit)
+    waiter.daemon = True
+    waiter.start()
+
+    readers = [exitRead]
+    stdoutFd = None
+    if process.stdout is not None:
+        stdoutFd = process.stdout.fileno()
+        readers.append(stdoutFd)
+    if process.stderr is not None:
+        readers.append(process.stderr.fileno())
+    writers = []
+    if process.stdin is not None:
+        if stdin_string:
+            stdinFd = process.stdin.fileno()
+            fcntl.fcntl(stdinFd, fcntl.F_SETFL, fcntl.fcntl(stdinFd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            writers.append(stdinFd)
+            stdinOffset = 0
+        else:
+            process.stdin.close()
+
+    def sampleMemory():
+        updatedMemUsage = maxMemUsageOfContainer(containerInfo)
+        if updatedMemUsage is not None:
+            assert status['memUsage'] <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
+            status['memUsage'] = updatedMemUsage
+            if containerWasOOMKilled(containerInfo):
+                status['oomKilled'] = True
+            cpuTime = cpuUsageOfContainer(containerInfo)
+            if cpuTime is not None:
+                status['containerCpuTime'] = cpuTime
+
+    sampleContainer = runsInOwnContainer(containerInfo)
+
+    interval = getMemorySampleInterval()
+    startTime = time.time()
+    nextSample = startTime + interval
+    try:
+        while readers:
+            timeout = nextSample - time.time()
+            if soft_timeout is not None:
+                timeout = min(timeout, startTime + soft_timeout - time.time())
+            try:
+                readable, writable, _ = select.select(readers, writers, [], max(timeout, 0))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in writable:
+                try:
+                    stdinOffset += os.write(fd, stdin_string[stdinOffset:stdinOffset + chunkSize])
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    if e.errno != errno.EPIPE:
+                        raise
+                    # The process stopped reading its input
+                    stdinOffset = len(stdin_string)
+                if stdinOffset >= len(stdin_string):
+                    process.stdin.close()
+                    writers = []
+            for fd in readable:
+                if fd == exitRead:
+                    # The process has exited, but its output may not
+                    # have been fully drained yet.
+                    readers.remove(exitRead)
+                    waiter.join()
+                    if writers:
+                        process.stdin.close()
+                        writers = []
+                    if sampleContainer:
+                        sampleMemory()
+                    continue
+                chunk = os.read(fd, chunkSize)
+                if chunk == "":
+                    readers.remove(fd)
+                elif fd == stdoutFd:
+                    yield chunk
+            now = time.time()
+            if now >= nextSample:
+                if sampleContainer:
+                    sampleMemory()
+                nextSample = now + interval
+            if soft_timeout is not None and exitRead in readers and now - startTime > soft_timeout:
+                # Soft timeout has been triggered. Just return early.
+                process.send_signal(signal.SIGINT)
+                status['timedOut'] = True
+                return
+    finally:
+        if exitRead in readers and not status['timedOut']:
+            # We were abandoned before the process finished
+            process.terminate()
+        os.close(exitRead)
+        for fileHandle in (process.stdin, process.stdout, process.stderr):
+            if fileHandle is not None and not fileHandle.closed:
+                fileHandle.close()
+
+class OOMError(RuntimeError):
+    """Raised when a tool was killed for running out of memory."""
+    pass
+
+def getToolName(parameters):
+    """The name of the binary a cactus_call runs, for profiling."""
+    if len(parameters) == 0:
+        return "unknown"
+    words = str(parameters[0]).split()
+    if len(words) == 0:
+        return "unknown"
+    return os.path.basename(words[0])
+
+def recordCallProfile(parameters, startTime, status):
+    """Add a finished cactus_call to the running job's profile."""
+    if not profilingEnabled():
+        return
+    cpu = status.get('cpuTime')
+    if status.get('containerCpuTime') is not None:
+        cpu = status['containerCpuTime']
+    peakRss = status.get('peakRss')
+    if status.get('memUsage'):
+        peakRss = status['memUsage']
+    recordToolCall(getToolName(parameters), startTime, time.time() - startTime, cpu, peakRss)
+
+def raiseCallFailure(call, process, status, output):
+    """Raise the error for a failed call. OOM kills (exit status 137
+    from docker, SIGKILL locally, or an OOM kill seen in the container's
+    cgroup) raise an OOMError."""
+    if status.get('oomKilled') or process.returncode in (137, -signal.SIGKILL):
+        raise OOMError("Command %s was killed, most likely for running out of memory, with output: %s" % (call, output))
+    raise RuntimeError("Command %s failed with output: %s" % (call, output))
+
+def startCactusCall(tool=None,
+                    work_dir=None,
+                    parameters=None,
+                    rm=True,
+                    pipe_stdout=False,
+                    infile=None,
+                    outfile=None,
+                    stdin_string=None,
+                    server=False,
+                    shell=False,
+                    port=None,
+                    dockstore=None,
+                    soft_timeout=None,
+                    swallowStdErr=False):
+    """Start running a tool, returning the process, the full command
+    line, the (relativized) parameters and the container info (None if
+    the tool isn't running in a container)."""
     mode = os.environ.get("CACTUS_BINARIES_MODE", "docker")
 
     if dockstore is None:
@@ -957,7 +1570,14 @@ def cactus_call(tool=None,
     if mode in ("docker", "singularity"):
         work_dir, parameters = prepareWorkDir(work_dir, parameters)
 
-    if mode == "docker":
+    containerInfo = None
+    if mode == "docker" and dockerPoolEnabled() and not server and port is None \
+       and soft_timeout is None and canUseDockerPool(work_dir):
+        # The docker client doesn't forward signals to exec'd processes,
+        # so servers and soft timeouts still get their own container.
+        call, containerInfo = dockerExecCommand(tool=tool, work_dir=work_dir,
+                                                parameters=parameters, dockstore=dockstore)
+    elif mode == "docker":
         call, containerInfo = dockerCommand(tool=tool,
                                             work_dir=work_dir,
                                             parameters=parameters,
@@ -979,7 +1599,7 @@ def cactus_call(tool=None,
         stdinFileHandle = open(infile, 'r')
     if outfile:
         stdoutFileHandle = open(outfile, 'w')
-    if check_output:
+    if pipe_stdout:
         stdoutFileHandle = subprocess32.PIPE
 
     _log.info("Running the command %s" % call)
@@ -987,45 +1607,140 @@ def cactus_call(tool=None,
                                  stdin=stdinFileHandle, stdout=stdoutFileHandle,
                                  stderr=subprocess32.PIPE if swallowStdErr else sys.stderr,
                                  bufsize=-1)
+    return process, call, parameters, containerInfo
 
-    if server:
-        return process
+def logMemoryUsage(fileStore, job_name, tool, features, memUsage):
+    """Log a datapoint for the memory usage for these features."""
+    fileStore.logToMaster("Max memory used for job %s (tool %s) "
+                          "on JSON features %s: %s" % (job_name, tool,
+                                                       json.dumps(features), memUsage))
 
-    memUsage = 0
-    first_run = True
-    start_time = time.time()
-    while True:
-        try:
-            # Wait a bit to see if the process is done
-            output, nothing = process.communicate(stdin_string if first_run else None, timeout=10)
-        except subprocess32.TimeoutExpired:
-            if mode == "docker":
-                # Every so often, check the memory usage of the container
-                updatedMemUsage = maxMemUsageOfContainer(containerInfo)
-                if updatedMemUsage is not None:
-                    assert memUsage <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
-                    memUsage = updatedMemUsage
-            first_run = False
-            if soft_timeout is not None and time.time() - start_time > soft_timeout:
-                # Soft timeout has been triggered. Just return early.
-                process.send_signal(signal.SIGINT)
-                return None
-        else:
-            break
-    if mode == "docker" and job_name is not None and features is not None and fileStore is not None:
-        # Log a datapoint for the memory usage for these features.
-        fileStore.logToMaster("Max memory used for job %s (tool %s) "
-                              "on JSON features %s: %s" % (job_name, parameters[0],
-                                                           json.dumps(features), memUsage))
+def cactus_call(tool=None,
+                work_dir=None,
+                parameters=None,
+                rm=True,
+                check_output=False,
+                infile=None,
+                outfile=None,
+                stdin_string=None,
+                server=False,
+                shell=False,
+                port=None,
+                check_result=False,
+                dockstore=None,
+                soft_timeout=None,
+                job_name=None,
+                features=None,
+                fileStore=None,
+                swallowStdErr=False):
+    startTime = time.time()
+    # Tools share an embedded DB one at a time
+    with lockEmbeddedDbs(parameters if not server else None):
+        for attempt in xrange(DOCKER_POOL_EXEC_ATTEMPTS):
+            process, call, callParameters, containerInfo = startCactusCall(tool=tool,
+                                                                           work_dir=work_dir,
+                                                                           parameters=parameters,
+                                                                           rm=rm,
+                                                                           pipe_stdout=check_output,
+                                                                           infile=infile,
+                                                                           outfile=outfile,
+                                                                           stdin_string=stdin_string,
+                                                                           server=server,
+                                                                           shell=shell,
+                                                                           port=port,
+                                                                           dockstore=dockstore,
+                                                                           soft_timeout=soft_timeout,
+                                                                           swallowStdErr=swallowStdErr)
+
+            if server:
+                return process
+
+            status = {}
+            chunks = []
+            for chunk in superviseProcess(process, status, stdin_string=stdin_string,
+                                          containerInfo=containerInfo,
+                                          soft_timeout=soft_timeout):
+                chunks.append(chunk)
+            if not pooledContainerWentAway(containerInfo, process):
+                break
+            _log.info("Pooled container %s went away before %s could start, retrying" % (containerInfo['name'], call))
+    parameters = callParameters
+    recordCallProfile(parameters, startTime, status)
+    if status['timedOut']:
+        return None
+    output = "".join(chunks) if check_output else None
+    memUsage = status['memUsage']
+    if runsInOwnContainer(containerInfo) and job_name is not None and features is not None and fileStore is not None:
+        logMemoryUsage(fileStore, job_name, parameters[0], features, memUsage)
     if check_result:
         return process.returncode
 
     if process.returncode != 0:
-        raise RuntimeError("Command %s failed with output: %s" % (call, output))
+        raiseCallFailure(call, process, status, output)
 
     if check_output:
         return output
 
+def cactus_call_lines(tool=None,
+                      work_dir=None,
+                      parameters=None,
+                      rm=True,
+                      infile=None,
+                      stdin_string=None,
+                      shell=False,
+                      dockstore=None,
+                      job_name=None,
+                      features=None,
+                      fileStore=None,
+                      swallowStdErr=False):
+    """Like cactus_call with check_output=True, but yields the non-empty
+    lines of the tool's stdout (without newlines) as they are produced
+    rather than returning the whole output as one string.
+
+    The tool is only started once iteration begins, and a failure is
+    raised once the output has been consumed. If the caller stops
+    iterating early the tool is terminated.
+    """
+    startTime = time.time()
+    # Tools share an embedded DB one at a time
+    with lockEmbeddedDbs(parameters):
+        for attempt in xrange(DOCKER_POOL_EXEC_ATTEMPTS):
+            process, call, callParameters, containerInfo = startCactusCall(tool=tool,
+                                                                           work_dir=work_dir,
+                                                                           parameters=parameters,
+                                                                           rm=rm,
+                                                                           pipe_stdout=True,
+                                                                           infile=infile,
+                                                                           stdin_string=stdin_string,
+                                                                           shell=shell,
+                                                                           dockstore=dockstore,
+                                                                           swallowStdErr=swallowStdErr)
+            status = {}
+            # Keep the tail of the output around for the error message
+            lastLines = collections.deque(maxlen=100)
+            partialLine = ""
+            for chunk in superviseProcess(process, status, stdin_string=stdin_string,
+                                          containerInfo=containerInfo):
+                lines = (partialLine + chunk).split("\n")
+                partialLine = lines.pop()
+                for line in lines:
+                    if line != '':
+                        lastLines.append(line)
+                        yield line
+            if partialLine != '':
+                lastLines.append(partialLine)
+                yield partialLine
+            # Only a call that never started (so produced nothing) is retried
+            if lastLines or not pooledContainerWentAway(containerInfo, process):
+                break
+            _log.info("Pooled container %s went away before %s could start, retrying" % (containerInfo['name'], call))
+    parameters = callParameters
+    recordCallProfile(parameters, startTime, status)
+    if runsInOwnContainer(containerInfo) and job_name is not None and features is not None and fileStore is not None:
+        logMemoryUsage(fileStore, job_name, parameters[0], features, status['memUsage'])
+    if process.returncode != 0:
+        raiseCallFailure(call, process, status, "\n".join(lastLines))
+
 class RunAsFollowOn(Job):
     def __init__(self, job, *args, **kwargs):
         Job.__init__(self, memory=100000000, preemptable=True)
@@ -1046,6 +1761,12 @@ class RoundedJob(Job):
     """
     # Default rounding amount: 100 MiB
     roundingAmount = 100*1024*1024
+    # Multiples of the original memory requirement to re-run the job
+    # with, in turn, if it fails with an OOMError. Empty disables this.
+    oomMemoryEscalation = ()
+    _oomAttempt = 0
+    _baseMemory = None
+    _maxMemory = None
     def __init__(self, memory=None, cores=None, disk=None, preemptable=None,
                  unitName=None, checkpoint=False):
         if memory is not None:
@@ -1073,9 +1794,75 @@ class RoundedJob(Job):
             return bytesRequirement
         return (bytesRequirement // self.roundingAmount + 1) * self.roundingAmount
 
+    def getEscalatedMemory(self):
+        """Get the memory to re-run the job with after it ran out of
+        memory, or None if it shouldn't be re-run. The escalation is
+        capped by the job's memoryCap, if it has one."""
+        if self._oomAttempt >= len(self.oomMemoryEscalation):
+            return None
+        baseMemory = self._baseMemory if self._baseMemory is not None else self.memory
+        memory = int(baseMemory * self.oomMemoryEscalation[self._oomAttempt])
+        for cap in (getattr(self, 'memoryCap', None), self._maxMemory):
+            if cap is not None:
+                memory = int(min(memory, cap))
+        if memory <= self.memory:
+            return None
+        return memory
+
+    def getProfilePhase(self):
+        """The workflow phase to report this job under when profiling,
+        or None if it isn't part of one."""
+        return None
+
+    def _run(self, jobGraph, fileStore):
+        if not profilingEnabled():
+            return self._runWithOOMRetry(jobGraph, fileStore)
+        profile = startJobProfile(self.__class__.__name__, self.getProfilePhase())
+        failed = True
+        try:
+            returnValue = self._runWithOOMRetry(jobGraph, fileStore)
+            failed = False
+            return returnValue
+        finally:
+            finishJobProfile(profile, fileStore, failed=failed)
+
+    def _runWithOOMRetry(self, jobGraph, fileStore):
+        if len(self.oomMemoryEscalation) == 0 or self.checkpoint:
+            return super(RoundedJob, self)._run(jobGraph, fileStore)
+        try:
+            return super(RoundedJob, self)._run(jobGraph, fileStore)
+        except OOMError:
+            memory = self.getEscalatedMemory()
+            if memory is None or self._children or self._followOns or self._services or \
+               getattr(self, 'queuedChildJobs', None):
+                # Can't safely re-run a job that has already added
+                # successors, so leave it to Toil's usual retries.
+                raise
+            fileStore.logToMaster("Job %s ran out of memory with %i bytes, re-running it with %i bytes"
+                                  % (self.__class__.__name__, self.memory, memory))
+            return self.addFollowOn(self.loadOOMRetry(jobGraph, fileStore, memory)).rv()
+
+    def loadOOMRetry(self, jobGraph, fileStore, memory):
+        """Get a copy of the job to re-run with the given memory.
+
+        Toil can't change the requirements of a job it retries, so the
+        copy is run as a follow-on. It is loaded afresh from the job
+        store, so none of the changes the failed run made to the job's
+        state (such as lists it appended to) carry over into it.
+        """
+        retry = Job._loadJob(jobGraph.command, fileStore.jobStore)
+        # Give the copy the new requirements, and none of the promises
+        # made on the original, which are fulfilled through this one.
+        RoundedJob.__init__(retry, memory=memory, cores=self.cores, disk=self.disk,
+                            preemptable=self.preemptable)
+        retry._oomAttempt = self._oomAttempt + 1
+        retry._baseMemory = self._baseMemory if self._baseMemory is not None else self.memory
+        return retry
+
     def _runner(self, jobGraph, jobStore, fileStore):
         if jobStore.config.workDir is not None:
             os.environ['TMPDIR'] = fileStore.getLocalTempDir()
+        self._maxMemory = jobStore.config.maxMemory
         super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore)
 
 def readGlobalFileWithoutCache(fileStore, jobStoreID):
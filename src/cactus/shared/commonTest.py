@@ -9,9 +9,23 @@ from sonLib.bioio import system
 from toil.job import Job
 from toil.common import Toil
 from cactus.shared.test import silentOnSuccess
+from cactus.shared import common
 from cactus.shared.common import encodeFlowerNames, decodeFirstFlowerName, \
                                  runCactusSplitFlowersBySecondaryGrouping, \
-                                 cactus_call, ChildTreeJob
+                                 readFlowerNames, iterFlowerNames, \
+                                 encodeBinaryFlowerNames, decodeBinaryFlowerNames, \
+                                 getNumberOfFlowers, encodeFlowerSizes, decodeFlowerSizes, \
+                                 concatenateFlowerNames, packFlowerGroups, \
+                                 cactus_call, cactus_call_lines, ChildTreeJob, \
+                                 RoundedJob, OOMError
+
+class FakeFileStore(object):
+    """Collects the messages logged to the leader."""
+    def __init__(self):
+        self.messages = []
+
+    def logToMaster(self, message):
+        self.messages.append(message)
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -50,6 +64,72 @@ class TestCase(unittest.TestCase):
         self.assertEquals([(True, "1 13") ], runCactusSplitFlowersBySecondaryGrouping("1 b 13"))
         self.assertEquals([(False, "3 9 1 1"), (False, "2 8 4"), (True, "3 13 7 8")], runCactusSplitFlowersBySecondaryGrouping("8 9 1 1 a -3 4 b 1 7 8"))
 
+    def testBinaryFlowerNames(self):
+        for flowerNames in ["0", "1 1", "3 100 -95 995", "1 b -1", "2 b 7 a 1",
+                            "8 9 1 1 a -3 4 b 1 7 8", "2 %i -%i" % (2**62, 2**40)]:
+            binaryFlowerNames = encodeBinaryFlowerNames(flowerNames)
+            self.assertTrue(len(binaryFlowerNames) <= len(flowerNames) + 2)
+            self.assertEquals(flowerNames, decodeBinaryFlowerNames(binaryFlowerNames))
+            # Already-encoded names are left alone
+            self.assertEquals(binaryFlowerNames, encodeBinaryFlowerNames(binaryFlowerNames))
+            self.assertEquals(decodeFirstFlowerName(flowerNames), decodeFirstFlowerName(binaryFlowerNames))
+            self.assertEquals(getNumberOfFlowers(flowerNames), getNumberOfFlowers(binaryFlowerNames))
+            self.assertEquals(runCactusSplitFlowersBySecondaryGrouping(flowerNames),
+                              [(overlarge, decodeBinaryFlowerNames(group)) for overlarge, group in \
+                               runCactusSplitFlowersBySecondaryGrouping(binaryFlowerNames)])
+        self.assertEquals("\xca\x08\x02\x06\x05\x12\x02\x02\x05\x08\x02\x0e\x10",
+                          encodeBinaryFlowerNames("8 9 1 1 a -3 4 b 1 7 8"))
+
+        flowerSizes = [0, 1, 127, 128, 1000000, 2**40]
+        self.assertEquals(flowerSizes, decodeFlowerSizes(encodeFlowerSizes(flowerSizes)))
+        self.assertEquals([], decodeFlowerSizes(encodeFlowerSizes([])))
+
+    def testConcatenateFlowerNames(self):
+        self.assertEquals("3 100 a -95 995", concatenateFlowerNames(["1 100", "2 5 995"]))
+        self.assertEquals("4 9 1 b 3 a -5", concatenateFlowerNames(["2 9 1", encodeBinaryFlowerNames("1 b 13"), "0", "1 8"]))
+        self.assertEquals([(False, "1 9"), (True, "1 13"), (False, "1 8")],
+                          runCactusSplitFlowersBySecondaryGrouping(concatenateFlowerNames(["1 9", "1 b 13", "1 8"])))
+
+    def testPackFlowerGroups(self):
+        groups = [(False, "1 1", [5]), (True, "1 b 2", [50]), (False, "1 3", [6]),
+                  (False, "1 4", [20]), (False, "1 5", [4]), (False, "1 6", [5])]
+        packed = list(packFlowerGroups(iter(groups), 10))
+        # Overlarge and big groups are untouched
+        self.assertEquals(groups[1], packed[0])
+        self.assertEquals(groups[3], packed[1])
+        # The small ones are packed into as few groups as possible
+        self.assertEquals(2, len(packed[2:]))
+        for overlarge, flowerNames, flowerSizes in packed[2:]:
+            self.assertFalse(overlarge)
+            self.assertTrue(sum(flowerSizes) <= 10)
+            self.assertEquals(getNumberOfFlowers(flowerNames), len(flowerSizes))
+        packedNames = []
+        for overlarge, flowerNames, flowerSizes in packed[2:]:
+            for overlarge, group in runCactusSplitFlowersBySecondaryGrouping(flowerNames):
+                packedNames.append(decodeFirstFlowerName(group))
+        self.assertEquals([1, 3, 5, 6], sorted(packedNames))
+
+    def testPackFlowerGroupsWindow(self):
+        """The small groups of a stream are packed a window at a time,
+        without reading the rest of the stream first."""
+        def groups():
+            for i in xrange(1, 8):
+                yield False, encodeFlowerNames([i]), [3]
+            raise RuntimeError("Read past the first window")
+        packed = packFlowerGroups(groups(), 10, windowSize=7)
+        firstWindow = [packed.next() for i in xrange(3)]
+        self.assertEquals([[3, 3, 3], [3, 3, 3], [3]], [flowerSizes for overlarge, flowerNames, flowerSizes in firstWindow])
+        self.assertRaises(RuntimeError, packed.next)
+
+    def testReadFlowerNames(self):
+        self.assertEquals([(True, "2 5 3", [100, 200])], readFlowerNames("1 2 5 100 3 200\n"))
+        self.assertEquals([(False, "2 5 a 3", [100, 200]), (True, "1 b 9", [7])],
+                          readFlowerNames("0 2 5 100 a 3 200\n1 1 b 9 7\n\n"))
+        # The iterator shouldn't need to see all the lines up front
+        flowers = iterFlowerNames(iter(["0 1 5 100", "0 1 6 200"]))
+        self.assertEquals((False, "1 5", [100]), flowers.next())
+        self.assertEquals([(False, "1 6", [200])], list(flowers))
+
     def testCactusCall(self):
         inputFile = getTempFile(rootDir=self.tempDir)
 
@@ -71,6 +151,72 @@ class TestCase(unittest.TestCase):
 
         self.assertEquals(input, output)
 
+        #Stream the output back line by line
+        lines = list(cactus_call_lines(stdin_string=input,
+                                       parameters=["docker_test_script"]))
+        self.assertEquals(input, "".join(lines))
+        self.assertTrue('' not in lines)
+
+    @silentOnSuccess
+    def testCactusCallPooled(self):
+        """Check that calls through a pooled container behave like calls
+        through a fresh container."""
+        if os.environ.get("CACTUS_BINARIES_MODE", "docker") != "docker":
+            return
+        oldEnviron = os.environ.copy()
+        os.environ["CACTUS_DOCKER_POOL"] = "1"
+        os.environ["CACTUS_DOCKER_POOL_ROOT"] = self.tempDir
+        os.environ["CACTUS_DOCKER_POOL_IDLE_TIMEOUT"] = "10"
+        try:
+            inputFile = getTempFile(rootDir=self.tempDir)
+            with open(inputFile, 'w') as fh:
+                fh.write("ACGT\n" * 1000)
+            input = "".join(open(inputFile).read().split("\n"))
+
+            # Twice, so that the second call reuses the container
+            for i in xrange(2):
+                output = "".join(cactus_call(infile=inputFile, check_output=True,
+                                             work_dir=self.tempDir,
+                                             parameters=["docker_test_script"]).split("\n"))
+                self.assertEquals(input, output)
+
+            outputFile = getTempFile(rootDir=self.tempDir)
+            cactus_call(stdin_string=input, outfile=outputFile, work_dir=self.tempDir,
+                        parameters=["docker_test_script"])
+            self.assertEquals(input, "".join(open(outputFile).read().split("\n")))
+
+            # Failures should still be reported
+            self.assertEquals(1, cactus_call(work_dir=self.tempDir, check_result=True,
+                                             parameters=["false"]))
+
+            # The pooled container's memory usage covers other calls
+            # too, so it shouldn't be logged as a datapoint for this one
+            fileStore = FakeFileStore()
+            cactus_call(infile=inputFile, check_output=True, work_dir=self.tempDir,
+                        parameters=["docker_test_script"], job_name="test",
+                        features={"length": len(input)}, fileStore=fileStore)
+            self.assertFalse(any("Max memory used" in message for message in fileStore.messages))
+
+            # A container that goes away between being found and the
+            # exec shouldn't fail the call
+            realDockerExecCommand = common.dockerExecCommand
+            def dockerExecCommandAfterExit(**kwargs):
+                call, containerInfo = realDockerExecCommand(**kwargs)
+                common.dockerExecCommand = realDockerExecCommand
+                system("docker rm -f %s" % containerInfo['id'])
+                return call, containerInfo
+            common.dockerExecCommand = dockerExecCommandAfterExit
+            try:
+                output = "".join(cactus_call(infile=inputFile, check_output=True,
+                                             work_dir=self.tempDir,
+                                             parameters=["docker_test_script"]).split("\n"))
+            finally:
+                common.dockerExecCommand = realDockerExecCommand
+            self.assertEquals(input, output)
+        finally:
+            os.environ.clear()
+            os.environ.update(oldEnviron)
+
     @silentOnSuccess
     def testChildTreeJob(self):
         """Check that the ChildTreeJob class runs all children."""
@@ -88,6 +234,57 @@ class TestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
         shutil.rmtree(flagDir)
 
+    def testGetEscalatedMemory(self):
+        mib = 1024*1024
+        job = RoundedJob(memory=100*mib)
+        self.assertEquals(None, job.getEscalatedMemory())
+        job.oomMemoryEscalation = (2, 4)
+        self.assertEquals(200*mib, job.getEscalatedMemory())
+        job._oomAttempt = 1
+        self.assertEquals(400*mib, job.getEscalatedMemory())
+        job.memoryCap = 300*mib
+        self.assertEquals(300*mib, job.getEscalatedMemory())
+        job.memoryCap = 50*mib
+        self.assertEquals(None, job.getEscalatedMemory())
+        job._oomAttempt = 2
+        job.memoryCap = None
+        self.assertEquals(None, job.getEscalatedMemory())
+
+    @silentOnSuccess
+    def testOOMRetry(self):
+        """Check that a job that runs out of memory is re-run with more."""
+        flagDir = getTempDirectory()
+
+        options = Job.Runner.getDefaultOptions(getTempDirectory())
+        shutil.rmtree(options.jobStore)
+
+        with Toil(options) as toil:
+            toil.start(OOMTestJob(flagDir))
+
+        with open(os.path.join(flagDir, "memory")) as f:
+            self.assertEquals(400*1024*1024, int(f.read()))
+        # Each run started from the job as it was created, not as the
+        # failed run left it
+        with open(os.path.join(flagDir, "attempts")) as f:
+            self.assertEquals("[1]", f.read())
+        shutil.rmtree(flagDir)
+
+class OOMTestJob(RoundedJob):
+    def __init__(self, flagDir):
+        self.flagDir = flagDir
+        self.attempts = []
+        super(OOMTestJob, self).__init__(memory=100*1024*1024)
+        self.oomMemoryEscalation = (2, 4)
+
+    def run(self, fileStore):
+        self.attempts.append(1)
+        if self.memory < 400*1024*1024:
+            raise OOMError("Not enough memory")
+        with open(os.path.join(self.flagDir, "attempts"), 'w') as f:
+            f.write(str(self.attempts))
+        with open(os.path.join(self.flagDir, "memory"), 'w') as f:
+            f.write(str(self.memory))
+
 class CTTestParent(ChildTreeJob):
     def __init__(self, flagDir, numChildren):
         self.flagDir = flagDir
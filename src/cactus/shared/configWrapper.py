@@ -185,6 +185,36 @@ class ConfigWrapper:
             return int(ktServerElem.attrib["cpu"])
         return default           
 
+    def getKtserverIncrementalSnapshots(self):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "incrementalSnapshots" in ktServerElem.attrib:
+            return bool(int(ktServerElem.attrib["incrementalSnapshots"]))
+        return False
+
+    def getKtserverShards(self):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "shards" in ktServerElem.attrib:
+            return int(ktServerElem.attrib["shards"])
+        return 1
+
+    def getKtserverWarmHandoff(self):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "warmHandoff" in ktServerElem.attrib:
+            return bool(int(ktServerElem.attrib["warmHandoff"]))
+        return False
+
+    def getKtserverSnapshotInterval(self):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "snapshotInterval" in ktServerElem.attrib:
+            return int(ktServerElem.attrib["snapshotInterval"])
+        return 600
+
+    def getKtserverAutoTune(self):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "autoTune" in ktServerElem.attrib:
+            return bool(int(ktServerElem.attrib["autoTune"]))
+        return True
+
     def getDefaultMemory(self):
         constantsElem = self.xmlRoot.find("constants")
         return int(constantsElem.attrib["defaultMemory"])
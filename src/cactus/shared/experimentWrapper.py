@@ -20,7 +20,9 @@ class DbElemWrapper(object):
         dbElem = confElem.find(typeString)
         self.dbElem = dbElem
         self.confElem = confElem
-        self.dbElem.attrib["database_dir"] = "fakepath"
+        if typeString == "kyoto_tycoon" or "database_dir" not in self.dbElem.attrib:
+            # Only the embedded DBs keep a real directory
+            self.dbElem.attrib["database_dir"] = "fakepath"
 
     def check(self):
         """Function checks the database conf is as expected and creates useful exceptions
@@ -55,6 +57,12 @@ class DbElemWrapper(object):
     def getDbType(self):
         return self.dbElem.tag
 
+    def getDbDir(self):
+        return self.dbElem.attrib["database_dir"]
+
+    def setDbDir(self, path):
+        self.dbElem.attrib["database_dir"] = path
+
     def getDbPort(self):
         assert self.getDbType() == "kyoto_tycoon"
         return int(self.dbElem.attrib["port"])
@@ -73,6 +81,31 @@ class DbElemWrapper(object):
         assert self.getDbType() == "kyoto_tycoon"
         self.dbElem.attrib["host"] = host
 
+    def getDbShards(self):
+        """Get the (host, port) of each ktserver a sharded DB is spread
+        over, or None if the DB isn't sharded."""
+        if "shards" not in self.confElem.attrib:
+            return None
+        shards = []
+        for shard in self.confElem.attrib["shards"].split():
+            host, port = shard.rsplit(":", 1)
+            shards.append((host, int(port)))
+        return shards
+
+    def setDbShards(self, shards):
+        assert self.getDbType() == "kyoto_tycoon"
+        self.confElem.attrib["shards"] = " ".join("%s:%i" % (host, port) for host, port in shards)
+
+    def getDbControlPort(self):
+        assert self.getDbType() == "kyoto_tycoon"
+        if "control_port" in self.dbElem.attrib:
+            return int(self.dbElem.attrib["control_port"])
+        return None
+
+    def setDbControlPort(self, port):
+        assert self.getDbType() == "kyoto_tycoon"
+        self.dbElem.attrib["control_port"] = str(port)
+
     def getDbServerOptions(self):
         assert self.getDbType() == "kyoto_tycoon"
         if "server_options" in self.dbElem.attrib:
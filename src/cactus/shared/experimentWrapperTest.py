@@ -10,6 +10,7 @@ import unittest
 import os
 import xml.etree.ElementTree as ET
 from cactus.shared.experimentWrapper import ExperimentWrapper
+from cactus.shared.experimentWrapper import DbElemWrapper
 from sonLib.nxnewick import NXNewick
 
 class TestCase(unittest.TestCase):
@@ -29,6 +30,13 @@ class TestCase(unittest.TestCase):
         for i in seqList:
             assert seqMap[os.path.splitext(i)[0].upper()] == i
     
+    def testDbShards(self):
+        dbElem = DbElemWrapper(self.__makeDiskElem().find("st_kv_database_conf"))
+        self.assertEqual(dbElem.getDbShards(), None)
+        shards = [("10.0.0.1", 1978), ("10.0.0.2", 2000)]
+        dbElem.setDbShards(shards)
+        self.assertEqual(DbElemWrapper(ET.fromstring(dbElem.getConfString())).getDbShards(), shards)
+
     def __makeXmlDummy(self, treeString, sequenceString):
         rootElem =  ET.Element("dummy")
         rootElem.attrib['species_tree'] = self.tree
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""Reading of FASTA files by memory-mapping them and indexing their records.
+
+A FastaFile finds its records in one pass over the file, which only
+looks for the header lines and counts the bases of each record a chunk
+at a time, so it never holds more than a chunk of any sequence. The
+sequence of a record (or part of it) can then be read as a series of
+chunks. If all the lines of a record but the last have the same length,
+the part is found from its position directly, as with a samtools .fai
+index, which can also be written and, when up to date, read instead of
+scanning the file.
+"""
+import os
+import mmap
+from collections import namedtuple
+
+# The bytes that aren't part of a sequence
+FASTA_WHITESPACE = " \t\n\r\x0b\x0c"
+
+# Number of bytes read at a time
+FASTA_CHUNK_SIZE = 2**20
+
+# A record of a FASTA file: the name (the first word of its header), the
+# offset of its header line, the offset and end of its sequence lines,
+# the number of bases and, if its lines all have the same length but the
+# last, the number of bases and of bytes in each line (both 0 otherwise)
+FastaRecord = namedtuple("FastaRecord", ["name", "headerOffset", "offset", "end", "length",
+                                         "lineBases", "lineBytes"])
+
+def removeWhitespace(text):
+    return text.translate(None, FASTA_WHITESPACE)
+
+class FastaFile(object):
+    """A memory-mapped FASTA file, iterable over its FastaRecords."""
+    def __init__(self, path, readIndex=True):
+        self.path = path
+        self.file = open(path, 'rb')
+        if os.path.getsize(path) > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+        indexPath = getFastaIndexPath(path)
+        if readIndex and os.path.exists(indexPath) and os.path.getmtime(indexPath) >= os.path.getmtime(path):
+            self.records = self.readIndex(indexPath)
+        else:
+            self.records = self.scanRecords()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def scanRecords(self):
+        """Find the records of the file in a single pass."""
+        records = []
+        headerOffset = self.findHeader(0)
+        while headerOffset is not None:
+            newline = self.data.find('\n', headerOffset)
+            offset = len(self.data) if newline == -1 else newline + 1
+            nextHeaderOffset = self.findHeader(offset)
+            end = len(self.data) if nextHeaderOffset is None else nextHeaderOffset
+            words = self.data[headerOffset + 1:offset].split()
+            length = 0
+            for chunkStart in xrange(offset, end, FASTA_CHUNK_SIZE):
+                length += len(removeWhitespace(self.data[chunkStart:min(end, chunkStart + FASTA_CHUNK_SIZE)]))
+            lineBases, lineBytes = self.getLineLayout(offset, end, length)
+            records.append(FastaRecord(words[0] if len(words) > 0 else "", headerOffset, offset, end,
+                                       length, lineBases, lineBytes))
+            headerOffset = nextHeaderOffset
+        return records
+
+    def findHeader(self, start):
+        """Get the offset of the first header line starting at or after
+        start, or None if there are no more."""
+        if start == 0 and self.data[:1] == '>':
+            return 0
+        if start > 0 and self.data[start - 1:start] == '\n' and self.data[start:start + 1] == '>':
+            return start
+        newline = self.data.find('\n>', start)
+        return None if newline == -1 else newline + 1
+
+    def getLineLayout(self, offset, end, length):
+        """Get the number of bases and bytes of each line of a record, if
+        they are the same for all the lines but the last, or (0, 0)."""
+        if length == 0:
+            return 0, 0
+        newline = self.data.find('\n', offset, end)
+        lineBytes = (end if newline == -1 else newline + 1) - offset
+        lineBases = len(self.data[offset:offset + lineBytes].rstrip(FASTA_WHITESPACE))
+        if lineBases == 0:
+            return 0, 0
+        fullLines = length // lineBases
+        linesPerChunk = max(1, FASTA_CHUNK_SIZE // lineBytes)
+        for firstLine in xrange(0, fullLines, linesPerChunk):
+            lines = min(linesPerChunk, fullLines - firstLine)
+            chunk = self.data[offset + firstLine * lineBytes:min(end, offset + (firstLine + lines) * lineBytes)]
+            # All the bases must be in the first lineBases columns
+            if len(removeWhitespace(chunk)) != lines * lineBases:
+                return 0, 0
+            for column in xrange(lineBases, lineBytes):
+                if removeWhitespace(chunk[column::lineBytes]) != "":
+                    return 0, 0
+        remainder = length - fullLines * lineBases
+        tail = self.data[min(end, offset + fullLines * lineBytes):end]
+        if removeWhitespace(tail[:remainder]) != tail[:remainder] or removeWhitespace(tail[remainder:]) != "":
+            return 0, 0
+        return lineBases, lineBytes
+
+    def getHeader(self, record):
+        """Get the header line of a record, without the '>'."""
+        return self.data[record.headerOffset + 1:record.offset].rstrip("\r\n")
+
+    def iterSequence(self, record, start=0, end=None, chunkSize=FASTA_CHUNK_SIZE):
+        """Iterate over chunks of the bases of a record in [start, end),
+        clipped to the sequence as slicing would be."""
+        end = record.length if end is None else min(end, record.length)
+        start = max(0, start)
+        if start >= end:
+            return
+        if record.lineBases > 0:
+            startByte = record.offset + (start // record.lineBases) * record.lineBytes + start % record.lineBases
+            endByte = record.offset + ((end - 1) // record.lineBases) * record.lineBytes + \
+                      (end - 1) % record.lineBases + 1
+            for chunkStart in xrange(startByte, endByte, chunkSize):
+                yield removeWhitespace(self.data[chunkStart:min(endByte, chunkStart + chunkSize)])
+            return
+        position = 0
+        for chunkStart in xrange(record.offset, record.end, chunkSize):
+            chunk = removeWhitespace(self.data[chunkStart:min(record.end, chunkStart + chunkSize)])
+            if position + len(chunk) > start:
+                yield chunk[max(0, start - position):end - position]
+            position += len(chunk)
+            if position >= end:
+                break
+
+    def getSequence(self, record, start=0, end=None):
+        return "".join(self.iterSequence(record, start, end))
+
+    def iterSections(self, chunkSize=FASTA_CHUNK_SIZE):
+        """Iterate over the whole file as (isHeader, text) pairs: each
+        header line (with its newline) and chunks of the lines between
+        them, so that it can be copied with changes."""
+        preambleEnd = self.records[0].headerOffset if len(self.records) > 0 else len(self.data)
+        for chunkStart in xrange(0, preambleEnd, chunkSize):
+            yield False, self.data[chunkStart:min(preambleEnd, chunkStart + chunkSize)]
+        for record in self.records:
+            yield True, self.data[record.headerOffset:record.offset]
+            for chunkStart in xrange(record.offset, record.end, chunkSize):
+                yield False, self.data[chunkStart:min(record.end, chunkStart + chunkSize)]
+
+    def readIndex(self, indexPath):
+        """Get the records from a .fai index of the file."""
+        entries = []
+        with open(indexPath) as f:
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) >= 5:
+                    entries.append((fields[0],) + tuple(int(field) for field in fields[1:5]))
+        records = []
+        for name, length, offset, lineBases, lineBytes in entries:
+            headerOffset = self.data.rfind('\n', 0, max(0, offset - 1)) + 1
+            records.append(FastaRecord(name, headerOffset, offset, None, length, lineBases, lineBytes))
+        # Each record's sequence ends where the next header starts
+        for i, record in enumerate(records):
+            end = records[i + 1].headerOffset if i + 1 < len(records) else len(self.data)
+            records[i] = record._replace(end=end)
+        return records
+
+    def writeIndex(self, indexPath=None):
+        """Write a samtools-style .fai index of the file, by default next
+        to it, which is used instead of scanning the file from then on."""
+        for record in self.records:
+            if record.length > 0 and record.lineBases == 0:
+                raise RuntimeError("The lines of %s in %s differ in length, so it can't be indexed" %
+                                   (record.name, self.path))
+        with open(indexPath or getFastaIndexPath(self.path), 'w') as f:
+            for record in self.records:
+                f.write("%s\t%i\t%i\t%i\t%i\n" % (record.name, record.length, record.offset,
+                                                  record.lineBases, record.lineBytes))
+
+def getFastaIndexPath(path):
+    return path + ".fai"
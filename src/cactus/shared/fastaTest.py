@@ -0,0 +1,110 @@
+import os
+import random
+import unittest
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.shared import fasta
+from cactus.shared.fasta import FastaFile, getFastaIndexPath
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.path = os.path.join(self.tempDir, "seqs.fa")
+        random.seed(1)
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def writeFasta(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def getRandomFasta(self, regular):
+        """Get the text of a random FASTA file and its (name, sequence) records."""
+        records = []
+        text = ""
+        for i in xrange(random.randint(0, 5)):
+            name = "seq%i" % i
+            sequence = "".join(random.choice("ACGTNacgtn") for j in xrange(random.randint(0, 300)))
+            records.append((name, sequence))
+            newline = random.choice(["\n", "\r\n"])
+            text += ">%s description %i%s" % (name, i, newline)
+            lineLength = random.randint(1, 70)
+            position = 0
+            while position < len(sequence):
+                if not regular:
+                    lineLength = random.randint(1, 70)
+                text += sequence[position:position + lineLength] + newline
+                position += lineLength
+                if not regular and random.random() < 0.1:
+                    text += newline
+        return text, records
+
+    def checkRecords(self, records):
+        with FastaFile(self.path) as fastaFile:
+            self.assertEquals([name for name, sequence in records], [record.name for record in fastaFile])
+            for record, (name, sequence) in zip(fastaFile, records):
+                self.assertEquals(len(sequence), record.length)
+                self.assertEquals(sequence, fastaFile.getSequence(record))
+                for i in xrange(10):
+                    start = random.randint(-5, len(sequence) + 5)
+                    end = random.randint(-5, len(sequence) + 5)
+                    expected = sequence[max(0, start):max(0, end)]
+                    self.assertEquals(expected, fastaFile.getSequence(record, start, end))
+                    self.assertEquals(expected,
+                                      "".join(fastaFile.iterSequence(record, start, end, chunkSize=7)))
+            with open(self.path) as f:
+                self.assertEquals(f.read(), "".join(text for isHeader, text in fastaFile.iterSections(chunkSize=7)))
+
+    def testRandomFiles(self):
+        defaultChunkSize = fasta.FASTA_CHUNK_SIZE
+        try:
+            for chunkSize in (defaultChunkSize, 13):
+                fasta.FASTA_CHUNK_SIZE = chunkSize
+                for regular in (True, False):
+                    for i in xrange(20):
+                        text, records = self.getRandomFasta(regular)
+                        self.writeFasta(text)
+                        self.checkRecords(records)
+        finally:
+            fasta.FASTA_CHUNK_SIZE = defaultChunkSize
+
+    def testLineLayout(self):
+        self.writeFasta(">a x\nACGT\nACGT\nAC\n>b\nACG\nACGT\n>c\n>d\r\nAC\r\nA\r\n\r\n>e")
+        with FastaFile(self.path) as fastaFile:
+            self.assertEquals(["a", "b", "c", "d", "e"], [record.name for record in fastaFile])
+            self.assertEquals([10, 7, 0, 3, 0], [record.length for record in fastaFile])
+            self.assertEquals([(4, 5), (0, 0), (0, 0), (2, 4), (0, 0)],
+                              [(record.lineBases, record.lineBytes) for record in fastaFile])
+            self.assertEquals("a x", fastaFile.getHeader(fastaFile.records[0]))
+            self.assertEquals("d", fastaFile.getHeader(fastaFile.records[3]))
+            self.assertEquals(["CGT", "CGA"], [fastaFile.getSequence(record, 1, 4)
+                                               for record in fastaFile.records[:2]])
+
+    def testIndex(self):
+        self.writeFasta(">a\nACGT\nACGT\nAC\n>b\n>c\nAAAAAA\nAAA\n")
+        with FastaFile(self.path) as fastaFile:
+            records = fastaFile.records
+            fastaFile.writeIndex()
+        with open(getFastaIndexPath(self.path)) as f:
+            self.assertEquals("a\t10\t3\t4\t5\nb\t0\t19\t0\t0\nc\t9\t22\t6\t7\n", f.read())
+        with FastaFile(self.path) as fastaFile:
+            self.assertEquals(records, fastaFile.records)
+            self.assertEquals("AAAAAAAAA", fastaFile.getSequence(fastaFile.records[2]))
+        # Files whose lines differ in length can't be indexed
+        os.remove(getFastaIndexPath(self.path))
+        self.writeFasta(">a\nACG\nACGT\n")
+        with FastaFile(self.path) as fastaFile:
+            self.assertRaises(RuntimeError, fastaFile.writeIndex)
+
+    def testEmpty(self):
+        self.writeFasta("")
+        with FastaFile(self.path) as fastaFile:
+            self.assertEquals([], list(fastaFile))
+            self.assertEquals([], list(fastaFile.iterSections()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Compares the job store footprint and (un)pickling time of recursion
+jobs carrying their flowers as the original text strings and as the
+compact binary form.
+
+The flower groups are simulated to look like the output of
+cactus_workflow_getFlowers deep in the cactus tree: many groups of
+small flowers with nearby names.
+"""
+import random
+import time
+import cPickle
+from argparse import ArgumentParser
+
+from cactus.shared.common import encodeFlowerNames
+from cactus.shared.common import encodeBinaryFlowerNames
+from cactus.shared.common import encodeFlowerSizes
+
+class TextFlowers(object):
+    """Stand-in for the flower state of a CactusRecursionJob as it was
+    pickled before the binary encoding."""
+    def __init__(self, flowerNames, flowerSizes):
+        self.flowerNames = flowerNames
+        self.flowerSizes = flowerSizes
+
+class BinaryFlowers(object):
+    """Stand-in for the flower state of a CactusRecursionJob using the
+    binary encoding."""
+    def __init__(self, flowerNames, flowerSizes):
+        self.flowerNames = encodeBinaryFlowerNames(flowerNames)
+        self.encodedFlowerSizes = encodeFlowerSizes(flowerSizes)
+
+def simulateFlowerGroups(numFlowers, maxFlowerGroupSize, maxFlowerSize):
+    """Yields (flowerNames, flowerSizes) for groups of flowers packed up to
+    maxFlowerGroupSize bases, as the flower writer does."""
+    name = random.randint(0, 2**40)
+    names = []
+    sizes = []
+    for i in xrange(numFlowers):
+        name += random.randint(1, 20)
+        size = random.randint(1, maxFlowerSize)
+        if len(names) > 0 and sum(sizes) + size > maxFlowerGroupSize:
+            yield encodeFlowerNames(names), sizes
+            names = []
+            sizes = []
+        names.append(name)
+        sizes.append(size)
+    if len(names) > 0:
+        yield encodeFlowerNames(names), sizes
+
+def benchmark(jobClass, flowerGroups, repeats):
+    jobs = [jobClass(flowerNames, flowerSizes) for flowerNames, flowerSizes in flowerGroups]
+    pickles = [cPickle.dumps(job, cPickle.HIGHEST_PROTOCOL) for job in jobs]
+    totalBytes = sum(len(pickled) for pickled in pickles)
+    start = time.time()
+    for i in xrange(repeats):
+        for job in jobs:
+            cPickle.dumps(job, cPickle.HIGHEST_PROTOCOL)
+    pickleTime = (time.time() - start) / repeats
+    start = time.time()
+    for i in xrange(repeats):
+        for pickled in pickles:
+            cPickle.loads(pickled)
+    unpickleTime = (time.time() - start) / repeats
+    return len(jobs), totalBytes, pickleTime, unpickleTime
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--numFlowers", type=int, default=1000000)
+    parser.add_argument("--maxFlowerGroupSize", type=int, default=1000000)
+    parser.add_argument("--maxFlowerSize", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    flowerGroups = list(simulateFlowerGroups(options.numFlowers,
+                                             options.maxFlowerGroupSize,
+                                             options.maxFlowerSize))
+    print "%-8s %10s %14s %12s %12s" % ("encoding", "jobs", "job store (B)", "pickle (s)", "unpickle (s)")
+    for name, jobClass in (("text", TextFlowers), ("binary", BinaryFlowers)):
+        numJobs, totalBytes, pickleTime, unpickleTime = benchmark(jobClass, flowerGroups, options.repeats)
+        print "%-8s %10i %14i %12.3f %12.3f" % (name, numJobs, totalBytes, pickleTime, unpickleTime)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""Profiling of the cactus jobs and the tools they run.
+
+When CACTUS_PROFILE is set to 1 (cactus_progressive's --profile option
+does this), every RoundedJob records its wall-clock time, CPU time and
+peak RSS, along with the same for every cactus_call it makes, and logs
+the record to the leader as JSON. Latencies of other events, such as
+ktservers starting up and shutting down, are sent the same way, as are
+parameters chosen at run time (e.g. the ktserver tuning). The leader appends these records to a
+JSON-lines file (ProfileStore, fed by ProfileLogHandler) that is kept
+across restarts, and at the end of the run summarizes them per phase,
+per job class and per tool into a JSON and an HTML report.
+"""
+import os
+import re
+import cgi
+import json
+import time
+import logging
+import resource
+import functools
+
+PROFILE_RECORD_PREFIX = "Cactus profile record: "
+PROFILE_RECORD_RE = re.compile(re.escape(PROFILE_RECORD_PREFIX) + r"(\{.*\})\s*$")
+
+def profilingEnabled():
+    return os.environ.get("CACTUS_PROFILE") == "1"
+
+# Profiles of the jobs running in this process, innermost last
+_activeProfiles = []
+
+def readPeakRss():
+    """Get the peak RSS of this process since it was last reset by
+    resetPeakRss, or None if /proc doesn't give it."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def resetPeakRss():
+    """Reset the peak RSS of this process to its current RSS (Linux 4.0
+    and up), returning whether that worked."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except IOError:
+        return False
+
+def _updatePeakRss():
+    """Fold the peak RSS since the last reset into the jobs running."""
+    peakRss = readPeakRss()
+    for profile in _activeProfiles:
+        if profile.peakRss is not None and peakRss is not None:
+            profile.peakRss = max(profile.peakRss, peakRss)
+
+class JobProfile(object):
+    """Resource usage of one job and the tools it ran.
+
+    A worker runs many jobs, so the job's own peak RSS is measured by
+    resetting the process's peak when the job starts. Where that can't
+    be done, only the worker's peak over its lifetime is known, which is
+    recorded as workerPeakRss instead."""
+    def __init__(self, jobClass, phase=None):
+        self.jobClass = jobClass
+        self.phase = phase
+        self.calls = []
+        self.start = time.time()
+        times = os.times()
+        self._startCpu = times[0] + times[1]
+        self.peakRss = 0 if resetPeakRss() else None
+
+    def addCall(self, tool, start, wall, cpu, peakRss):
+        self.calls.append({'tool': tool,
+                           'start': start,
+                           'wall': wall,
+                           'cpu': cpu,
+                           'peakRss': peakRss})
+
+    def toRecord(self, failed=False):
+        times = os.times()
+        end = time.time()
+        toolCpu = sum(call['cpu'] for call in self.calls if call['cpu'] is not None)
+        toolRss = [call['peakRss'] for call in self.calls if call['peakRss'] is not None]
+        if self.peakRss is not None:
+            peakRss = max([self.peakRss] + toolRss)
+        else:
+            peakRss = max(toolRss) if toolRss else None
+        record = {'jobClass': self.jobClass,
+                  'phase': self.phase,
+                  'start': self.start,
+                  'end': end,
+                  'wall': end - self.start,
+                  'jobCpu': times[0] + times[1] - self._startCpu,
+                  'cpu': times[0] + times[1] - self._startCpu + toolCpu,
+                  'peakRss': peakRss,
+                  'failed': failed,
+                  'calls': self.calls}
+        if self.peakRss is None:
+            # ru_maxrss is in kilobytes on Linux
+            record['workerPeakRss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return record
+
+def startJobProfile(jobClass, phase=None):
+    # The peak of any job this one runs inside is taken before it is
+    # reset for this one
+    _updatePeakRss()
+    profile = JobProfile(jobClass, phase)
+    _activeProfiles.append(profile)
+    return profile
+
+def finishJobProfile(profile, fileStore, failed=False):
+    """Stop profiling a job and send its record to the leader."""
+    _updatePeakRss()
+    _activeProfiles.remove(profile)
+    fileStore.logToMaster(PROFILE_RECORD_PREFIX + json.dumps(profile.toRecord(failed=failed)))
+
+def profileJobFunction(phase):
+    """Decorator that profiles a Toil job function (which doesn't go
+    through RoundedJob) under the given phase."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(job, *args, **kwargs):
+            if not profilingEnabled():
+                return fn(job, *args, **kwargs)
+            profile = startJobProfile(fn.__name__, phase)
+            failed = True
+            try:
+                returnValue = fn(job, *args, **kwargs)
+                failed = False
+                return returnValue
+            finally:
+                finishJobProfile(profile, job.fileStore, failed=failed)
+        return wrapper
+    return decorator
+
+def logLatency(fileStore, name, start, latency):
+    """Send the time taken by some event that isn't a job or a tool call
+    (e.g. a server starting up) to the leader."""
+    if profilingEnabled():
+        fileStore.logToMaster(PROFILE_RECORD_PREFIX + json.dumps({'latency': name,
+                                                                  'start': start,
+                                                                  'wall': latency}))
+
+def logParameters(fileStore, name, parameters):
+    """Send a dict of parameters chosen during the run (e.g. the tuning of a
+    ktserver) to the leader, to be recorded in the report."""
+    if profilingEnabled():
+        fileStore.logToMaster(PROFILE_RECORD_PREFIX + json.dumps({'parameters': name,
+                                                                  'start': time.time(),
+                                                                  'values': parameters}))
+
+def recordToolCall(tool, start, wall, cpu, peakRss):
+    """Add a tool call to the profile of the job running it, if any."""
+    if len(_activeProfiles) > 0:
+        _activeProfiles[-1].addCall(tool, start, wall, cpu, peakRss)
+
+class ProfileStore(object):
+    """Profile records, kept in a JSON-lines file that is appended to as
+    records arrive so that nothing is lost if the leader dies."""
+    def __init__(self, path, restart=False):
+        self.path = path
+        if not restart and os.path.exists(path):
+            # A fresh run starts a fresh profile
+            os.remove(path)
+        self.runStart = time.time()
+        self._append({'type': 'run', 'start': self.runStart, 'restart': restart})
+
+    def _append(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def addRecord(self, record):
+        if 'latency' in record:
+            record['type'] = 'latency'
+        elif 'parameters' in record:
+            record['type'] = 'parameters'
+        else:
+            record['type'] = 'job'
+        self._append(record)
+
+    def finishRun(self, succeeded):
+        self._append({'type': 'runEnd', 'start': self.runStart, 'end': time.time(),
+                      'succeeded': succeeded})
+
+    def getRecords(self):
+        records = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Truncated by a crash
+                    continue
+        return records
+
+class ProfileLogHandler(logging.Handler):
+    """Picks up the profile records logged to the leader by the jobs."""
+    def __init__(self, store):
+        logging.Handler.__init__(self)
+        self.store = store
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            return
+        match = PROFILE_RECORD_RE.search(message)
+        if match is None:
+            return
+        try:
+            profileRecord = json.loads(match.group(1))
+        except ValueError:
+            return
+        self.store.addRecord(profileRecord)
+
+def _newSummary():
+    return {'jobs': 0, 'failedJobs': 0, 'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+            'peakRss': 0, 'firstStart': None, 'lastEnd': None}
+
+def _addToSummary(summary, start, end, wall, cpu, peakRss):
+    summary['wall'] += wall
+    summary['cpu'] += cpu if cpu is not None else 0.0
+    summary['peakRss'] = max(summary['peakRss'], peakRss or 0)
+    if summary['firstStart'] is None or start < summary['firstStart']:
+        summary['firstStart'] = start
+    if summary['lastEnd'] is None or end > summary['lastEnd']:
+        summary['lastEnd'] = end
+
+def summarizeProfile(records):
+    """Aggregate the profile records per phase, per job class (within
+    its phase), per tool and per latency event, and list the parameters
+    chosen in the run. The span of a phase is the time from its first job
+    starting to its last job finishing."""
+    phases = {}
+    jobClasses = {}
+    tools = {}
+    latencies = {}
+    parameters = []
+    runs = []
+    for record in records:
+        if record.get('type') == 'latency':
+            summary = latencies.setdefault(record['latency'], {'count': 0, 'wall': 0.0, 'max': 0.0})
+            summary['count'] += 1
+            summary['wall'] += record['wall']
+            summary['max'] = max(summary['max'], record['wall'])
+            continue
+        if record.get('type') == 'parameters':
+            parameters.append({'name': record['parameters'], 'start': record['start'],
+                               'values': record['values']})
+            continue
+        if record.get('type') == 'runEnd':
+            runs.append({'start': record['start'], 'end': record['end'],
+                         'wall': record['end'] - record['start'],
+                         'succeeded': record['succeeded']})
+            continue
+        if record.get('type') != 'job':
+            continue
+        phase = record['phase'] if record['phase'] is not None else 'other'
+        for summary in (phases.setdefault(phase, _newSummary()),
+                        jobClasses.setdefault(phase, {}).setdefault(record['jobClass'], _newSummary())):
+            summary['jobs'] += 1
+            if record['failed']:
+                summary['failedJobs'] += 1
+            summary['calls'] += len(record['calls'])
+            _addToSummary(summary, record['start'], record['end'], record['wall'],
+                          record['cpu'], record['peakRss'])
+        for call in record['calls']:
+            summary = tools.setdefault(call['tool'], _newSummary())
+            summary['calls'] += 1
+            _addToSummary(summary, call['start'], call['start'] + call['wall'],
+                          call['wall'], call['cpu'], call['peakRss'])
+    for summary in phases.values():
+        summary['span'] = summary['lastEnd'] - summary['firstStart']
+    return {'runs': runs,
+            'totalWall': sum(run['wall'] for run in runs),
+            'phases': phases,
+            'jobClasses': jobClasses,
+            'tools': tools,
+            'latencies': latencies,
+            'parameters': parameters}
+
+def _htmlTable(title, columns, rows):
+    lines = ["<h2>%s</h2>" % cgi.escape(title), "<table>",
+             "<tr>%s</tr>" % "".join("<th>%s</th>" % cgi.escape(column) for column in columns)]
+    for row in rows:
+        lines.append("<tr>%s</tr>" % "".join("<td>%s</td>" % cgi.escape(str(value)) for value in row))
+    lines.append("</table>")
+    return "\n".join(lines)
+
+def _summaryRow(name, summary, span=False):
+    row = [name]
+    if span:
+        row.append("%.1f" % summary['span'])
+    return row + [summary['jobs'], summary['failedJobs'], summary['calls'],
+                  "%.1f" % summary['wall'], "%.1f" % summary['cpu'],
+                  "%.1f" % (summary['peakRss'] / 1024.0**2)]
+
+def writeProfileReport(summary, jsonPath, htmlPath):
+    with open(jsonPath, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+    summaryColumns = ["jobs", "failed jobs", "tool calls", "wall (s)", "CPU (s)", "peak RSS (MiB)"]
+    byWall = lambda items: sorted(items, key=lambda item: item[1]['wall'], reverse=True)
+    sections = [_htmlTable("Runs", ["start", "wall (s)", "succeeded"],
+                           [[time.ctime(run['start']), "%.1f" % run['wall'], run['succeeded']]
+                            for run in summary['runs']]),
+                _htmlTable("Phases", ["phase", "span (s)"] + summaryColumns,
+                           [_summaryRow(phase, phaseSummary, span=True)
+                            for phase, phaseSummary in byWall(summary['phases'].items())]),
+                _htmlTable("Job classes", ["phase"] + ["job class"] + summaryColumns,
+                           [[phase] + _summaryRow(jobClass, jobClassSummary)
+                            for phase, jobClasses in sorted(summary['jobClasses'].items())
+                            for jobClass, jobClassSummary in byWall(jobClasses.items())]),
+                _htmlTable("Tools", ["tool"] + summaryColumns,
+                           [_summaryRow(tool, toolSummary)
+                            for tool, toolSummary in byWall(summary['tools'].items())]),
+                _htmlTable("Latencies", ["event", "count", "total (s)", "mean (s)", "max (s)"],
+                           [[name, latency['count'], "%.2f" % latency['wall'],
+                             "%.2f" % (latency['wall'] / latency['count']), "%.2f" % latency['max']]
+                            for name, latency in byWall(summary['latencies'].items())]),
+                _htmlTable("Parameters", ["name", "time", "values"],
+                           [[parameters['name'], time.ctime(parameters['start']),
+                             ", ".join("%s=%s" % item for item in sorted(parameters['values'].items()))]
+                            for parameters in summary['parameters']])]
+    with open(htmlPath, 'w') as f:
+        f.write("<html><head><title>Cactus profile</title>\n"
+                "<style>table { border-collapse: collapse; } "
+                "td, th { border: 1px solid #999; padding: 2px 8px; text-align: right; }</style>\n"
+                "</head><body>\n<h1>Cactus profile</h1>\n"
+                "<p>Total wall-clock time over all runs: %.1f s</p>\n%s\n</body></html>\n"
+                % (summary['totalWall'], "\n".join(sections)))
@@ -0,0 +1,109 @@
+import os
+import json
+import logging
+import unittest
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.shared.test import silentOnSuccess
+from cactus.shared.common import cactus_call
+from cactus.shared.profiling import ProfileStore, ProfileLogHandler, \
+                                    startJobProfile, finishJobProfile, logLatency, logParameters, \
+                                    summarizeProfile, writeProfileReport, resetPeakRss, \
+                                    PROFILE_RECORD_PREFIX
+
+class LogToMasterLogger(object):
+    """Stands in for the file store, passing messages straight to a
+    logger as the leader would."""
+    def __init__(self, log):
+        self.log = log
+
+    def logToMaster(self, text, level=logging.INFO):
+        self.log.log(level, "Got message from job at time 0: %s", text)
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.oldProfileEnv = os.environ.get("CACTUS_PROFILE")
+        os.environ["CACTUS_PROFILE"] = "1"
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        if self.oldProfileEnv is None:
+            del os.environ["CACTUS_PROFILE"]
+        else:
+            os.environ["CACTUS_PROFILE"] = self.oldProfileEnv
+        system("rm -rf %s" % self.tempDir)
+
+    def runProfiledJob(self, fileStore, jobClass, phase, numCalls):
+        profile = startJobProfile(jobClass, phase)
+        for i in xrange(numCalls):
+            cactus_call(parameters=["sleep", "0.1"])
+        finishJobProfile(profile, fileStore)
+
+    @silentOnSuccess
+    def testProfile(self):
+        path = os.path.join(self.tempDir, "profile")
+        log = logging.getLogger("profilingTest")
+        log.setLevel(logging.INFO)
+        fileStore = LogToMasterLogger(log)
+
+        # A run that is then restarted
+        for restart in (False, True):
+            store = ProfileStore(path + ".records", restart=restart)
+            handler = ProfileLogHandler(store)
+            log.addHandler(handler)
+            try:
+                self.runProfiledJob(fileStore, "CactusBarWrapper", "bar", 2)
+                self.runProfiledJob(fileStore, "CactusCafWrapper", "caf", 1)
+                logLatency(fileStore, "ktserverStartup", 0, 1.5 if restart else 0.5)
+                logParameters(fileStore, "ktserverTuning", {'bnum': 1000000, 'threads': 8})
+            finally:
+                log.removeHandler(handler)
+            store.finishRun(succeeded=restart)
+
+        summary = summarizeProfile(store.getRecords())
+        self.assertEquals(2, len(summary['runs']))
+        self.assertEquals(set(['bar', 'caf']), set(summary['phases'].keys()))
+        self.assertEquals(2, summary['phases']['bar']['jobs'])
+        self.assertEquals(4, summary['phases']['bar']['calls'])
+        self.assertTrue(summary['phases']['bar']['wall'] >= 0.4)
+        self.assertEquals(2, summary['jobClasses']['caf']['CactusCafWrapper']['jobs'])
+        self.assertEquals(6, summary['tools']['sleep']['calls'])
+        self.assertTrue(summary['tools']['sleep']['peakRss'] > 0)
+        self.assertEquals({'count': 2, 'wall': 2.0, 'max': 1.5}, summary['latencies']['ktserverStartup'])
+        self.assertEquals(2, len(summary['parameters']))
+        self.assertEquals({'bnum': 1000000, 'threads': 8}, summary['parameters'][0]['values'])
+
+        # A fresh run discards the old records
+        store = ProfileStore(path + ".records")
+        store.finishRun(succeeded=True)
+        self.assertEquals(0, len(summarizeProfile(store.getRecords())['phases']))
+
+        writeProfileReport(summary, path + ".json", path + ".html")
+        with open(path + ".json") as f:
+            self.assertEquals(6, json.load(f)['tools']['sleep']['calls'])
+        self.assertTrue(os.path.getsize(path + ".html") > 0)
+
+    def testJobPeakRss(self):
+        """A job's peak RSS is its own, not that of the jobs the worker
+        ran before it."""
+        if not resetPeakRss():
+            self.skipTest("The peak RSS can't be reset on this system")
+        records = []
+        class RecordingFileStore(object):
+            def logToMaster(self, text, level=logging.INFO):
+                records.append(json.loads(text[len(PROFILE_RECORD_PREFIX):]))
+        fileStore = RecordingFileStore()
+        profile = startJobProfile("BigJob")
+        big = bytearray(200 * 1024**2)
+        del big
+        finishJobProfile(profile, fileStore)
+        profile = startJobProfile("SmallJob")
+        finishJobProfile(profile, fileStore)
+        self.assertTrue(records[0]['peakRss'] >= 200 * 1024**2)
+        self.assertTrue(records[1]['peakRss'] < 100 * 1024**2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Learned resource model for the cactus workflow jobs.
+
+Docker-mode cactus_call logs a line like "Max memory used for job X (tool
+Y) on JSON features {...}: N" for each tool a job runs. The leader
+collects these datapoints into a JSON store that persists across runs
+(ResourceModelStore, fed by ResourceModelLogHandler). At the start of a
+run, a linear fit of memory against each feature is made per job class
+and tool. CactusJob.evaluateResourcePoly then uses these fits in place of
+the hard-coded memoryPoly. The margin added to each fit is the given
+quantile of its residuals, scaled by a safety factor.
+"""
+import os
+import re
+import json
+import logging
+
+MEMORY_DATAPOINT_RE = re.compile(r"Max memory used for job (\S+) \(tool (\S+)\) "
+                                 r"on JSON features (.*): (\d+)\s*$")
+
+class ResourceModelStore(object):
+    """Datapoints of peak memory usage, by job class and tool, kept in a
+    JSON file."""
+    def __init__(self, path, maxDatapoints=20000):
+        self.path = path
+        self.maxDatapoints = maxDatapoints
+        # jobName -> tool -> [[features, memory], ...]
+        self.datapoints = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.datapoints = json.load(f)["datapoints"]
+
+    def addDatapoint(self, jobName, tool, features, memory):
+        if memory <= 0:
+            # The container exited before its memory usage could be sampled
+            return
+        datapoints = self.datapoints.setdefault(jobName, {}).setdefault(tool, [])
+        datapoints.append([features, memory])
+        if len(datapoints) > self.maxDatapoints:
+            # Keep the most recent datapoints
+            del datapoints[:len(datapoints) - self.maxDatapoints]
+
+    def save(self):
+        tempPath = self.path + ".tmp"
+        with open(tempPath, 'w') as f:
+            json.dump({"datapoints": self.datapoints}, f)
+        os.rename(tempPath, self.path)
+
+    def fit(self, safetyMargin=0.2, residualQuantile=0.95, minDatapoints=20):
+        """Fit the datapoints, returning a dict of jobName -> tool ->
+        feature -> fit, as used by evaluateResourceModel."""
+        fits = {}
+        for jobName, tools in self.datapoints.items():
+            for tool, datapoints in tools.items():
+                if len(datapoints) < minDatapoints:
+                    continue
+                features = set(datapoints[0][0].keys())
+                for datapoint in datapoints[1:]:
+                    features &= set(datapoint[0].keys())
+                for feature in features:
+                    xs = [datapoint[0][feature] for datapoint in datapoints]
+                    if not all(isinstance(x, (int, long, float)) for x in xs):
+                        continue
+                    ys = [datapoint[1] for datapoint in datapoints]
+                    fit = fitLinear(xs, ys, residualQuantile)
+                    fit['safetyMargin'] = safetyMargin
+                    fits.setdefault(jobName, {}).setdefault(tool, {})[feature] = fit
+        return fits
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def fitLinear(xs, ys, residualQuantile):
+    """Least-squares fit of ys = slope * xs + intercept, along with a
+    quantile of the residuals to use as a margin."""
+    n = float(len(xs))
+    meanX = sum(xs) / n
+    meanY = sum(ys) / n
+    varianceX = sum((x - meanX)**2 for x in xs)
+    if varianceX == 0:
+        slope = 0.0
+    else:
+        slope = sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys)) / varianceX
+    intercept = meanY - slope * meanX
+    residuals = [y - (slope * x + intercept) for x, y in zip(xs, ys)]
+    return {'slope': slope,
+            'intercept': intercept,
+            'residual': max(0.0, quantile(residuals, residualQuantile)),
+            'minObserved': min(ys),
+            'numDatapoints': len(xs)}
+
+def evaluateResourceModel(fits, jobName, feature, x):
+    """Predict the memory needed by a job from the fits of all the tools
+    it runs, or return None if there is no fit for this feature."""
+    if fits is None or jobName not in fits:
+        return None
+    predictions = []
+    for tool, toolFits in fits[jobName].items():
+        if feature not in toolFits:
+            continue
+        fit = toolFits[feature]
+        prediction = fit['slope'] * x + fit['intercept'] + fit['residual']
+        prediction = max(prediction, fit['minObserved']) * (1 + fit['safetyMargin'])
+        predictions.append(prediction)
+    if len(predictions) == 0:
+        return None
+    return int(max(predictions))
+
+class ResourceModelLogHandler(logging.Handler):
+    """Picks up the memory datapoints logged to the leader by the jobs."""
+    def __init__(self, store):
+        logging.Handler.__init__(self)
+        self.store = store
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            return
+        match = MEMORY_DATAPOINT_RE.search(message)
+        if match is None:
+            return
+        jobName, tool, features, memory = match.groups()
+        try:
+            features = json.loads(features)
+        except ValueError:
+            return
+        self.store.addDatapoint(jobName, tool, features, int(memory))
@@ -0,0 +1,62 @@
+import os
+import json
+import logging
+import unittest
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from cactus.shared.test import silentOnSuccess
+from cactus.shared.resourceModel import ResourceModelStore, ResourceModelLogHandler, \
+                                        evaluateResourceModel, fitLinear
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def testFitLinear(self):
+        fit = fitLinear([1, 2, 3, 4], [12, 14, 16, 18], 0.95)
+        self.assertAlmostEquals(2.0, fit['slope'])
+        self.assertAlmostEquals(10.0, fit['intercept'])
+        self.assertAlmostEquals(0.0, fit['residual'])
+        # A constant feature just gives the mean
+        fit = fitLinear([5, 5], [10, 20], 0.95)
+        self.assertAlmostEquals(0.0, fit['slope'])
+        self.assertAlmostEquals(15.0, fit['intercept'])
+        self.assertAlmostEquals(5.0, fit['residual'])
+
+    @silentOnSuccess
+    def testStoreAndEvaluate(self):
+        path = os.path.join(self.tempDir, "model.json")
+        store = ResourceModelStore(path)
+        handler = ResourceModelLogHandler(store)
+        log = logging.getLogger("resourceModelTest")
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        try:
+            for i in xrange(1, 31):
+                log.info("Got message from job at time 0: Max memory used for job CactusBarWrapper "
+                         "(tool cactus_bar) on JSON features %s: %i" % (json.dumps({'flowerGroupSize': i}), 1000 * i + 500))
+            # Datapoints without a memory sample are ignored
+            log.info("Max memory used for job CactusBarWrapper (tool cactus_bar) on JSON features {\"flowerGroupSize\": 1}: 0")
+        finally:
+            log.removeHandler(handler)
+        store.save()
+
+        store = ResourceModelStore(path)
+        self.assertEquals(30, len(store.datapoints['CactusBarWrapper']['cactus_bar']))
+        fits = store.fit(safetyMargin=0.5)
+        self.assertEquals(int((1000 * 10 + 500) * 1.5),
+                          evaluateResourceModel(fits, 'CactusBarWrapper', 'flowerGroupSize', 10))
+        # Unknown jobs and features fall back to the polynomials
+        self.assertEquals(None, evaluateResourceModel(fits, 'CactusCafWrapper', 'flowerGroupSize', 10))
+        self.assertEquals(None, evaluateResourceModel(fits, 'CactusBarWrapper', 'maxFlowerSize', 10))
+        # Too little data to fit
+        self.assertEquals({}, store.fit(minDatapoints=100))
+
+if __name__ == '__main__':
+    unittest.main()